@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Benchmark of the input path of metilene (reading and parsing the TSV
+# matrix) on a synthetic beta-value matrix with three decimals and NA
+# tokens, including empty cells. The matrix is converted to a binary cache with -C, which reads
+# every row exactly once and does no segmentation. Every binary given with
+# --ref is timed on the same input and its cache is checked against the
+# first binary, e.g. a build of the previous commit:
+#
+#   git stash; make; cp metilene /tmp/metilene.old; git stash pop; make
+#   python benchmarks/bench_fileio.py [-n 10000000] [-s 100] [-r 1] [--ref /tmp/metilene.old]
+#
+# The default 10M x 100 matrix is about 6 GB of text; --dir selects where
+# it is written.
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def syntheticMatrix(path, n, s, na=0.02, seed=1, block=100000):
+    # CpGs 20bp apart on 22 chromosomes, about na of the cells are '.', '-' or empty
+    rng = np.random.default_rng(seed)
+    perchr = -(-n // 22)
+    tokens = np.array(['%.3f' % (i/1000) for i in range(1001)] + ['.', '-', ''], dtype=object)
+    with open(path, 'w') as f:
+        f.write('chr\tpos\t' + '\t'.join('%d_s%d' % (i % 2, i) for i in range(s)) + '\n')
+        for start in range(0, n, block):
+            rows = min(block, n-start)
+            codes = np.rint(1000*rng.beta(2, 5, size=(rows, s))).astype(int)
+            mask = rng.random((rows, s)) < na
+            codes[mask] = 1001 + rng.integers(0, 3, size=mask.sum())
+            f.write(''.join('chr%d\t%d\t' % (i // perchr + 1, 1000 + 20*(i % perchr)) + '\t'.join(r) + '\n'
+                            for i, r in zip(range(start, start+rows), tokens[codes].tolist())))
+
+
+def run(binary, path, cache, repeats):
+    best = None
+    for _ in range(repeats):
+        if os.path.exists(cache):
+            os.remove(cache)
+        t = time.time()
+        subprocess.run([binary, '-C', cache, path],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        el = time.time()-t
+        best = el if best is None else min(best, el)
+    return best
+
+
+def sameFile(a, b, chunk=1 << 24):
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            x, y = fa.read(chunk), fb.read(chunk)
+            if x != y:
+                return False
+            if not x:
+                return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=10000000, help='number of CpGs')
+    parser.add_argument('-s', type=int, default=100, help='number of samples')
+    parser.add_argument('-r', type=int, default=1, help='repeats, the best time is reported')
+    parser.add_argument('--dir', default=None, help='directory for the matrix and the caches')
+    parser.add_argument('--bin', default=os.path.join(ROOT, 'metilene'), help='metilene binary')
+    parser.add_argument('--ref', nargs='*', default=[], help='binaries to compare against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        path = os.path.join(tmp, 'matrix.tsv')
+        t = time.time()
+        syntheticMatrix(path, args.n, args.s)
+        size = os.path.getsize(path)
+        print('CpGs:', args.n, 'samples:', args.s, 'size: %.1f MB' % (size/1e6),
+              '(written in %.1fs)' % (time.time()-t))
+
+        base = None
+        for i, binary in enumerate([args.bin] + args.ref):
+            cache = os.path.join(tmp, 'cache%d.bin' % i)
+            try:
+                el = run(binary, path, cache, args.r)
+            except subprocess.CalledProcessError:
+                print('%s: failed on the matrix' % binary)
+                sys.exit(1)
+            print('%s: %.2fs, %.1f MB/s' % (binary, el, size/1e6/el))
+            if base is None:
+                base = cache
+            elif not sameFile(cache, base):
+                print('  cache differs from', args.bin)
+                sys.exit(1)
+            else:
+                os.remove(cache)
+        if args.ref:
+            print('caches agree')
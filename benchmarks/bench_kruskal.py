@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# Benchmark of the Kruskal-Wallis test in addANOVA: per-row scipy.stats.kruskal
+# vs. the batched kruskalRows, including a check that the p-values agree.
+#
+#   python benchmarks/bench_kruskal.py [-n 200000] [-s 100] [-g 4] [-t 4]
+import os
+import sys
+import time
+import argparse
+import warnings
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from metilene3 import kruskalRows
+
+
+def legacyKruskal(x, grprange):
+    from scipy.stats import kruskal
+    pval = []
+    for row in x:
+        try:
+            pval.append(kruskal(*[row[i[0]:i[1]] for i in grprange], nan_policy='omit')[1])
+        except ValueError:
+            pval.append(np.nan)
+    return np.array(pval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=200000, help='number of DMRs')
+    parser.add_argument('-s', type=int, default=100, help='number of samples')
+    parser.add_argument('-g', type=int, default=4, help='number of groups')
+    parser.add_argument('-t', type=int, default=4, help='threads')
+    parser.add_argument('--legacy-rows', type=int, default=20000, help='rows checked against scipy')
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore')
+
+    rng = np.random.default_rng(1)
+    x = np.round(rng.random((args.n, args.s)), 3)
+    x[rng.random(x.shape) < 0.1] = np.nan
+    bounds = np.linspace(0, args.s, args.g+1).astype(int)
+    grprange = [[bounds[i], bounds[i+1]] for i in range(args.g)]
+    print('DMRs:', args.n, 'samples:', args.s, 'groups:', args.g)
+
+    t = time.time()
+    new = kruskalRows(x, grprange, args.t)
+    print('batched (%d threads): %.2fs' % (args.t, time.time()-t))
+
+    k = min(args.n, args.legacy_rows)
+    t = time.time()
+    old = legacyKruskal(x[:k], grprange)
+    el = time.time()-t
+    print('scipy per row: %.2fs for %d rows (~%.2fs for all)' % (el, k, el*args.n/k))
+    assert np.array_equal(np.isnan(old), np.isnan(new[:k]))
+    assert np.allclose(old, new[:k], rtol=1e-9, atol=0, equal_nan=True)
+    print('p-values agree')
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Benchmark of the segment scoring in metilene (kstest, counter) on one dense
+# synthetic chunk with planted DMRs. Every binary given with --ref is timed
+# on the same input and its output is checked against the first binary, e.g.
+# a build of the previous commit:
+#
+#   git stash; make; cp metilene /tmp/metilene.old; git stash pop; make
+#   python benchmarks/bench_kstest.py [-n 4000] [-s 20] [-g 2] [-r 3] [--ref /tmp/metilene.old]
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def denseChunk(path, n, s, g, seed=1):
+    # one chunk: CpGs 20bp apart, well below the default -M 300
+    rng = np.random.default_rng(seed)
+    x = rng.beta(2, 5, size=(n, s))
+    groups = np.arange(s) % g
+    for start in range(100, n-40, 300):
+        x[start:start+40, groups == start % g] += 0.4
+    x = np.round(np.clip(x, 0, 1), 3)
+    with open(path, 'w') as f:
+        f.write('chr\tpos\t' + '\t'.join('%d_s%d' % (groups[i], i) for i in range(s)) + '\n')
+        for i in range(n):
+            f.write('chr1\t%d\t' % (1000 + 20*i) + '\t'.join('%.3f' % v for v in x[i]) + '\n')
+
+
+def run(binary, path, repeats):
+    best, out = None, None
+    for _ in range(repeats):
+        t = time.time()
+        out = subprocess.run([binary, '-l', '1', '-t', '1', '-H', path, path],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+        el = time.time()-t
+        best = el if best is None else min(best, el)
+    return best, out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=4000, help='CpGs in the chunk')
+    parser.add_argument('-s', type=int, default=20, help='number of samples')
+    parser.add_argument('-g', type=int, default=2, help='number of groups')
+    parser.add_argument('-r', type=int, default=3, help='repeats, the best time is reported')
+    parser.add_argument('--bin', default=os.path.join(ROOT, 'metilene'), help='metilene binary')
+    parser.add_argument('--ref', nargs='*', default=[], help='binaries to compare against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'chunk.tsv')
+        denseChunk(path, args.n, args.s, args.g)
+        print('CpGs:', args.n, 'samples:', args.s, 'groups:', args.g)
+
+        base = None
+        for binary in [args.bin] + args.ref:
+            el, out = run(binary, path, args.r)
+            rows = sum(1 for l in out.decode().splitlines() if not l.startswith('#'))
+            print('%s: %.2fs, %d rows' % (binary, el, rows))
+            if base is None:
+                base = out
+            elif out != base:
+                print('  output differs from', args.bin)
+                sys.exit(1)
+        if args.ref:
+            print('outputs agree')
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Benchmark of the sig.comparison/mean decoding in processOutput:
+# the previous row-wise apply implementation vs. decodeSigComparison.
+#
+#   python benchmarks/bench_processOutput.py [-n 1000000] [-s 50]
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from metilene3 import decodeSigComparison
+
+
+def legacyDecode(mout, names, label):
+    def rename_cls_pn(x):
+        x = x.replace('0','1').replace('4','3')
+        if x[0]=='p':
+            x = x.replace('1','x').replace('3','1').replace('x','3')
+        x = x[1:]
+        return x
+    mout['sig.comparison'] = ( (1*(mout['meandiff']>0)).map({1:"p", 0:"n"}) \
+                                     +mout['sig.comparison']).apply(rename_cls_pn)
+    
+    mout['#Hypo'] = mout['sig.comparison'].apply(lambda x:(len(x.split('1'))-1))
+    mout['#Int'] = mout['sig.comparison'].apply(lambda x:(len(x.split('2'))-1))
+    mout['#Hyper'] = mout['sig.comparison'].apply(lambda x:(len(x.split('3'))-1))
+    
+    def calmean(a,b,c):
+        a = a.split('|')
+        b = b.split('|')
+        s = 0
+        n = 0
+        for i in range(len(a)):
+            if b[i]==c:
+                s += float(a[i])
+                n += 1
+        try:
+            return s/n
+        except:
+            return None
+            
+    mout['meanHypo'] = mout.apply(lambda x:calmean(x['mean'],x['sig.comparison'],'1'), axis=1)
+    mout['meanInt'] = mout.apply(lambda x:calmean(x['mean'],x['sig.comparison'],'2'), axis=1)
+    mout['meanHyper'] = mout.apply(lambda x:calmean(x['mean'],x['sig.comparison'],'3'), axis=1)
+
+    def sigcom2(x, s):
+        return [i for i,j in enumerate(x.split('|')) if j==s]
+
+    mout['Hypo-'+label] = mout['sig.comparison'].apply(lambda x:sigcom2(x,'1')).apply(lambda x:','.join(sorted([names[i] for i in x])))
+    mout['Int-'+label] = mout['sig.comparison'].apply(lambda x:sigcom2(x,'2')).apply(lambda x:','.join(sorted([names[i] for i in x])))\
+                                                                                                .apply(lambda x:x if x!='' else '-')
+    mout['Hyper-'+label] = mout['sig.comparison'].apply(lambda x:sigcom2(x,'3')).apply(lambda x:','.join(sorted([names[i] for i in x])))
+    return mout
+
+
+def synthetic(n, k, seed=1):
+    # clustering output: per sample one of 0-4, a few hundred distinct patterns
+    rng = np.random.default_rng(seed)
+    npat = min(n, 500)
+    pat = rng.choice(5, size=(npat, k), p=[0.2, 0.1, 0.4, 0.1, 0.2])
+    sig = np.array(['|'.join(map(str, i)) for i in pat], dtype=object)[rng.integers(0, npat, n)]
+    means = rng.random((n, k))
+    mean = pd.DataFrame(means).map(lambda x:'%.3f' % x).agg('|'.join, axis=1) if n*k <= 2e6 else \
+        pd.Series(['|'.join(['%.3f' % j for j in i]) for i in means])
+    return pd.DataFrame({'chr':'chr1', 'start':np.arange(n)*1000, 'stop':np.arange(n)*1000+500,
+                         'meandiff':rng.uniform(-1, 1, n), 'mean':mean, 'sig.comparison':sig})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=1000000, help='number of DMRs')
+    parser.add_argument('-s', type=int, default=50, help='number of samples')
+    parser.add_argument('--skip-legacy', action='store_true', help='only time the vectorized path')
+    args = parser.parse_args()
+
+    mout = synthetic(args.n, args.s)
+    names = ['Sample'+str(i) for i in range(args.s)]
+    print('DMRs:', args.n, 'samples:', args.s)
+
+    t = time.time()
+    new = decodeSigComparison(mout.copy(), names, 'samples')
+    print('vectorized: %.2fs' % (time.time()-t))
+
+    if not args.skip_legacy:
+        t = time.time()
+        old = legacyDecode(mout.copy(), names, 'samples')
+        print('legacy:     %.2fs' % (time.time()-t))
+        pd.testing.assert_frame_equal(old.astype(str), new.astype(str))
+        print('identical output')
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Benchmark of the DMTree construction: the previous string-based recurSplit
+# vs. the integer-coded one, on synthetic cohorts with a planted group tree.
+#
+#   python benchmarks/bench_recurSplit.py [-s 100 1000 5000] [-p 5000] [--skip-legacy]
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from metilene3 import recurSplit
+
+
+def legacyRecurSplit(arr, ref=0, depth=0, nsep=0, minN=2, minSumDMRs=100, fulltree=False):
+    finalList = []
+    depthList = []
+    weightList = []
+    
+    def numVS(a):
+        return sorted([a.count('1'),a.count('2'),a.count('3')])[1]
+    
+    if ref == 0:
+        arr = arr.groupby('sig.comparison.bin').sum().sort_values(ascending=False)
+        ifSig = 0
+        for i in range(len(arr)):
+            newref = arr.index[0]
+            nsep = arr.iloc[0]
+            if arr.iloc[i] > minSumDMRs and numVS(arr.index[i]) >= minN:#0.5*nonsep:
+                newref = arr.index[i]
+                nsep = arr.iloc[i]
+                ifSig = 1
+                break
+        if ifSig:
+            finalList.append(newref)
+            depthList.append(depth)
+            weightList.append(nsep)
+        else:
+            return None
+    else:
+        arr = arr.groupby('sig.comparison.bin').sum().sort_values(ascending=False)
+        for i in arr.index:
+            newref = 0
+            if arr[i] < minSumDMRs:
+                return ([],[],[])
+            if numVS(i)<minN:
+                continue
+            newref = i
+            finalList.append(newref)
+            depthList.append(depth)
+            nsep = arr[i]
+            weightList.append(nsep)
+            break
+        if newref==0 and fulltree:
+            for i in arr.index:
+                newref = 0
+                if arr[i] < minSumDMRs:
+                    return ([],[],[])
+                if numVS(i)==0:
+                    continue
+                newref = i
+                finalList.append(newref)
+                depthList.append(depth)
+                nsep = arr[i]
+                weightList.append(nsep)
+                break
+
+    if newref == 0:
+        return (finalList, depthList, weightList)
+        
+    else:
+        def mask(x, y, v):
+            x = list(x)
+            for i in range(len(y)):
+                if y[i] != '|':
+                    if y[i] != v:
+                        x[i] = '0'
+            return ''.join(x)
+        masked = {}
+        for i in ['1','2','3']:
+            masked[i] = arr.copy()
+            masked[i].index = pd.Series(arr.index).apply(lambda x:mask(x, newref, i))
+            resRS = legacyRecurSplit(masked[i], mask(newref, newref, i), depth+1, nsep, minN, minSumDMRs, fulltree)
+            finalList += resRS[0]
+            depthList += resRS[1]
+            weightList+= resRS[2]
+            
+        return (finalList, depthList, weightList)
+
+
+def synthetic(nsamples, npatterns, ngroups=8, seed=1):
+    # DMRs separate the two sides of random splits of a planted group partition,
+    # with per-sample noise; weights are summed |meandiff| per pattern
+    rng = np.random.default_rng(seed)
+    grp = rng.integers(0, ngroups, nsamples)
+    pats = np.empty((npatterns, nsamples), dtype=np.int8)
+    for k in range(npatterns):
+        side = rng.integers(1, 4, ngroups)
+        side[side==2] = 1 if rng.random()<0.5 else 3
+        p = side[grp]
+        noise = rng.random(nsamples) < rng.uniform(0, 0.05)
+        p[noise] = 2
+        pats[k] = p
+    idx = ['|'.join(i) for i in pats.astype(str)]
+    w = pd.Series(rng.gamma(2, 20, npatterns), index=pd.Index(idx, name='sig.comparison.bin'))
+    return w.groupby('sig.comparison.bin').sum().sort_values(ascending=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', type=int, nargs='+', default=[100, 1000, 5000], help='numbers of samples')
+    parser.add_argument('-p', type=int, default=5000, help='number of distinct DMR patterns')
+    parser.add_argument('-m', type=float, default=100, help='minSumDMRs')
+    parser.add_argument('--skip-legacy', action='store_true', help='only time the integer-coded path')
+    args = parser.parse_args()
+
+    for ns in args.s:
+        ranked = synthetic(ns, args.p)
+        print('samples:', ns, 'patterns:', len(ranked))
+        for fulltree, minSum in [(False, args.m), (True, 0)]:
+            t = time.time()
+            new = recurSplit(ranked, minN=2, minSumDMRs=minSum, fulltree=fulltree)
+            print('  fulltree=%s integer-coded: %.2fs, %d nodes' % (fulltree, time.time()-t, len(new[0]) if new else 0))
+            if not args.skip_legacy:
+                t = time.time()
+                old = legacyRecurSplit(ranked, minN=2, minSumDMRs=minSum, fulltree=fulltree)
+                print('  fulltree=%s legacy:        %.2fs' % (fulltree, time.time()-t))
+                assert old == new, 'DMTree differs'
+    if not args.skip_legacy:
+        print('identical output')
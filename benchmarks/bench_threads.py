@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Benchmark of the thread pool of metilene on a synthetic two-group matrix
+# of many small chunks and a few dense islands of several thousand CpGs,
+# which dominate the run when they are segmented last. The output of every
+# binary with -t threads is checked to be byte-identical to -t 1 of the
+# first binary. --ref times other binaries, e.g. a build of the previous
+# commit:
+#
+#   git stash; make; cp metilene /tmp/metilene.old; git stash pop; make
+#   python benchmarks/bench_threads.py [-c 5000] [-i 4] [-t 4] [--ref /tmp/metilene.old]
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def syntheticMatrix(path, header, chunks, islands, s=20, seed=1):
+    # chunks of 10-200 CpGs 20bp apart and islands of 2000-6000 CpGs, 1kb
+    # apart; group 1 is shifted on a quarter of the chunks and in stretches
+    # of the islands
+    rng = np.random.default_rng(seed)
+    sizes = list(rng.integers(10, 200, size=chunks)) + list(rng.integers(2000, 6000, size=islands))
+    sizes = [sizes[i] for i in rng.permutation(len(sizes))]
+    names = ['%d_s%d' % (i*2//s, i) for i in range(s)]
+    with open(header, 'w') as f:
+        f.write('chr\tpos\t' + '\t'.join(names) + '\n')
+    with open(path, 'w') as f:
+        f.write('chr\tpos\t' + '\t'.join(names) + '\n')
+        pos = 1000
+        for n in sizes:
+            vals = rng.beta(2, 5, size=(n, s))
+            if n >= 2000:
+                for a in rng.integers(0, n-50, size=n//500):
+                    vals[a:a+rng.integers(10, 50), s//2:] += 0.4
+            elif rng.random() < 0.25:
+                vals[:, s//2:] += 0.4
+            vals = np.clip(vals, 0, 1)
+            f.write(''.join('chr1\t%d\t' % (pos+20*i) + '\t'.join('%.3f' % v for v in r) + '\n'
+                            for i, r in enumerate(vals)))
+            pos += 20*n + 1000
+
+
+def run(binary, path, header, threads, out):
+    t = time.time()
+    with open(out, 'w') as f:
+        subprocess.run([binary, '-n', '2', '-H', header, '-t', str(threads), path],
+                       stdout=f, stderr=subprocess.DEVNULL, check=True)
+    return time.time()-t
+
+
+def sameFile(a, b):
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        return fa.read() == fb.read()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', type=int, default=5000, help='number of small chunks')
+    parser.add_argument('-i', type=int, default=4, help='number of dense islands')
+    parser.add_argument('-t', type=int, default=4, help='threads')
+    parser.add_argument('--bin', default=os.path.join(ROOT, 'metilene'), help='metilene binary')
+    parser.add_argument('--ref', nargs='*', default=[], help='binaries to compare against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'matrix.tsv')
+        header = os.path.join(tmp, 'header.tsv')
+        syntheticMatrix(path, header, args.c, args.i)
+        base = os.path.join(tmp, 'base.out')
+        el = run(args.bin, path, header, 1, base)
+        print('%s -t 1: %.2fs' % (args.bin, el))
+
+        for i, binary in enumerate([args.bin] + args.ref):
+            out = os.path.join(tmp, 'out%d' % i)
+            el = run(binary, path, header, args.t, out)
+            print('%s -t %d: %.2fs' % (binary, args.t, el))
+            if not sameFile(out, base):
+                print('  output differs from', args.bin, '-t 1')
+                sys.exit(1)
+        print('outputs agree')
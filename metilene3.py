@@ -2,6 +2,11 @@
 import os
 import sys
 import time
+import gzip
+import subprocess
+import hashlib
+import pickle
+import shutil
 import argparse
 import numpy as np
 import pandas as pd
@@ -39,11 +44,15 @@ parser.add_argument('-w', "--minSumDMRs", type=int, default=100, help='(optional
 # optional
 parser.add_argument('-auto', "--automatic", type=lambda x: (str(x).lower() == 'true'), default=True, help='(optional) True or False, set the unsupervised mode parameters -D and -w automatically',)
 parser.add_argument('-plot', "--visualization", type=lambda x: (str(x).lower() == 'true'), default=False, help='(optional) True or False, plot PCA and heatmap based on DMR methylation',)
-parser.add_argument('-anno', "--annotation", help='(optional) hg19 or hg38, use ChIPseeker to annotate the DMRs',)
+parser.add_argument('-anno', "--annotation", help='(optional) a GTF or BED gene model to annotate the DMRs with (indexed once as <model>.m3anno), or hg19 or hg38 to use ChIPseeker in R',)
 parser.add_argument('-refs', "--refSeq", help='(optional) reference genome, for sequence annotation',)
-parser.add_argument('-gsea', "--genesets", help='(optional) geneset gmt file for GSEA',)
+parser.add_argument('-gsea', "--genesets", help='(optional) comma-separated gene set GMT files, tested offline, or Enrichr library names, queried online with gseapy',)
 parser.add_argument('-wsup', "--withSupervised", help='(optional) True or False, run supervised mode on clusters after unsupervised mode', type=lambda x: (str(x).lower() == 'true'), default=True)
-parser.add_argument('-pdrl', "--pandarallel", help='(optional) True or False, run Kruskal-Wallis-Test with pandarallel', type=lambda x: (str(x).lower() == 'true'), default=False)
+parser.add_argument('-mc', "--matrixCache", help='(optional) directory for a binary cache of the input matrix, the input is converted once and reused by all passes and later runs',)
+parser.add_argument('-sh', "--shards", type=int, default=1, help='(optional) run the segmentation as this many processes on groups of chromosomes of similar size, sharing --threads, and merge them with one multiple testing correction',)
+parser.add_argument('-cs', "--chrSeed", type=lambda x: (str(x).lower() == 'true'), default=False, help='(optional) True or False, seed the imputation of missing values per chromosome as --shards does, so that a single process gives the same result as shards',)
+parser.add_argument('-sc', "--stageCache", help='(optional) directory for the results of the pipeline stages, a rerun resumes from the first stage whose inputs or parameters changed',)
+parser.add_argument('-pdrl', "--pandarallel", help='(optional) deprecated and ignored, the Kruskal-Wallis-Test is vectorized and uses --threads', type=lambda x: (str(x).lower() == 'true'), default=False)
 parser.add_argument('--version', action='version', version=VERSION, help='Get the version of metilene3',)
 parser.add_argument('-test', "--test", help='(optional) True or False, run on the test dataset', type=lambda x: (str(x).lower() == 'true'), default=False)
 parser.add_argument('-udmr', "--unsupervisedDMRs", help='(optional) the metilene3 unsupervised DMRs',)
@@ -55,11 +64,12 @@ parser.add_argument('-n0', "--minN0", type=int, default=2, help=argparse.SUPPRES
 
 
 class CommentedDataFrame(pd.DataFrame):
-    _metadata = ["comments"]
+    _metadata = ["comments", "dmtree"]
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.comments = []
+        self.dmtree = None
 
     @property
     def _constructor(self):
@@ -103,7 +113,7 @@ def preprocess(args, headerfile, ifsup, grpinfo=None):
     #     return None
     
     if ifsup=='unsup':
-        cols = pd.read_table(args.input, nrows=0)
+        cols = readInputHeader(args.input)
         newcols = list(cols.columns)
         # print(newcols)
         for i in range(len(newcols))[2:]:
@@ -112,7 +122,7 @@ def preprocess(args, headerfile, ifsup, grpinfo=None):
         cols.to_csv(headerfile, sep='\t', index=False)
         
     else:
-        cols = pd.read_table(args.input, nrows=0)
+        cols = readInputHeader(args.input)
         newcols = list(cols.columns)
         
         grp = pd.read_table(grpinfo, index_col='ID')['Group'].astype(str)
@@ -142,69 +152,577 @@ def preprocess(args, headerfile, ifsup, grpinfo=None):
         cols.to_csv(headerfile, sep='\t', index=False)
 
 
-def runMetilene(args, headerfile, ifsup):
+def isCompressed(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(2) == b'\x1f\x8b'
+    except:
+        return False
+
+
+def openInput(path):
+    # plain, gzip or bgzip text, told apart by the magic bytes rather than the suffix
+    return gzip.open(path, 'rt') if isCompressed(path) else open(path)
+
+
+def readInputHeader(path, nrows=0):
+    with openInput(path) as f:
+        return pd.read_table(f, nrows=nrows)
+
+
+def decompressThreads(args, path):
+    # the engine decompresses bgzip input with -R threads
+    return ['-R', str(args.threads)] if isCompressed(path) else []
+
+
+def matrixCacheKey(path):
+    st = os.stat(path)
+    h = hashlib.sha1()
+    h.update((os.path.realpath(path)+'|'+str(st.st_size)+'|'+str(st.st_mtime_ns)).encode())
+    with open(path, 'rb') as f:
+        h.update(f.read(1<<20))
+        if st.st_size > 2<<20:
+            f.seek(st.st_size-(1<<20))
+            h.update(f.read(1<<20))
+    return h.hexdigest()[:16]
+
+
+def isMatrixCache(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(8) == b'M3MATv3\x00'
+    except:
+        return False
+
+
+def getMatrixCache(args):
+    if not args.matrixCache:
+        return args.input
+    try:
+        os.makedirs(args.matrixCache, exist_ok=True)
+    except:
+        print('Warning: cannot create the matrix cache directory '+args.matrixCache+', reading the text input.')
+        return args.input
+
+    cachePath = args.matrixCache+'/'+args.input.split('/')[-1]+'.'+matrixCacheKey(args.input)+'.m3bin'
+    if isMatrixCache(cachePath):
+        print(time.ctime(),": Using the cached input matrix "+cachePath)
+        return cachePath
+
+    print(time.ctime(),": Caching the input matrix...")
+    tmpPath = cachePath+'.'+str(os.getpid())+'.tmp'
+    ret = subprocess.run([os.path.realpath(__file__).replace('metilene3.py','metilene')]+\
+                         decompressThreads(args, args.input)+['-C', tmpPath, args.input]).returncode
+    if ret != 0 or not isMatrixCache(tmpPath):
+        print('Warning: caching the input matrix failed, reading the text input.')
+        if os.path.isfile(tmpPath):
+            os.remove(tmpPath)
+        return args.input
+    os.replace(tmpPath, cachePath)
+    return cachePath
+
+
+def fileDigest(path):
+    # content hash of a (small) file written by an earlier stage, None if it is missing
+    if not path or not os.path.isfile(path):
+        return None
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1<<24), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def stageDigest(h, x):
+    if isinstance(x, (pd.DataFrame, pd.Series)):
+        cols = list(x.columns) if isinstance(x, pd.DataFrame) else [x.name]
+        h.update(repr((type(x).__name__, x.shape, cols, getattr(x, 'comments', None))).encode())
+        h.update(pd.util.hash_pandas_object(x, index=True).values.tobytes())
+    elif isinstance(x, (list, tuple)):
+        h.update(b'[')
+        for i in x:
+            stageDigest(h, i)
+        h.update(b']')
+    else:
+        h.update((repr(x)+'|').encode())
+
+
+def outputSnapshot(args):
+    # size and mtime of the files in the output folder, apart from a stage cache inside it
+    skip = os.path.realpath(args.stageCache)+os.sep
+    snap = {}
+    for root, dirs, files in os.walk(args.output):
+        if (os.path.realpath(root)+os.sep).startswith(skip):
+            dirs[:] = []
+            continue
+        for i in files:
+            path = os.path.join(root, i)
+            st = os.stat(path)
+            snap[os.path.relpath(path, args.output)] = (st.st_size, st.st_mtime_ns)
+    return snap
+
+
+def runStage(args, name, deps, func, *fargs):
+    # func(*fargs), cached in args.stageCache under a hash of the stage name and deps
+    # (parameters, tables, file digests); a hit restores the files the stage wrote
+    # into the output folder and returns its result without running it
+    if not args.stageCache:
+        return func(*fargs)
+    h = hashlib.sha1()
+    stageDigest(h, [name, VERSION]+list(deps))
+    stagePath = args.stageCache+'/'+name+'.'+h.hexdigest()[:16]
+    if os.path.isfile(stagePath+'/result.pkl'):
+        print(time.ctime(),": Using the cached stage "+name+".")
+        for root, dirs, files in os.walk(stagePath+'/files'):
+            for i in files:
+                path = os.path.join(args.output, os.path.relpath(os.path.join(root, i), stagePath+'/files'))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                shutil.copyfile(os.path.join(root, i), path)
+        with open(stagePath+'/result.pkl', 'rb') as f:
+            return pickle.load(f)
+
+    before = outputSnapshot(args)
+    res = func(*fargs)
+    try:
+        tmpPath = stagePath+'.'+str(os.getpid())+'.tmp'
+        os.makedirs(tmpPath+'/files')
+        for i, st in outputSnapshot(args).items():
+            if before.get(i) != st:
+                os.makedirs(os.path.dirname(tmpPath+'/files/'+i), exist_ok=True)
+                shutil.copyfile(os.path.join(args.output, i), tmpPath+'/files/'+i)
+        with open(tmpPath+'/result.pkl', 'wb') as f:
+            pickle.dump(res, f)
+        os.replace(tmpPath, stagePath)
+    except Exception as e:
+        print('Warning: cannot cache the stage '+name+' ('+str(e)+').')
+        shutil.rmtree(tmpPath, ignore_errors=True)
+    return res
+
+
+def inputDigest(path):
+    return matrixCacheKey(path) if path else None
+
+
+def engineDigest():
+    st = os.stat(os.path.realpath(__file__).replace('metilene3.py','metilene'))
+    return (st.st_size, st.st_mtime_ns)
+
+
+def readMatrixCache(path):
+    # header: magic, nrows, nsamples, nchr, offsets of values, chrid, pos, names, scale and
+    # exceptions, nexceptions (see src/matcache.h); values are fixed point, see cacheRows
+    hdr = np.fromfile(path, dtype=np.uint64, count=11)
+    nrows, nsamples, nchr = int(hdr[1]), int(hdr[2]), int(hdr[3])
+    mm = np.memmap(path, mode='r')
+    names = bytes(mm[int(hdr[7]):]).split(b'\0')
+    return {'values':np.ndarray((nrows, nsamples), dtype=np.int32, buffer=mm, offset=int(hdr[4])),
+            'chrid':np.ndarray(nrows, dtype=np.int32, buffer=mm, offset=int(hdr[5])),
+            'pos':np.ndarray(nrows, dtype=np.int32, buffer=mm, offset=int(hdr[6])),
+            'scale':np.ndarray(nrows, dtype=np.int8, buffer=mm, offset=int(hdr[8])),
+            'exceptions':np.ndarray((int(hdr[10]), nsamples), dtype=np.float64, buffer=mm, offset=int(hdr[9])),
+            'samples':[i.decode() for i in names[:nsamples]],
+            'chrs':[i.decode() for i in names[nsamples:nsamples+nchr]]}
+
+
+def cacheRows(mc, rows):
+    # the values of the given rows as parsed from the text: q / 10^scale, NaN for
+    # missing, or the doubles of the rows kept as exceptions (scale -1)
+    q = np.asarray(mc['values'][rows])
+    scale = mc['scale'][rows]
+    vals = q / (10.0**np.maximum(scale, 0))[:, None]
+    vals[q==np.iinfo(np.int32).min] = np.nan
+    ex = np.flatnonzero(scale<0)
+    if len(ex)>0:
+        vals[ex] = mc['exceptions'][q[ex, 0]]
+    return vals
+
+
+def regionMeans(met, regions, outPath):
+    # mean methylation of every sample over the bed-style regions (chr, start, stop),
+    # CpGs with start < pos <= stop, named like the output of bedavg. Each chromosome
+    # gets prefix sums over the rows covered by its regions, so a region costs
+    # O(samples). The means agree with bedavg within 1e-6: both round to 6 decimals,
+    # but the prefix sums add in another order and can round a tie the other way.
+    # A text matrix is converted to a temporary cache first.
+    names = regions['chr'].astype(str)+':'+regions['start'].astype(str)+'-'+regions['stop'].astype(str)
+    tmpCache = None
+    if not isMatrixCache(met):
+        tmpCache = outPath+'.'+str(os.getpid())+'.m3bin'
+        ret = subprocess.run([os.path.realpath(__file__).replace('metilene3.py','metilene'), '-C', tmpCache, met]).returncode
+        if ret != 0 or not isMatrixCache(tmpCache):
+            print('ERROR: caching '+met+' for the DMR means failed.')
+            if os.path.isfile(tmpCache):
+                os.remove(tmpCache)
+            sys.exit(1)
+        met = tmpCache
+
+    mc = readMatrixCache(met)
+    chrid = mc['chrid']
+    runs = np.r_[0, np.flatnonzero(np.diff(chrid))+1, len(chrid)]
+    rchr = regions['chr'].astype(str).values
+    rstart = regions['start'].values.astype(np.int64)
+    rstop = regions['stop'].values.astype(np.int64)
+    sums = np.zeros((len(regions), len(mc['samples'])))
+    counts = np.zeros((len(regions), len(mc['samples'])))
+
+    for a, b in zip(runs[:-1], runs[1:]):
+        # rows [lo,hi) of each region; the first row of a run is skipped as in bedavg
+        rid = np.flatnonzero(rchr==mc['chrs'][chrid[a]])
+        if len(rid)==0 or b-a<2:
+            continue
+        pos = mc['pos'][a+1:b]
+        lo = a+1+np.searchsorted(pos, rstart[rid], side='right')
+        hi = a+1+np.searchsorted(pos, rstop[rid], side='right')
+        keep = hi>lo
+        rid, lo, hi = rid[keep], lo[keep], hi[keep]
+        if len(rid)==0:
+            continue
+        # prefix sums over the covered rows only: merge the row ranges and index into their union
+        order = np.argsort(lo, kind='stable')
+        slo, shi = lo[order], np.maximum.accumulate(hi[order])
+        newseg = np.r_[True, slo[1:]>=shi[:-1]]
+        seglo = slo[newseg]
+        seghi = shi[np.r_[np.flatnonzero(newseg)[1:]-1, len(slo)-1]]
+        seglen = seghi-seglo
+        rows = np.repeat(seglo-np.r_[0, np.cumsum(seglen)[:-1]], seglen)+np.arange(seglen.sum())
+        vals = cacheRows(mc, rows)
+        isna = np.isnan(vals)
+        vals[isna] = 0
+        cs = np.vstack([np.zeros((1, vals.shape[1])), np.cumsum(vals, axis=0)])
+        cc = np.vstack([np.zeros((1, vals.shape[1]), dtype=np.int64), np.cumsum(~isna, axis=0)])
+        clo = np.searchsorted(rows, lo)
+        chi = np.searchsorted(rows, hi-1)+1
+        sums[rid] = cs[chi]-cs[clo]
+        counts[rid] = cc[chi]-cc[clo]
+
+    samples = mc['samples']
+    del mc
+    if tmpCache:
+        os.remove(tmpCache)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.round(sums/counts, 6)
+    return pd.DataFrame(means, index=pd.Index(names.values, name='name'), columns=samples)
+
+
+def unsupThresholds(args):
+    if not args.automatic or args.unsupervisedDMRs:
+        return None
+    return sorted(set([args.minMethDiffHigh, 0.25]), reverse=True)
+
+
+def selectThreshold(args, threshold):
+    allPath = args.output+'/DMRs-unsupervised.all.tsv'
+    if not os.path.isfile(allPath):
+        return False
+    header = True
+    with open(allPath) as f, open(args.output+'/DMRs-unsupervised.tsv', 'w') as out:
+        for line in f:
+            if line.startswith('#test@'):
+                thr, n = line[6:].rstrip('\n').split(':')
+                if abs(float(thr)-threshold) < 1e-9:
+                    out.write('#test:'+n+'\n')
+            elif line.startswith('#'):
+                out.write(line)
+            elif header:
+                out.write(line.rstrip('\n').rsplit('\t', 1)[0]+'\n')
+                header = False
+            else:
+                row, thr = line.rstrip('\n').rsplit('\t', 1)
+                if abs(float(thr)-threshold) < 1e-9:
+                    out.write(row+'\n')
+    return True
+
+
+def streamMetilene(cmd, outPath, imputedPath=None, imputedHeader=None):
+    # run the engine and split its stdout as it arrives: comments and DMR rows go to
+    # outPath and into the returned table, '//Imputed:' rows to imputedPath
+    from io import StringIO
+    comments, rows = [], []
+    imputed = open(imputedPath, 'w') if imputedPath else None
+    if imputed and imputedHeader:
+        imputed.write(imputedHeader)
+    with open(outPath, 'w') as out:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, bufsize=1<<20)
+        for line in proc.stdout:
+            if line.startswith('//Imputed:'):
+                if imputed:
+                    imputed.write(line[10:])
+                continue
+            out.write(line)
+            if line.startswith('#') and not rows:
+                comments.append(line.rstrip('\n'))
+            else:
+                rows.append(line)
+        proc.stdout.close()
+        ret = proc.wait()
+    if imputed:
+        imputed.close()
+    if ret != 0:
+        print('ERROR: metilene exited with status '+str(ret)+'.')
+        sys.exit(ret if 0<ret<256 else 1)
+    if not rows:
+        return None
+    mout = CommentedDataFrame(pd.read_table(StringIO(''.join(rows))))
+    mout.comments = comments
+    return mout
+
+
+def textChromosomes(path):
+    # (chromosome, bytes) in input order, from the line starts found by bisection
+    # on the byte offsets; the rows of a chromosome are consecutive
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.readline()
+        pos = f.tell()
+
+        def chrAfter(x):
+            # chromosome of the first line starting at or after x, None at the end
+            f.seek(x-1)
+            f.readline()
+            line = f.readline()
+            return line.split(b'\t', 1)[0] if line else None
+
+        sizes = []
+        while pos < size:
+            c = chrAfter(pos)
+            lo, hi = pos, size
+            while hi-lo > 1:
+                mid = (lo+hi)//2
+                if chrAfter(mid) == c:
+                    lo = mid
+                else:
+                    hi = mid
+            f.seek(lo)
+            f.readline()
+            sizes.append((c.decode(), f.tell()-pos))
+            pos = f.tell()
+    return sizes
+
+
+def cacheChromosomes(path):
+    # (chromosome, rows) in input order
+    mc = readMatrixCache(path)
+    chrid = mc['chrid']
+    starts = np.r_[0, np.flatnonzero(np.diff(chrid))+1]
+    ends = np.r_[starts[1:], len(chrid)]
+    return [(mc['chrs'][chrid[a]], int(b-a)) for a, b in zip(starts, ends)]
+
+
+def shardGroups(args):
+    # the chromosomes of each shard: consecutive runs of about equal size, a
+    # chromosome goes to the shard that holds its middle
+    if isCompressed(args.matrix):
+        print('Warning: sharding needs a plain text input or a matrix cache (-mc), running one process.')
+        return None
+    sizes = cacheChromosomes(args.matrix) if isMatrixCache(args.matrix) else textChromosomes(args.matrix)
+    if len(set([i[0] for i in sizes])) < len(sizes):
+        print('Warning: the input is not sorted by chromosome, running one process.')
+        return None
+    total = max(1, sum([i[1] for i in sizes]))
+    groups, done = {}, 0
+    for c, n in sizes:
+        groups.setdefault(min(args.shards-1, int((done+n/2)*args.shards/total)), []).append(c)
+        done += n
+    return [groups[k] for k in sorted(groups)] if len(groups) > 1 else None
+
+
+def engineCommand(args, threads, opts):
+    return [os.path.realpath(__file__).replace('metilene3.py','metilene'), '-t', str(threads)] + \
+           decompressThreads(args, args.matrix) + opts + [args.matrix]
+
+
+def runEngine(args, opts, outPath, thresholds, imputedPath=None, imputedHeader=None):
+    # opts are the engine options apart from the threads and the input.
+    # With --shards every shard reads its chromosomes only (-L) and prints all tested
+    # segments at full precision (-E); the merge applies the correction over the summed
+    # test counts and the -d/-T filters, so the result equals the single run.
+    groups = shardGroups(args) if args.shards > 1 else None
+    if not groups:
+        return streamMetilene(engineCommand(args, args.threads, opts), outPath, imputedPath, imputedHeader)
+
+    print(time.ctime(),": Running "+str(len(groups))+" shards...")
+    threads = max(1, args.threads//len(groups))
+    procs = []
+    for k, g in enumerate(groups):
+        shardPath = outPath+'.shard'+str(k)
+        with open(shardPath, 'w') as out:
+            procs.append((subprocess.Popen(engineCommand(args, threads, ['-L', ','.join(g), '-E', '1']+opts),
+                                           stdout=out), shardPath))
+    ret = [proc.wait() for proc, _ in procs]
+    if any(ret):
+        for _, shardPath in procs:
+            os.remove(shardPath)
+        ret = [i for i in ret if i][0]
+        print('ERROR: metilene exited with status '+str(ret)+'.')
+        sys.exit(ret if 0<ret<256 else 1)
+
+    nonna, ntest, header, rows = 0, {}, None, []
+    imputed = open(imputedPath, 'w') if imputedPath else None
+    if imputed and imputedHeader:
+        imputed.write(imputedHeader)
+    for _, shardPath in procs:
+        with open(shardPath) as f:
+            for line in f:
+                if line.startswith('//Imputed:'):
+                    if imputed:
+                        imputed.write(line[10:])
+                elif line.startswith('#non-NA CpGs:'):
+                    nonna += int(line.split(':')[-1])
+                elif line.startswith('#test'):
+                    key, n = line.rstrip('\n').rsplit(':', 1)
+                    ntest[key] = ntest.get(key, 0)+int(n)
+                elif header is None and line.startswith('chr\t'):
+                    header = line
+                elif not line.startswith('chr\t'):
+                    rows.append(line)
+        os.remove(shardPath)
+    if imputed:
+        imputed.close()
+
+    from io import StringIO
+    table = pd.read_table(StringIO(header+''.join(rows)), dtype=str, keep_default_na=False)
+    tagged = 'threshold' in table.columns
+    lists = []
+    for thr in thresholds:
+        key = '#test@'+('%g' % thr) if tagged else '#test'
+        sel = table.loc[table['threshold']==('%g' % thr)] if tagged else table
+        p = sel['p'].astype(float).to_numpy()
+        meandiff = sel['meandiff'].astype(float).to_numpy()
+        # Bonferroni as in src/mtc.c, the engine default (-c 1) the pipeline runs with
+        sel = sel.assign(q=np.minimum(p*float(ntest.get(key, 0)), 1.0))
+        keep = (meandiff >= thr) | (meandiff <= -thr)
+        sel = sel.loc[keep]
+        lists.append(sel.assign(q=['%.5g' % i for i in sel['q']],
+                                meandiff=['%f' % i for i in meandiff[keep]],
+                                p=['%.5g' % i for i in p[keep]]))
+    merged = pd.concat(lists)
+
+    comments = ['#non-NA CpGs:'+str(nonna)] + [i+':'+str(ntest[i]) for i in ntest]
+    with open(outPath, 'w') as out:
+        out.write('\n'.join(comments)+'\n')
+        merged.to_csv(out, sep='\t', index=False)
+    if tagged or merged.shape[0] == 0:
+        return None
+    mout = CommentedDataFrame(pd.read_table(outPath, skiprows=len(comments)))
+    mout.comments = comments
+    return mout
+
+
+def testCount(comments):
+    # the number of tests from the '#test:' comment of the engine output
+    for c in comments:
+        if c.startswith('#test:'):
+            return int(c.split(':')[-1])
+    return None
+
+
+def chrSeed(args):
+    # shards (-sh) seed the imputation per chromosome, so a shard does not depend on the
+    # chromosomes of the others; --chrSeed does the same for a single process
+    return args.chrSeed or args.shards > 1
+
+
+def runMetilene(args, headerfile, ifsup, thresholds=None):
+    # returns the DMR table of the run, or None if it is left to the files
+    # (skipped runs, or several thresholds that selectThreshold splits up)
     if args.skipMetilene:
         return None
-    # print(os.path.realpath(__file__))
-    if ifsup=='unsup':
-        os.system(os.path.realpath(__file__).replace('metilene3.py','metilene')+\
-                    " -t "+str(args.threads)+\
-                    " -s "+str(args.seed)+\
-                    " -p "+str(args.verbose*1)+\
-                    
-                    " -M "+str(args.maxdist)+\
-                    " -m "+str(args.minCpGs)+\
-                    " -d "+str(args.minMethDiffHigh)+\
-                    " -v "+str(args.valley)+\
-                    
-                    " -r "+str(args.minDMR)+\
-                    " -w "+str(args.minMethDiffHigh)+\
-                    " -e "+str(args.clusteringRatio)+\
-                    " -q "+str(args.minMethDiffHigh)+\
-                    
-                    " -H "+headerfile+\
-                    " -l 1 "+args.input+" > "+\
-                    args.output+'/DMRs-unsupervised.tsv' )
+    cmd = ['-s', str(args.seed),
+           '-p', str(args.verbose*1)]
+    if chrSeed(args):
+        cmd += ['-Z', '1']
+    if ifsup=='unsup' and thresholds:
+        cmd += ['-M', str(args.maxdist),
+                '-m', str(args.minCpGs),
+                '-T', ','.join([str(i) for i in thresholds]),
+                '-v', str(args.valley),
+
+                '-r', str(args.minDMR),
+                '-e', str(args.clusteringRatio),
+
+                '-H', headerfile,
+                '-l', '1']
+        runEngine(args, cmd, args.output+'/DMRs-unsupervised.all.tsv', thresholds)
+        return None
+
+    elif ifsup=='unsup':
+        # a multi-threshold file of an earlier run does not belong to this one
+        if os.path.isfile(args.output+'/DMRs-unsupervised.all.tsv'):
+            os.remove(args.output+'/DMRs-unsupervised.all.tsv')
+        cmd += ['-M', str(args.maxdist),
+                '-m', str(args.minCpGs),
+                '-d', str(args.minMethDiffHigh),
+                '-v', str(args.valley),
+
+                '-r', str(args.minDMR),
+                '-w', str(args.minMethDiffHigh),
+                '-e', str(args.clusteringRatio),
+                '-q', str(args.minMethDiffHigh),
+
+                '-H', headerfile,
+                '-l', '1']
+        return runEngine(args, cmd, args.output+'/DMRs-unsupervised.tsv', [args.minMethDiffHigh])
 
     else:
-        os.system(os.path.realpath(__file__).replace('metilene3.py','metilene')+\
-                    " -t "+str(args.threads)+\
-                    " -s "+str(args.seed)+\
-                    " -p "+str(args.verbose*1)+\
-                    " -O "+str(args.outputImputed*1)+\
-                    
-                    " -M "+str(args.maxdist)+\
-                    " -m "+str(args.minCpGs)+\
-                    " -d "+str(args.minMethDiff)+\
-                    " -X "+str(args.minNonNA)+\
-                    " -v "+str(args.valley)+\
-                    
-                    " -r "+str(args.minDMR)+\
-                    " -w "+str(args.minMethDiff)+\
-                    " -e "+str(args.clusteringRatio)+\
-                    " -q "+str(args.minMethDiff)+\
-                    
-                    " -H "+headerfile+\
-                    " -l 1 "+args.input+" > "+\
-                    args.output+'/'+args.input.split('/')[-1]+'.aout' )
-                    
+        cmd += ['-O', str(args.outputImputed*1),
+
+                '-M', str(args.maxdist),
+                '-m', str(args.minCpGs),
+                '-d', str(args.minMethDiff),
+                '-X', str(args.minNonNA),
+                '-v', str(args.valley),
+
+                '-r', str(args.minDMR),
+                '-w', str(args.minMethDiff),
+                '-e', str(args.clusteringRatio),
+                '-q', str(args.minMethDiff),
+
+                '-H', headerfile,
+                '-l', '1']
+        imputedPath, imputedHeader = None, None
         if args.outputImputed:
-            os.system("grep -v \'//Imputed:\' "+\
-            args.output+'/'+args.input.split('/')[-1]+'.aout >' + \
-            args.output+'/DMRs.tsv')
-            
-            os.system("head -n1 "+args.input+" > "+\
-                        args.output+'/'+args.input.split('/')[-1]+'.imputed')
-                        
-            os.system("grep \'//Imputed:\' "+\
-            args.output+'/'+args.input.split('/')[-1]+r".aout|sed 's/\/\/Imputed://' >>" + \
-            args.output+'/'+args.input.split('/')[-1]+'.imputed')
-            
-            os.system("rm "+args.output+'/'+args.input.split('/')[-1]+'.aout')
-            
-        else:
-            os.system("mv "+ args.output+'/'+args.input.split('/')[-1]+'.aout ' + \
-            args.output+'/DMRs.tsv')
+            imputedPath = args.output+'/'+args.input.split('/')[-1]+'.imputed'
+            with openInput(args.input) as f:
+                imputedHeader = f.readline()
+        return runEngine(args, cmd, args.output+'/DMRs.tsv', [args.minMethDiff], imputedPath, imputedHeader)
+
+
+def engineStage(args, headerfile, ifsup, thresholds=None):
+    # the engine output depends on neither the number of threads nor the matrix cache
+    deps = [ifsup, engineDigest(), matrixCacheKey(args.input), fileDigest(headerfile), args.skipMetilene,
+            chrSeed(args), args.seed, args.maxdist, args.minCpGs, args.valley, args.minDMR, args.clusteringRatio]
+    if ifsup=='unsup':
+        deps += [args.minMethDiffHigh, thresholds]
+    else:
+        deps += [args.minMethDiff, args.minNonNA, args.outputImputed]
+    return runStage(args, 'metilene-'+ifsup, deps, runMetilene, args, headerfile, ifsup, thresholds)
+
+
+def outputStage(args, ifsup, dmrs=None):
+    # keyed on the engine output as written to the file, which equals dmrs
+    if ifsup=='unsup':
+        deps = [fileDigest(args.output+'/DMRs-unsupervised.tsv')]
+    else:
+        deps = [fileDigest(args.output+'/DMRs.tsv'), fileDigest(args.output+'/group-ID.tsv'),
+                fileDigest(args.groupinfo if args.groupinfo else args.output+'/clusters.tsv'), args.anova]
+    deps += [ifsup, matrixCacheKey(args.input), annotationDigest(args), inputDigest(args.refSeq)]
+    return runStage(args, 'processOutput-'+ifsup, deps, processOutput, args, ifsup, 'T', dmrs)
+
+
+def clusterStage(args, unmout):
+    deps = [unmout, [str(i) for i in readInputHeader(args.input).columns[2:]],
+            args.minN0, args.minNSamples, args.minSumDMRs, args.minMethDiffHigh]
+    finalCls, cls = runStage(args, 'clustering', deps, clustering, unmout, args)
+    if finalCls is not None and args.visualization:
+        runStage(args, 'plots', deps+[finalCls, cls], plotClusters, unmout, cls, finalCls, args)
+    return finalCls, cls
+
+
+def gseaStage(args, finalCls, mout, unmout=None):
+    genesets = [inputDigest(i) if os.path.isfile(i) else i for i in args.genesets.split(',')]
+    deps = [genesets, annotationDigest(args), args.minMethDiffHigh, bool(args.groupinfo),
+            fileDigest(args.output+'/group-ID.tsv'), finalCls, mout, unmout]
+    return runStage(args, 'gsea', deps, gsea, args, finalCls, mout, unmout)
 
 
 def chipseeker(mout, moutPath, anno):
@@ -237,26 +755,347 @@ def chipseeker(mout, moutPath, anno):
     return mout
 
 
-def addSeq(mout, refSeq):
-    from Bio import SeqIO
+# categories in the order of ChIPseeker's genomicAnnotationPriority, tssRegion=c(-3000, 1000)
+ANNOTATION_PRIORITY = [('Promoter','promoter'), ("5' UTR",'utr5'), ("3' UTR",'utr3'),
+                       ('Exon','exon'), ('Intron','intron'), ('Downstream','downstream')]
+ANNOTATION_INDEX = 'M3ANNOv1'
+
+
+def gtfAttribute(attrs, name):
+    return attrs.str.extract(name+' "([^"]*)"', expand=False)
+
+
+def readGTF(path):
+    # transcripts (from their exons), exons and UTRs of a GTF gene model, 1-based closed
+    gtf = pd.read_table(path, header=None, comment='#', names=['chr','source','feature','start','end',
+                        'score','strand','frame','attrs'], usecols=['chr','feature','start','end','strand','attrs'],
+                        dtype={'chr':str}, compression='gzip' if isCompressed(path) else None)
+    gtf = gtf.loc[gtf['feature'].isin(['exon','CDS','UTR','five_prime_utr','three_prime_utr'])]
+    gtf = gtf.assign(tid=gtfAttribute(gtf['attrs'], 'transcript_id'))
+    exons = gtf.loc[gtf['feature']=='exon']
+    tx = exons[['chr','strand','tid']].assign(gene=gtfAttribute(exons['attrs'], 'gene_id'),
+                                              symbol=gtfAttribute(exons['attrs'], 'gene_name'),
+                                              start=exons['start'], end=exons['end'])
+    tx = tx.groupby('tid', sort=False).agg({'chr':'first', 'strand':'first', 'gene':'first', 'symbol':'first',
+                                            'start':'min', 'end':'max'})
+    tx['gene'] = tx['gene'].str.split('.').str[0]
+
+    # GENCODE has one UTR feature, 5' or 3' by the side of the CDS it is on
+    utr = gtf.loc[gtf['feature'].isin(['UTR','five_prime_utr','three_prime_utr'])]
+    cds = gtf.loc[gtf['feature']=='CDS'].groupby('tid').agg({'start':'min', 'end':'max'})
+    five = np.where(utr['strand']=='-', utr['start'] > utr['tid'].map(cds['end']),
+                    utr['end'] < utr['tid'].map(cds['start']))
+    five = np.where(utr['feature']=='UTR', five, utr['feature']=='five_prime_utr')
+    return tx, exons, utr.loc[five], utr.loc[~five]
+
+
+def readBED(path, skip):
+    # BED6 or BED12 transcripts, name either gene or gene|symbol; BED12 blocks are the
+    # exons and the parts of them outside thickStart-thickEnd the UTRs
+    bed = pd.read_table(path, header=None, skiprows=skip, dtype={0:str},
+                        compression='gzip' if isCompressed(path) else None)
+    name = bed[3].astype(str).str.split('|')
+    tx = pd.DataFrame({'chr':bed[0], 'strand':bed[5], 'gene':name.str[0], 'symbol':name.str[-1],
+                       'start':bed[1].astype(np.int64)+1, 'end':bed[2].astype(np.int64)})
+    if bed.shape[1] < 12:
+        return tx, tx, tx.iloc[:0], tx.iloc[:0]
+
+    blocks = pd.DataFrame({'sizes':bed[10].astype(str).str.rstrip(',').str.split(','),
+                           'starts':bed[11].astype(str).str.rstrip(',').str.split(','),
+                           'chr':bed[0], 'strand':bed[5], 'tx':bed[1].astype(np.int64),
+                           'thickStart':bed[6].astype(np.int64), 'thickEnd':bed[7].astype(np.int64)})
+    blocks = blocks.explode(['sizes','starts'])
+    start = blocks['tx'].to_numpy()+blocks['starts'].astype(np.int64).to_numpy()
+    exons = blocks[['chr','strand']].assign(start=start+1, end=start+blocks['sizes'].astype(np.int64).to_numpy())
+    coding = (blocks['thickStart'] < blocks['thickEnd']).to_numpy()
+    left = exons.assign(end=np.minimum(exons['end'], blocks['thickStart'])).loc[coding]
+    right = exons.assign(start=np.maximum(exons['start'], blocks['thickEnd']+1)).loc[coding]
+    left, right = left.loc[left['start']<=left['end']], right.loc[right['start']<=right['end']]
+    minus = lambda x:x['strand']=='-'
+    return tx, exons, pd.concat([left.loc[~minus(left)], right.loc[minus(right)]]), \
+           pd.concat([right.loc[~minus(right)], left.loc[minus(left)]])
+
+
+def intervalIndex(chrs, start, end):
+    # per chromosome: starts in order and the running maximum of the ends, enough for
+    # "does [s, e] overlap any interval": the last interval starting <= e ends >= s
+    res = {}
+    df = pd.DataFrame({'chr':chrs, 'start':start, 'end':end}).sort_values(['chr','start'])
+    for c, i in df.groupby('chr', sort=False):
+        res[c] = (i['start'].to_numpy(np.int64), np.maximum.accumulate(i['end'].to_numpy(np.int64)))
+    return res
+
+
+def buildAnnotationIndex(tx, exons, utr5, utr3):
+    genes, gid = np.unique(tx['gene'].astype(str), return_inverse=True)
+    symbols = tx.groupby(gid)['symbol'].first().reindex(range(len(genes)))
+    minus = (tx['strand']=='-').to_numpy()
+    start, end = tx['start'].to_numpy(np.int64), tx['end'].to_numpy(np.int64)
+    tss = np.where(minus, end, start)
+    idx = {'ENSEMBL':genes.astype(object), 'SYMBOL':symbols.to_numpy(dtype=object),
+           'promoter':intervalIndex(tx['chr'], np.where(minus, tss-1000, tss-3000), np.where(minus, tss+3000, tss+1000)),
+           'utr5':intervalIndex(utr5['chr'], utr5['start'], utr5['end']),
+           'utr3':intervalIndex(utr3['chr'], utr3['start'], utr3['end']),
+           'exon':intervalIndex(exons['chr'], exons['start'], exons['end']),
+           'intron':intervalIndex(tx['chr'], start, end),
+           'downstream':intervalIndex(tx['chr'], np.where(minus, start-3000, end+1), np.where(minus, start-1, end+3000)),
+           'tss':{}}
+    df = pd.DataFrame({'chr':tx['chr'].to_numpy(), 'tss':tss, 'sign':np.where(minus, -1, 1), 'gene':gid})
+    for c, i in df.sort_values(['chr','tss']).groupby('chr', sort=False):
+        idx['tss'][c] = (i['tss'].to_numpy(np.int64), i['sign'].to_numpy(np.int8), i['gene'].to_numpy(np.int32))
+    return idx
+
+
+def loadAnnotationIndex(path):
+    # the index of a gene model is kept next to it as <model>.m3anno and rebuilt when the model changes
+    st = os.stat(path)
+    key = (ANNOTATION_INDEX, st.st_size, st.st_mtime_ns)
+    idxPath = path+'.m3anno'
+    try:
+        with open(idxPath, 'rb') as f:
+            idx = pickle.load(f)
+        if idx['key'] == key:
+            return idx
+    except:
+        pass
+
+    print(time.ctime(),": Indexing the gene model "+path+".")
+    # GTF has 9 columns, BED 6 or 12, both may start with comment, track or browser lines
+    skip = 0
+    with openInput(path) as f:
+        for line in f:
+            if not line.startswith(('#','track','browser')):
+                break
+            skip += 1
+    model = readGTF(path) if len(line.split('\t')) == 9 else readBED(path, skip)
+    idx = buildAnnotationIndex(*model)
+    idx['key'] = key
+    try:
+        with open(idxPath+'.'+str(os.getpid())+'.tmp', 'wb') as f:
+            pickle.dump(idx, f)
+        os.replace(idxPath+'.'+str(os.getpid())+'.tmp', idxPath)
+    except Exception as e:
+        print('Warning: cannot save the annotation index '+idxPath+' ('+str(e)+').')
+    return idx
+
+
+def overlapsAny(intervals, s, e):
+    starts, ends = intervals
+    k = np.searchsorted(starts, e, side='right')
+    return (k > 0) & (ends[np.maximum(k-1, 0)] >= s)
+
+
+def annotateDMRs(mout, idx):
+    # distanceToTSS, ENSEMBL and SYMBOL of the nearest TSS and the genomic category, as
+    # ChIPseeker's annotatePeak; DMRs on chromosomes missing from the model stay NA
+    s = mout['start'].to_numpy(np.int64)+1
+    e = mout['stop'].to_numpy(np.int64)
+    chrs = mout['chr'].astype(str).to_numpy()
+    dist = np.full(len(s), np.nan)
+    gene = np.full(len(s), -1)
+    anno = np.full(len(s), np.nan, dtype=object)
+    for c in np.unique(chrs):
+        if c not in idx['tss']:
+            continue
+        rows = np.flatnonzero(chrs==c)
+        rs, re = s[rows], e[rows]
+
+        tss, sign, gid = idx['tss'][c]
+        i = np.searchsorted(tss, rs, side='left')
+        j = np.searchsorted(tss, re, side='right')
+        dl = np.where(i > 0, rs-tss[np.maximum(i-1, 0)], np.inf)
+        dr = np.where(j < len(tss), re-tss[np.minimum(j, len(tss)-1)], -np.inf)
+        k = np.where(j > i, i, np.where(dl <= -dr, i-1, j))
+        d = np.where(j > i, 0, np.where(dl <= -dr, dl, dr))
+        dist[rows] = d*sign[k]
+        gene[rows] = gid[k]
+
+        res = np.full(len(rows), 'Distal Intergenic', dtype=object)
+        for label, name in ANNOTATION_PRIORITY[::-1]:
+            if c in idx[name]:
+                res[overlapsAny(idx[name][c], rs, re)] = label
+        anno[rows] = res
+
+    found = gene >= 0
+    mout['distanceToTSS'] = dist.astype(np.int64) if found.all() else dist
+    for i in ['ENSEMBL','SYMBOL']:
+        mout[i] = np.full(len(s), np.nan, dtype=object)
+        mout.loc[found, i] = idx[i][gene[found]]
+    mout['anno'] = anno
+    return mout
+
+
+def annotationDigest(args):
+    # a gene model is keyed on its content, hg19/hg38 on the name
+    if args.annotation and os.path.isfile(args.annotation):
+        return inputDigest(args.annotation)
+    return args.annotation
+
+
+def annotate(mout, moutPath, args):
+    if args.annotation and os.path.isfile(args.annotation):
+        mout = annotateDMRs(mout, loadAnnotationIndex(args.annotation))
+    elif args.annotation:
+        mout = chipseeker(mout, moutPath, args.annotation)
+    if args.refSeq:
+        mout = addSeq(mout, args.refSeq)
+    return mout
 
-    ref = {}
-    with open(refSeq) as handle:
-        for record in SeqIO.parse(handle, "fasta"):
-            ref[record.id] = record.seq
 
-    mout['seq'] = mout.apply(lambda x:str(ref[x['chr']][x['start']-1:x['stop']]), axis=1)
+def buildFai(refSeq):
+    # samtools faidx index (name, length, offset, bases and bytes per line) from the
+    # record boundaries alone: all lines of a sequence but the last are equally long
+    import mmap
+    fai = []
+    with open(refSeq, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = 0 if mm[:1] == b'>' else mm.find(b'\n>')
+        pos = pos+1 if pos > 0 else pos
+        while pos >= 0:
+            hend = mm.find(b'\n', pos)
+            if hend < 0:
+                hend = len(mm)
+            nxt = mm.find(b'\n>', hend)
+            end = len(mm) if nxt < 0 else nxt+1
+            name = mm[pos+1:hend].split()[0].decode()
+            offset = min(hend+1, len(mm))
+            seqEnd = end
+            while seqEnd > offset and mm[seqEnd-1] in b' \t\r\n':
+                seqEnd -= 1
+            lend = mm.find(b'\n', offset, seqEnd)
+            if lend < 0:
+                length = lineBases = seqEnd-offset
+                lineWidth = length+1+(mm[seqEnd:seqEnd+1] == b'\r')
+            else:
+                lineWidth = lend+1-offset
+                lineBases = lineWidth-1-(mm[lend-1:lend] == b'\r')
+                last = mm.rfind(b'\n', offset, seqEnd)+1
+                if (last-offset) % lineWidth:
+                    raise ValueError('lines of '+name+' in '+refSeq+' are not equally long')
+                length = (last-offset)//lineWidth*lineBases+seqEnd-last
+            fai.append((name, length, offset, lineBases, lineWidth))
+            pos = nxt+1 if nxt >= 0 else -1
+    return pd.DataFrame(fai, columns=['name','length','offset','lineBases','lineWidth']).set_index('name')
+
+
+def loadFai(refSeq):
+    # reuse <refSeq>.fai unless the FASTA is newer, otherwise build and save it
+    faiPath = refSeq+'.fai'
+    if os.path.isfile(faiPath) and os.stat(faiPath).st_mtime_ns >= os.stat(refSeq).st_mtime_ns:
+        return pd.read_table(faiPath, header=None, usecols=range(5), index_col=0, dtype={0:str},
+                             names=['name','length','offset','lineBases','lineWidth'])
+    print(time.ctime(),": Indexing the reference genome "+refSeq+".")
+    fai = buildFai(refSeq)
+    try:
+        fai.to_csv(faiPath, sep='\t', header=False)
+    except Exception as e:
+        print('Warning: cannot save the reference index '+faiPath+' ('+str(e)+').')
+    return fai
+
 
+def addSeq(mout, refSeq):
+    # reference bases [start-1, stop) of each DMR, read from the memory-mapped FASTA
+    # through its .fai index in coordinate order; NA on sequences missing from it
+    import mmap
+    fai = loadFai(refSeq)
+    fai = dict(zip(fai.index, fai[['length','offset','lineBases','lineWidth']].astype(int).itertuples(index=False)))
+    seqs = np.full(mout.shape[0], np.nan, dtype=object)
+    order = np.lexsort((mout['start'].to_numpy(), mout['chr'].astype(str).to_numpy()))
+    with open(refSeq, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i, c, start, stop in zip(order, mout['chr'].astype(str).to_numpy()[order],
+                                     mout['start'].to_numpy()[order], mout['stop'].to_numpy()[order]):
+            if c not in fai:
+                continue
+            length, offset, lineBases, lineWidth = fai[c]
+            a, b, _ = slice(int(start)-1, int(stop)).indices(length)
+            if a >= b:
+                seqs[i] = ''
+                continue
+            raw = mm[offset+a//lineBases*lineWidth+a%lineBases:offset+(b-1)//lineBases*lineWidth+(b-1)%lineBases+1]
+            seqs[i] = raw.replace(b'\n', b'').replace(b'\r', b'').decode()
+    mout['seq'] = seqs
     return mout
 
 
-def processOutput(args, ifsup, anno='F'):
+def parseSigComparison(sigcom, meandiff):
+    # sig.comparison codes 0-4 -> 1: hypo, 2: intermediate, 3: hyper, swapped for positive meandiff
+    sigcom = sigcom.astype(str)
+    n = len(sigcom)
+    lens = sigcom.str.len()
+    if n>0 and lens.nunique()==1 and (lens.iloc[0]%2==1):
+        raw = np.frombuffer(''.join(sigcom).encode(), dtype=np.uint8).reshape(n, lens.iloc[0])
+        sep = raw[:, 1::2]
+        raw = raw[:, ::2].astype(np.int16)-ord('0')
+        if (sep!=ord('|')).any() or (raw<0).any() or (raw>4).any():
+            raw = None
+    else:
+        raw = None
+    if raw is None:
+        rows = [i.split('|') for i in sigcom]
+        raw = np.full((n, max([len(i) for i in rows]+[0])), -1, dtype=np.int16)
+        for i, r in enumerate(rows):
+            raw[i, :len(r)] = [int(j) if j in ('0','1','2','3','4') else -1 for j in r]
+
+    states = np.array([0,1,1,2,3,3], dtype=np.int8)[raw+1]
+    pos = (meandiff>0).to_numpy()
+    states[pos] = np.where(states[pos]>0, 4-states[pos], 0)
+    patterns, inverse = np.unique(states, axis=0, return_inverse=True)
+    return states, patterns, inverse.reshape(-1)
+
+def parseMeans(means):
+    from io import StringIO
+    if len(means)==0:
+        return np.zeros((0, 0))
+    return pd.read_csv(StringIO('\n'.join(means.astype(str))), sep='|', header=None, \
+                       float_precision='round_trip').to_numpy(dtype=np.float64)
+
+def stateMeans(states, means):
+    # accumulate column by column to keep the summation order of the per-row loop
+    n = states.shape[0]
+    k = min(states.shape[1], means.shape[1])
+    rows = np.arange(n)
+    sums = np.zeros((n, 4))
+    counts = np.zeros((n, 4), dtype=np.int64)
+    for j in range(k):
+        sums[rows, states[:, j]] += means[:, j]
+        counts[rows, states[:, j]] += 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = sums/counts
+    return res[:, 1], res[:, 2], res[:, 3]
+
+def decodeSigComparison(mout, names, label):
+    states, patterns, inverse = parseSigComparison(mout['sig.comparison'], mout['meandiff'])
+    mout['sig.comparison'] = np.array(['|'.join(map(str, i[i>0])) for i in patterns], dtype=object)[inverse]
+    
+    mout['#Hypo'] = (states==1).sum(axis=1)
+    mout['#Int'] = (states==2).sum(axis=1)
+    mout['#Hyper'] = (states==3).sum(axis=1)
+    
+    means = parseMeans(mout['mean'])
+    mout['meanHypo'], mout['meanInt'], mout['meanHyper'] = stateMeans(states, means)
+
+    def patternNames(state, empty=''):
+        res = [','.join(sorted([names[j] for j in np.where(i==state)[0]])) or empty for i in patterns]
+        return np.array(res, dtype=object)[inverse]
+
+    mout['Hypo-'+label] = patternNames(1)
+    mout['Int-'+label] = patternNames(2, '-')
+    mout['Hyper-'+label] = patternNames(3)
+    return mout
+
+def processOutput(args, ifsup, anno='F', dmrs=None):
+    # dmrs: the table streamed from the engine by runMetilene, otherwise it is read from the file
     if ifsup=='unsup':
         moutPath = args.output + '/DMRs-unsupervised.tsv'
-        mout = commented_read_table(moutPath)
+        mout = commented_read_table(moutPath) if dmrs is None else dmrs
     else:
         moutPath = args.output + '/DMRs.tsv'
-        mout = commented_read_table(moutPath, skipcomments=True)
+        if dmrs is None:
+            ntest = int(pd.read_table(moutPath,nrows=0,skiprows=1).columns[0].split(':')[-1])
+            mout = commented_read_table(moutPath, skipcomments=True)
+        else:
+            ntest = testCount(dmrs.comments)
+            mout = dmrs
+            mout.comments = []
     
     mout = mout.loc[mout['sig.comparison']!='TBC'].sort_values(['chr','start','stop'])
     # if args.skipMetilene:
@@ -265,88 +1104,25 @@ def processOutput(args, ifsup, anno='F'):
         print("No DMR found!")
         return None
     
-    mout['meandiffabs'] = mout['meandiff'].apply(abs)
+    mout['meandiffabs'] = mout['meandiff'].abs()
 
-    def rename_cls_pn(x):
-        x = x.replace('0','1').replace('4','3')
-        if x[0]=='p':
-            x = x.replace('1','x').replace('3','1').replace('x','3')
-        x = x[1:]
-        return x
-    mout['sig.comparison'] = ( (1*(mout['meandiff']>0)).map({1:"p", 0:"n"}) \
-                                     +mout['sig.comparison']).apply(rename_cls_pn)
-    
-    mout['#Hypo'] = mout['sig.comparison'].apply(lambda x:(len(x.split('1'))-1))
-    mout['#Int'] = mout['sig.comparison'].apply(lambda x:(len(x.split('2'))-1))
-    mout['#Hyper'] = mout['sig.comparison'].apply(lambda x:(len(x.split('3'))-1))
-    
-    def calmean(a,b,c):
-        a = a.split('|')
-        b = b.split('|')
-        s = 0
-        n = 0
-        for i in range(len(a)):
-            if b[i]==c:
-                s += float(a[i])
-                n += 1
-        try:
-            return s/n
-        except:
-            return None
-            
-    mout['meanHypo'] = mout.apply(lambda x:calmean(x['mean'],x['sig.comparison'],'1'), axis=1)
-    mout['meanInt'] = mout.apply(lambda x:calmean(x['mean'],x['sig.comparison'],'2'), axis=1)
-    mout['meanHyper'] = mout.apply(lambda x:calmean(x['mean'],x['sig.comparison'],'3'), axis=1)
-
-    def sigcom2hypo(x):
-        y = []
-        for i,j in enumerate(x.split('|')):
-            if j=='1':
-                y.append(i)
-        return y
-
-    def sigcom2inter(x):
-        y = []
-        for i,j in enumerate(x.split('|')):
-            if j=='2':
-                y.append(i)
-        return y
-
-    def sigcom2hyper(x):
-        y = []
-        for i,j in enumerate(x.split('|')):
-            if j=='3':
-                y.append(i)
-        return y
-    
     if ifsup=='unsup':
-        sids = [str(i) for i in pd.read_table(args.input, nrows=0).columns[2:]]
-        mout['Hypo-samples'] = mout['sig.comparison'].apply(sigcom2hypo).apply(lambda x:','.join(sorted([str(sids[i]) for i in x])))
-        mout['Int-samples'] = mout['sig.comparison'].apply(sigcom2inter).apply(lambda x:','.join(sorted([str(sids[i]) for i in x])))\
-                                                                                                                            .apply(lambda x:x if x!='' else '-')
-        mout['Hyper-samples'] = mout['sig.comparison'].apply(sigcom2hyper).apply(lambda x:','.join(sorted([str(sids[i]) for i in x])))
+        sids = [str(i) for i in readInputHeader(args.input).columns[2:]]
+        mout = decodeSigComparison(mout, sids, 'samples')
 
     else:
         rename_cls = pd.read_table(args.output + '/group-ID.tsv', index_col='Group_ID')['Group'].astype(str).to_dict()
-
-        mout['Hypo-groups'] = mout['sig.comparison'].apply(sigcom2hypo).apply(lambda x:','.join(sorted([rename_cls[i] for i in x])))
-        mout['Int-groups'] = mout['sig.comparison'].apply(sigcom2inter).apply(lambda x:','.join(sorted([rename_cls[i] for i in x])))\
-                                                                                                                            .apply(lambda x:x if x!='' else '-')
-        mout['Hyper-groups'] = mout['sig.comparison'].apply(sigcom2hyper).apply(lambda x:','.join(sorted([rename_cls[i] for i in x])))
+        mout = decodeSigComparison(mout, rename_cls, 'groups')
         
-        ntest = int(pd.read_table(args.output+'/DMRs.tsv',nrows=0,skiprows=1).columns[0].split(':')[-1])
-        if args.groupinfo:
-            mout = addANOVA(mout, args.input, args.groupinfo, args.output+'/DMR-met.tsv', args.anova, ntest, args.threads, args.pandarallel)
-        else:
-            mout = addANOVA(mout, args.input, args.output+'/clusters.tsv', args.output+'/DMR-met.tsv', args.anova, ntest, args.threads, args.pandarallel)
+        grp = args.groupinfo if args.groupinfo else args.output+'/clusters.tsv'
+        mout = runStage(args, 'anova', [mout, matrixCacheKey(args.input), fileDigest(grp), args.anova, ntest],
+                        addANOVA, mout, args.matrix, grp, args.output+'/DMR-met.tsv', args.anova, ntest, args.threads)
         # mout = mout.loc[mout['p-kwt']<args.anova]
 
     # print('# of processed DMRs:',mout.shape[0])
-    if anno == 'T' and args.annotation:
-        mout = chipseeker(mout, moutPath, args.annotation)
-
-    if anno == 'T' and args.refSeq:
-        mout = addSeq(mout, args.refSeq)
+    if anno == 'T' and (args.annotation or args.refSeq):
+        mout = runStage(args, 'annotation', [mout, annotationDigest(args), inputDigest(args.refSeq)],
+                        annotate, mout, moutPath, args)
 
     mout = mout.rename(columns={'p':'p-ks','mwu':'p-mwu','q':'q-ks'})
     
@@ -363,26 +1139,65 @@ def processOutput(args, ifsup, anno='F'):
     return mout
 
 def adjust_BH(x, m):
-    rnkdf = pd.DataFrame(list(x.rank()),list(x)).sort_index(ascending=False)
-    rnkdf[1] = (rnkdf.index*m/rnkdf[0]).apply(lambda x:min(1,x))
-    newP = []
-    lastP = 1
-    for i in rnkdf[1]:
-        if i<lastP:
-            lastP = i
-        newP.append(lastP)
-    rnkdf[2] = newP
-    return x.map(rnkdf[2].to_dict())
+    # Benjamini-Hochberg step-up over m tests (m >= the number of p-values): sort,
+    # cumulative minimum from the largest p down, scatter back. Tied p-values all
+    # get the q of the last of them; NaN stays NaN
+    p = x.to_numpy(dtype=np.float64)
+    valid = np.flatnonzero(~np.isnan(p))
+    order = valid[np.argsort(p[valid])]
+    q = np.minimum(1, p[order]*m/np.arange(1, len(order)+1))
+    q = np.minimum.accumulate(q[::-1])[::-1]
+    res = np.full(len(p), np.nan)
+    res[order] = q
+    return pd.Series(res, index=x.index)
     
-def addANOVA(dmrs, met, grp, dmrmet_path, anova, ntest, nthreads, pandarallel):
+def kruskalBlock(x, starts):
+    # Kruskal-Wallis test (nan_policy='omit') on every row of x at once;
+    # groups are the contiguous column ranges beginning at starts
+    b, m = x.shape
+    valid = ~np.isnan(x)
+    order = np.argsort(np.where(valid, x, np.inf), axis=1, kind='stable')
+    s = np.take_along_axis(x, order, axis=1)
+    sv = np.take_along_axis(valid, order, axis=1).ravel()
+
+    # runs of tied values in each sorted row get their average rank
+    newrun = np.ones((b, m), dtype=bool)
+    newrun[:,1:] = s[:,1:] != s[:,:-1]
+    newrun = newrun.ravel()
+    rid = np.cumsum(newrun) - 1
+    t = np.bincount(rid, weights=sv)
+    first = np.tile(np.arange(m), b)[newrun]
+    rk = np.zeros((b, m))
+    np.put_along_axis(rk, order, np.where(sv, (first + (t+1)/2)[rid], 0).reshape(b, m), axis=1)
+
+    n = valid.sum(1).astype(np.float64)
+    nj = np.add.reduceat(valid, starts, axis=1)
+    ranksum = np.add.reduceat(rk, starts, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ties = 1 - np.bincount(np.repeat(np.arange(b), m)[newrun], weights=t**3-t, minlength=b)/(n**3-n)
+        h = 12/(n*(n+1))*(ranksum**2/nj).sum(1) - 3*(n+1)
+        h = h/ties
+    # scipy gives NaN for empty groups; identical values make it raise
+    h[(nj==0).any(1) | ~(ties>0)] = np.nan
+
+    from scipy.stats import chi2
+    return chi2.sf(h, len(starts)-1)
+
+def kruskalRows(x, grprange, nthreads, blocksize=8192):
+    # blocks are views of one array, so the threads share it without copies
+    from concurrent.futures import ThreadPoolExecutor
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    starts = np.array([i[0] for i in grprange])
+    if len(x)==0:
+        return np.zeros(0)
+    blocks = [x[i:i+blocksize] for i in range(0, len(x), blocksize)]
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as ex:
+        return np.concatenate(list(ex.map(lambda b:kruskalBlock(b, starts), blocks)))
+
+def addANOVA(dmrs, met, grp, dmrmet_path, anova, ntest, nthreads):
     dmrs['dmrid'] = dmrs['chr'].astype(str)+':'+dmrs['start'].astype(str)+'-'+dmrs['stop'].astype(str)
 
-    dmrs[['chr','start','stop']].to_csv(dmrmet_path+'.bed', sep='\t', header=False, index=False)
-    os.system(os.path.realpath(__file__).replace('metilene3.py','bedavg')+' '+met+' '+dmrmet_path+'.bed  '+dmrmet_path)
-    os.remove(dmrmet_path+".bed")
-    
-    from scipy.stats import kruskal
-    dmrmet = pd.read_table(dmrmet_path, index_col=0)
+    dmrmet = regionMeans(met, dmrs, dmrmet_path)
     grp = pd.read_table(grp, index_col=None).sort_values(['Group','ID'])
     grp.index = range(len(grp.index))
     grprange = []
@@ -392,14 +1207,7 @@ def addANOVA(dmrs, met, grp, dmrmet_path, anova, ntest, nthreads, pandarallel):
         begin = grp[grp['Group']==i].index[-1]+1
 
     dmrmet = dmrmet[grp['ID']]
-    def grpseg(x,y):
-        return [x[i[0]:i[1]] for i in y]
-    if pandarallel:
-        from pandarallel import pandarallel
-        pandarallel.initialize(progress_bar=True, nb_workers=nthreads)
-        pval = dmrmet.parallel_apply(lambda x:kruskal(*grpseg(x,grprange),nan_policy='omit')[1], axis=1).T
-    else:
-        pval = dmrmet.apply(lambda x:kruskal(*grpseg(x,grprange),nan_policy='omit')[1], axis=1).T
+    pval = pd.Series(kruskalRows(dmrmet.to_numpy(dtype=np.float64), grprange, nthreads), index=dmrmet.index)
 
     dmrs['p-kwt'] = dmrs['dmrid'].map(pval)
     dmrs['fdr-kwt'] = adjust_BH(dmrs['p-kwt'], ntest)
@@ -412,6 +1220,37 @@ def addANOVA(dmrs, met, grp, dmrmet_path, anova, ntest, nthreads, pandarallel):
     dmrmet.to_csv(dmrmet_path, sep='\t')
     return dmrs.drop(columns=['dmrid'])
     
+def patternBits(patterns, width, variant='raw'):
+    # one packed bitset per state 1-3 of the '|'-joined state patterns; the
+    # variants mirror the binarization of DMR states against one-sided nodes
+    states = np.full((len(patterns), width), -1, dtype=np.int8)
+    for n, i in enumerate(patterns):
+        row = [int(j) if j in ('0','1','2','3') else -1 for j in i.split('|')]
+        states[n, :len(row)] = row
+    if variant=='1to2':
+        states[states==1] = 2
+    elif variant=='3to2':
+        states[states==3] = 2
+    return [np.packbits(states==k, axis=1) for k in (1,2,3)]
+
+def matchDMTree(patterns, nodes, variants):
+    # patterns x nodes: every non-0 state of the node is found in the pattern
+    members = np.zeros((len(patterns), len(nodes)), dtype=bool)
+    width = max([len(i.split('|')) for i in patterns+nodes], default=0)
+    bits = {}
+    for k, (node, variant) in enumerate(zip(nodes, variants)):
+        care = [j for j in node.split('|') if j!='0']
+        # a node state other than a single 1/2/3 never matches
+        if len(patterns)==0 or len(care)==0 or any(j not in ('1','2','3') for j in care):
+            continue
+        if variant not in bits:
+            bits[variant] = patternBits(patterns, width, variant)
+        ok = np.ones(len(patterns), dtype=bool)
+        for b, n in zip(bits[variant], patternBits([node], width)):
+            ok &= ((b & n)==n).all(axis=1)
+        members[:,k] = ok
+    return members
+
 def addDMTree2DMR(args, ifsup, cls, finalCls):
 
     if ifsup=='unsup':
@@ -435,7 +1274,9 @@ def addDMTree2DMR(args, ifsup, cls, finalCls):
             elif x.count('3')<=x.count('1'):
                 x = x.replace('3','2')
             return x
-        mout['sig.comparison.bin'] = mout['sig.comparison'].apply(rename_cls_pn2)
+        codes, patterns = pd.factorize(mout['sig.comparison'].astype(str))
+        patterns = [rename_cls_pn2(i) for i in patterns]
+        mout['sig.comparison.bin'] = np.array(patterns, dtype=object)[codes]
 
         cls_id = {}
         for i in cls[0]:
@@ -448,25 +1289,12 @@ def addDMTree2DMR(args, ifsup, cls, finalCls):
             finalCls[cls_id[i]] = finalCls[i]
         finalCls.drop(columns=cls[0]).to_csv(args.output + '/clusters.tsv', sep='\t')
 
-        def findDMTreeID(a, b, c, d):
-            a = a.split('|')
-            b = b.split('|')
-            num = 0
-            all = 0
-            for i in range(len(a)):
-                if a[i] != '0':
-                    if a[i] != b[i]:
-                        num += 1
-                    all += 1
-            if num == 0 and all > 0:
-                return d+c
-            else:
-                return ''
-            
-        mout['DMTree'] = ''
+        # a node matches a DMR if every non-0 state of the node is found in the DMR
+        nodes = []
         for i in cls[0]:
-            mout['DMTree'] += mout['sig.comparison.bin'].apply(lambda x:findDMTreeID(i,x,cls_id[i]+',','P'))
-            mout['DMTree'] += mout['sig.comparison.bin'].apply(lambda x:findDMTreeID(rev123(i),x,cls_id[i]+',','N'))
+            nodes.append(('P', cls_id[i], i, 'raw'))
+            nodes.append(('N', cls_id[i], rev123(i), 'raw'))
+        codes, patterns = pd.factorize(mout['sig.comparison.bin'])
 
     else:
         cls_id = {}
@@ -477,31 +1305,36 @@ def addDMTree2DMR(args, ifsup, cls, finalCls):
                 tmp[j] = (tmp[j]>0).map({True:str(j),False:''})
             cls_id[i] = '|'.join(list(tmp.T.sum().sort_index()))
 
-        def findDMTreeIDsup(a, b, c, d):
+        # nodes with only hypo (hyper) groups are compared with hyper (hypo) DMR states set to 2
+        def binVariant(a):
             a = a.split('|')
             if ('1' in a) and ('3' in a):
-                b = b.split('|')
+                return 'raw'
+            elif '3' in a:
+                return '1to2'
             else:
-                if '3' in a:
-                    b = b.replace('1','2').split('|')
-                else:
-                    b = b.replace('3','2').split('|')
-            num = 0
-            all = 0
-            for i in range(len(a)):
-                if a[i] != '0':
-                    if a[i] != b[i]:
-                        num += 1
-                    all += 1
-            if num == 0 and all > 0:
-                return d+c
-            else:
-                return ''
-            
-        mout['DMTree'] = ''
+                return '3to2'
+
+        nodes = []
         for i in cls[0]:
-            mout['DMTree'] += mout['sig.comparison'].apply(lambda x:findDMTreeIDsup(cls_id[i],x,cls_id[i]+',','P'))
-            mout['DMTree'] += mout['sig.comparison'].apply(lambda x:findDMTreeIDsup(rev123(cls_id[i]),x,cls_id[i]+',','N'))
+            nodes.append(('P', cls_id[i], cls_id[i], binVariant(cls_id[i])))
+            nodes.append(('N', cls_id[i], rev123(cls_id[i]), binVariant(rev123(cls_id[i]))))
+        codes, patterns = pd.factorize(mout['sig.comparison'].astype(str))
+
+    members = matchDMTree(list(patterns), [i[2] for i in nodes], [i[3] for i in nodes])
+    labels = np.array([i[0]+i[1]+',' for i in nodes], dtype=object)
+    dmtree = np.full(len(patterns), '', dtype=object)
+    for k in range(len(nodes)):
+        dmtree = dmtree + np.where(members[:,k], labels[k], '')
+    mout['DMTree'] = dmtree[codes] if len(codes) else ''
+
+    # DMR x node membership, nodes sharing an ID are merged
+    from scipy import sparse
+    keys = list(dict.fromkeys(labels))
+    merge = np.zeros((len(nodes), len(keys)), dtype=bool)
+    merge[range(len(nodes)), [keys.index(i) for i in labels]] = True
+    members = sparse.csr_matrix((members.astype(np.int32) @ merge.astype(np.int32))>0)
+    mout.dmtree = (mout.index, {j[:-1]:k for k,j in enumerate(keys)}, members[codes])
 
     mout[mout.columns[~mout.columns.str.contains('sig.comparison.bin')]].to_tsv(moutPath, index=False, sep='\t')
     
@@ -512,83 +1345,109 @@ def addDMTree2DMR(args, ifsup, cls, finalCls):
 ###################################################################################################
 # DMR-Freq-based Clustering
 ###################################################################################################
+def patternMatrix(patterns):
+    # '|'-joined single-digit states -> int8 matrix; rows sort like the strings
+    patterns = pd.Series(patterns, dtype=object).astype(str)
+    n = len(patterns)
+    lens = patterns.str.len()
+    if n>0 and lens.nunique()==1 and (lens.iloc[0]%2==1):
+        raw = np.frombuffer(''.join(patterns).encode(), dtype=np.uint8).reshape(n, lens.iloc[0])
+        if (raw[:, 1::2]==ord('|')).all() and (raw[:, ::2]>=ord('0')).all() and (raw[:, ::2]<=ord('9')).all():
+            return (raw[:, ::2]-ord('0')).astype(np.int8)
+    print('ERROR: DMTree patterns must be equally long and consist of single-digit states.')
+    sys.exit(1)
+
 def recurSplit(arr, ref=0, depth=0, nsep=0, minN=2, minSumDMRs=100, fulltree=False):
-    finalList = []
-    depthList = []
-    weightList = []
-    
-    def numVS(a):
-        return sorted([a.count('1'),a.count('2'),a.count('3')])[1]
-    
-    if ref == 0:
-        arr = arr.groupby('sig.comparison.bin').sum().sort_values(ascending=False)
-        ifSig = 0
-        for i in range(len(arr)):
-            newref = arr.index[0]
-            nsep = arr.iloc[0]
-            if arr.iloc[i] > minSumDMRs and numVS(arr.index[i]) >= minN:#0.5*nonsep:
-                newref = arr.index[i]
-                nsep = arr.iloc[i]
-                ifSig = 1
-                break
-        if ifSig:
-            finalList.append(newref)
-            depthList.append(depth)
-            weightList.append(nsep)
-        else:
-            return None
-    else:
-        arr = arr.groupby('sig.comparison.bin').sum().sort_values(ascending=False)
-        for i in arr.index:
-            newref = 0
-            if arr[i] < minSumDMRs:
-                return ([],[],[])
-            if numVS(i)<minN:
-                continue
-            newref = i
-            finalList.append(newref)
-            depthList.append(depth)
-            nsep = arr[i]
-            weightList.append(nsep)
-            break
-        # print(newref,fulltree)
-        if newref==0 and fulltree:
-            # print('FT')
-            for i in arr.index:
-                newref = 0
-                if arr[i] < minSumDMRs:
-                    return ([],[],[])
-                if numVS(i)==0:
-                    continue
-                newref = i
-                finalList.append(newref)
-                depthList.append(depth)
-                nsep = arr[i]
-                weightList.append(nsep)
-                break
-            # print(newref)
+    # arr: summed weights indexed by sig.comparison.bin; returns (finalList, depthList, weightList)
+    # of the DMTree nodes in depth-first order, or None if there is no root split
+    if len(arr)==0:
+        return None if ref==0 else ([],[],[])
+    pat = patternMatrix(arr.index)
+    # states are packed 2 (or 4) bits each, first state in the high bits, so that
+    # the packed rows sort like the pattern strings
+    bits = 2 if pat.max(initial=0)<=3 else 4
+    per = 8//bits
+    nstates = pat.shape[1]
+    def pack(x):
+        x = np.pad(x.astype(np.uint8), ((0,0), (0, -x.shape[1]%per))).reshape(x.shape[0], -1, per)
+        packed = np.zeros(x.shape[:2], dtype=np.uint8)
+        for j in range(per):
+            packed |= x[:,:,j] << (bits*(per-1-j))
+        return packed
+    def unpack(x):
+        return np.stack([(x>>(bits*(per-1-j)))&(2**bits-1) for j in range(per)], axis=-1).reshape(x.shape[0], -1)[:, :nstates]
+    # number of 1, 2 and 3 states in each byte value
+    lut = unpack(np.arange(256, dtype=np.uint8).reshape(-1, 1))
+    lut = np.stack([(lut==k).sum(1) for k in (1,2,3)], axis=1).astype(np.int32)
+    code = {'pack':pack, 'unpack':unpack, 'lut':lut, 'full':2**bits-1, 'width':-(-nstates//per), 'memo':{}}
+
+    packed = pack(pat)
+    res = splitPatterns(packed, np.arange(packed.shape[1]), arr.to_numpy(dtype=np.float64), ref==0,
+                        minN, minSumDMRs, fulltree, code)
+    if res is None:
+        return None
+    return ([i[0] for i in res], [i[1]+depth for i in res], [i[2] for i in res])
+
+def splitPatterns(pat, cols, weight, root, minN, minSumDMRs, fulltree, code):
+    # one DMTree node on the packed patterns, of which only the bytes cols are
+    # left (all others are masked to 0); identical patterns are merged and the
+    # subtrees of identical (pattern, weight) tables are computed only once
+    key = np.ascontiguousarray(pat).view('S'+str(pat.shape[1])).reshape(-1) if pat.shape[1] else np.zeros(len(pat))
+    _, first, inv = np.unique(key, return_index=True, return_inverse=True)
+    # same Kahan summation and sort as groupby(...).sum().sort_values(ascending=False) on the strings
+    arr = pd.Series(weight).groupby(inv.reshape(-1)).sum().sort_values(ascending=False)
+    pat = pat[first[arr.index.to_numpy()]]
+    weight = arr.to_numpy()
+
+    memo = code['memo']
+    key = hashlib.sha1(pat.tobytes()+cols.tobytes()+weight.tobytes()+bytes([root])).digest()
+    if key in memo:
+        return memo[key]
+
+    # the node is the first pattern (by weight) that passes cond; numVS, the median
+    # of the numbers of 1, 2 and 3 states, is computed for growing blocks only as needed
+    numVS = np.zeros(len(pat), dtype=np.int32)
+    done = [0]
+    def firstHit(cond):
+        i, block = 0, 256
+        while i < len(pat):
+            j = min(len(pat), i+block)
+            if j > done[0]:
+                numVS[done[0]:j] = np.sort(code['lut'][pat[done[0]:j]].sum(axis=1), axis=1)[:,1]
+                done[0] = j
+            hit = np.flatnonzero(cond(numVS[i:j], weight[i:j]))
+            if len(hit)>0:
+                return i+hit[0]
+            i, block = j, block*4
+        return None
 
-    if newref == 0:
-        return (finalList, depthList, weightList)
-        
+    if root:
+        newref = firstHit(lambda n, w:(w>minSumDMRs)&(n>=minN))
+        if newref is None:
+            memo[key] = None
+            return None
     else:
-        def mask(x, y, v):
-            x = list(x)
-            for i in range(len(y)):
-                if y[i] != '|':
-                    if y[i] != v:
-                        x[i] = '0'
-            return ''.join(x)
-        masked = {}
-        for i in ['1','2','3']:
-            masked[i] = arr.copy()
-            masked[i].index = pd.Series(arr.index).apply(lambda x:mask(x, newref, i))
-            resRS = recurSplit(masked[i], mask(newref, newref, i), depth+1, nsep, minN, minSumDMRs, fulltree)
-            finalList += resRS[0]
-            depthList += resRS[1]
-            weightList+= resRS[2]
-            
-        return (finalList, depthList, weightList)
+        # ... unless a pattern below minSumDMRs comes first
+        newref = firstHit(lambda n, w:(n>=minN)|(w<minSumDMRs))
+        if newref is None and fulltree:
+            newref = firstHit(lambda n, w:(n!=0)|(w<minSumDMRs))
+        if newref is None or weight[newref]<minSumDMRs:
+            memo[key] = []
+            return []
+
+    ref = np.zeros((1, code['width']), dtype=np.uint8)
+    ref[0, cols] = pat[newref]
+    ref = code['unpack'](ref)
+    res = [('|'.join(ref[0].astype(str)), 0, weight[newref])]
+    for v in (1,2,3):
+        # keep the states where the node is v, zero all others and drop empty bytes
+        mask = code['pack'](np.where(ref==v, code['full'], 0))[0, cols]
+        keep = mask!=0
+        sub = splitPatterns(pat[:, keep] & mask[keep], cols[keep], weight, False,
+                            minN, minSumDMRs, fulltree, code)
+        res += [(i[0], i[1]+1, i[2]) for i in sub]
+    memo[key] = res
+    return res
 
     
 def plotDMTree(cls, finalCls, reportPath, sids, cmap):
@@ -793,24 +1652,27 @@ def plotClustermap(mout, cls, reportPath, sids, finalCls, cls_full):
     return cmap
 
 
-def clustering(mout, args):
-    minN0 = args.minN0
-    minN = args.minNSamples
-    minSumDMRs = args.minSumDMRs
-    mindiff_unsup = args.minMethDiffHigh
-
+def rankPatterns(mout, args):
+    # the DMRs used for clustering and the sum of |meandiff| of each binarized pattern
     def rename_cls_pn2(x):
         if x.count('3')>x.count('1'):
             x = x.replace('1','2')
         elif x.count('3')<=x.count('1'):
             x = x.replace('3','2')
         return x
-    mout = mout.loc[(mout['#Hypo']>=minN0)\
-                    &(mout['#Hyper']>=minN0)\
-                    &(mout['meandiffabs']>mindiff_unsup)]
+    mout = mout.loc[(mout['#Hypo']>=args.minN0)\
+                    &(mout['#Hyper']>=args.minN0)\
+                    &(mout['meandiffabs']>args.minMethDiffHigh)]
     mout['sig.comparison.bin'] = mout['sig.comparison'].apply(rename_cls_pn2)
     ranked = mout[['sig.comparison.bin','meandiffabs']].groupby('sig.comparison.bin').\
         sum()['meandiffabs'].sort_values(ascending=False)
+    return mout, ranked
+
+def clustering(mout, args):
+    minN = args.minNSamples
+    minSumDMRs = args.minSumDMRs
+
+    mout, ranked = rankPatterns(mout, args)
     # print(ranked)
     cls = recurSplit(ranked.sort_values(ascending = False), minN=minN, minSumDMRs=minSumDMRs)
     # print(cls, minN, minSumDMRs)
@@ -818,7 +1680,7 @@ def clustering(mout, args):
         return (None, None)
 
     reportPath = args.output+'/'
-    sids = [str(i) for i in pd.read_table(args.input, nrows=0).columns[2:]]
+    sids = [str(i) for i in readInputHeader(args.input).columns[2:]]
     
     finalCls = pd.DataFrame([i.split('|') for i in cls[0]]).sum()
     finalCls.index = sids
@@ -833,20 +1695,34 @@ def clustering(mout, args):
     finalCls.index.name = 'ID'
     finalCls.to_csv(reportPath+'clusters.tsv', sep='\t')
     
-    if args.visualization:
-        # print(args.visualization)
-        cls_full = recurSplit(ranked.sort_values(ascending = False), \
-                              minN=minN, minSumDMRs=0, fulltree=True)
-        cmap = plotClustermap(mout, cls, reportPath, sids, finalCls, cls_full)
-        plotDMTree(cls_full, finalCls, reportPath, sids, cmap)
-    
     return (finalCls, cls)
 
+def plotClusters(mout, cls, finalCls, args):
+    mout, ranked = rankPatterns(mout, args)
+    reportPath = args.output+'/'
+    sids = [str(i) for i in readInputHeader(args.input).columns[2:]]
+    cls_full = recurSplit(ranked.sort_values(ascending = False), \
+                          minN=args.minNSamples, minSumDMRs=0, fulltree=True)
+    cmap = plotClustermap(mout, cls, reportPath, sids, finalCls, cls_full)
+    plotDMTree(cls_full, finalCls, reportPath, sids, cmap)
+
 
 
 ###################################################################################################
 # GSEA
 ###################################################################################################
+def DMTreeMembers(dmrs, node):
+    # DMRs assigned to a DMTree node ('P' or 'N' + node ID), from the membership
+    # matrix of addDMTree2DMR or, for tables without it, from the DMTree column
+    if getattr(dmrs, 'dmtree', None) is not None:
+        index, keys, members = dmrs.dmtree
+        rows = index.get_indexer(dmrs.index)
+        if (rows>=0).all():
+            if node not in keys:
+                return np.zeros(len(rows), dtype=bool)
+            return members[:, keys[node]].toarray().ravel()[rows]>0
+    return dmrs['DMTree'].str.contains((node+',').replace('|',r'\|')).values
+
 def DMRtable(args, finalCls, mout, unmout=None):
     tables = []
     
@@ -859,9 +1735,9 @@ def DMRtable(args, finalCls, mout, unmout=None):
             table = pd.DataFrame(mout['sig.comparison'].value_counts()[:10])
             table.columns = ['#DMRs']
         else:
-            table = pd.DataFrame([dmrs['DMTree'].str.contains(('P'+i+',').replace('|',r'\|')).sum() for i in finalCls.columns[1:]], list(finalCls.columns[1:]))
+            table = pd.DataFrame([DMTreeMembers(dmrs, 'P'+i).sum() for i in finalCls.columns[1:]], list(finalCls.columns[1:]))
             table.columns = ['#DMRs_hypo_in_left']
-            table['#DMRs_hypo_in_right'] = [dmrs['DMTree'].str.contains(('N'+i+',').replace('|',r'\|')).sum() for i in table.index]
+            table['#DMRs_hypo_in_right'] = [DMTreeMembers(dmrs, 'N'+i).sum() for i in table.index]
         # print(table)
         
         def decodeSigCmp(x):
@@ -902,11 +1778,163 @@ def DMRtable(args, finalCls, mout, unmout=None):
     
     return tables
 
+def readGMT(path):
+    # gene sets of a GMT file as a sparse gene x set matrix
+    from scipy import sparse
+    terms, members = [], []
+    with openInput(path) as f:
+        for line in f:
+            x = line.rstrip('\r\n').split('\t')
+            if len(x) > 2:
+                terms.append(x[0])
+                members.append([g for g in x[2:] if g])
+    if not terms:
+        raise ValueError('no gene sets in '+path)
+    genes, gid = np.unique(np.concatenate(members), return_inverse=True)
+    col = np.repeat(np.arange(len(terms)), [len(i) for i in members])
+    sets = sparse.csr_matrix((np.ones(len(gid), dtype=np.int32), (gid, col)), shape=(len(genes), len(terms)))
+    sets.data[:] = 1
+    return genes, np.array(terms, dtype=object), sets
+
+
+def hypergeomSF(x, M, n, N):
+    # P(X >= x) for X ~ hypergeom(M, n, N) and x >= 1, elementwise: the log pmf at the start
+    # from log-gamma, then the sum of the tail by the ratios of consecutive terms, up or down
+    # from x whichever side of the mean is shorter, until the terms no longer count
+    from scipy.special import gammaln
+    lchoose = lambda a, b:gammaln(a+1)-gammaln(b+1)-gammaln(a-b+1)
+    x, M, n, N = [np.asarray(i, dtype=np.float64) for i in np.broadcast_arrays(x, M, n, N)]
+    upper = x > n*N/M
+    j = np.where(upper, x, x-1)
+    logpmf = lchoose(n, j)+lchoose(M-n, N-j)-lchoose(M, N)
+    total = np.ones(len(x))
+    term = np.ones(len(x))
+    active = np.flatnonzero(np.where(upper, j < np.minimum(n, N), j > np.maximum(0, N-M+n)))
+    while len(active):
+        a, b, c, d, u = j[active], n[active], N[active], M[active]-n[active]-N[active], upper[active]
+        term[active] *= np.where(u, (b-a)*(c-a)/((a+1)*(d+a+1)), a*(d+a)/((b-a+1)*(c-a+1)))
+        j[active] = np.where(u, a+1, a-1)
+        total[active] += term[active]
+        a = j[active]
+        more = np.where(u, a < np.minimum(b, c), a > np.maximum(0, -d))
+        active = active[more & (term[active] > total[active]*1e-17)]
+    with np.errstate(invalid='ignore'):
+        p = np.exp(logpmf+np.log(total))
+    # x at the bottom of the support: nothing below it
+    p[~upper & (j < np.maximum(0, N-M+n))] = 0
+    return np.clip(np.where(upper, p, 1-p), 0, 1)
+
+
+def enrichGeneLists(geneLists, gmt):
+    # hypergeometric test of every gene list against every set of the library at once, as
+    # gseapy's enrichr with a GMT file: all genes of the library are the background, terms
+    # without overlap are left out, FDR per gene list; None for lists without any hit
+    from scipy import sparse
+    genes, terms, sets = readGMT(gmt)
+    name = gmt.split('/')[-1]
+    uppercase = all(str(i).isupper() for i in genes)
+    pos = pd.Series(np.arange(len(genes)), index=genes)
+    rows, cols = [], []
+    for i, gl in enumerate(geneLists):
+        gl = set(str(g).upper() if uppercase else str(g) for g in gl)
+        hits = pos.reindex(sorted(gl)).dropna().astype(int)
+        rows += [i]*len(hits)
+        cols += list(hits)
+    query = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(geneLists), len(genes)))
+
+    overlap = (query @ sets).toarray()
+    k = np.asarray(query.sum(1)).ravel()
+    m = np.asarray(sets.sum(0)).ravel()
+    bg = len(genes)
+    qi, ti = np.nonzero(overlap)
+    x = overlap[qi, ti]
+    pvals = hypergeomSF(x, bg, m[ti], k[qi])
+    oddr = ((x+0.5)*(bg-m[ti]-k[qi]+x+0.5))/((m[ti]-x+0.5)*(k[qi]-x+0.5))
+
+    reports = []
+    rank = np.empty(len(terms), dtype=np.int64)
+    rank[np.argsort(terms, kind='stable')] = np.arange(len(terms))
+    bounds = np.searchsorted(qi, np.arange(len(geneLists)+1))
+    for i in range(len(geneLists)):
+        sel = np.arange(bounds[i], bounds[i+1])
+        if len(sel) == 0:
+            reports.append(None)
+            continue
+        sel = sel[np.argsort(rank[ti[sel]], kind='stable')]
+        qg = query[i].indices
+        hitGenes = sets[qg][:, ti[sel]].T.tocsr()
+        hitGenes.sort_indices()
+        names, idx = genes[qg].tolist(), hitGenes.indices.tolist()
+        p = pd.Series(pvals[sel])
+        reports.append(pd.DataFrame({'Gene_set':name, 'Term':terms[ti[sel]],
+                                     'Overlap':x[sel].astype(str).astype(object)+'/'+m[ti[sel]].astype(str).astype(object),
+                                     'P-value':p, 'Adjusted P-value':adjust_BH(p, len(p)),
+                                     'Odds Ratio':oddr[sel], 'Combined Score':-np.log(p)*oddr[sel],
+                                     'Genes':[';'.join([names[j] for j in idx[a:b]]) for a, b in
+                                              zip(hitGenes.indptr[:-1], hitGenes.indptr[1:])]}))
+    return reports
+
+
+def plotEnrichment(res, path, title):
+    # bar plot of the top 10 terms, as gseapy's barplot
+    import matplotlib.pyplot as plt
+    top = res.sort_values('Adjusted P-value').head(10)[::-1]
+    fig, ax = plt.subplots(figsize=(6, 5.5))
+    ax.barh(top['Term'], -np.log10(top['Adjusted P-value']), color='salmon')
+    ax.set_xlabel('$- \\log_{10}$ (Adjusted P-value)')
+    ax.set_title(title)
+    plt.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+
+
+def enrichment(args, jobs):
+    # jobs: (output folder, gene list). Local GMT files are tested for all gene lists in
+    # one pass and their figures drawn in a process pool; other names are Enrichr libraries
+    # queried online through gseapy, one call per list
+    figures = []
+    for gs in args.genesets.split(','):
+        name = gs.split('/')[-1]
+        if not os.path.isfile(gs) and '.gmt' in name:
+            print('Warning: cannot find the gene sets '+gs+'.')
+            continue
+        if not os.path.isfile(gs):
+            try:
+                import gseapy as gp
+            except ImportError:
+                print('Warning: gseapy is needed for the Enrichr library '+gs+'.')
+                continue
+            for outdir, gene_list in jobs:
+                try:
+                    gp.enrichr(gene_list=gene_list, gene_sets=gs, organism='human', outdir=outdir,
+                               cutoff=1, format='jpg')
+                except Exception as e:
+                    print('Warning: Enrichr failed on '+gs+' for '+outdir+' ('+str(e)+').')
+            continue
+        try:
+            reports = enrichGeneLists([gl for outdir, gl in jobs], gs)
+        except Exception as e:
+            print('Warning: cannot read the gene sets '+gs+' ('+str(e)+').')
+            continue
+        for (outdir, gene_list), res in zip(jobs, reports):
+            if res is None:
+                continue
+            os.makedirs(outdir, exist_ok=True)
+            res.to_csv(outdir+'/'+name+'.human.enrichr.reports.txt', index=False, sep='\t', float_format='%.6e')
+            figures.append((res.sort_values('Adjusted P-value').head(10), outdir+'/'+name+'.human.enrichr.reports.jpg', name))
+
+    if args.threads > 1 and len(figures) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(args.threads, len(figures))) as ex:
+            list(ex.map(plotEnrichment, *zip(*figures)))
+    else:
+        for i in figures:
+            plotEnrichment(*i)
+
+
 def gsea(args, finalCls, mout, unmout=None):
-    import gseapy as gp
-    
     gseapopup = ''
     tables = []
+    jobs = []
     
     dmrs_list = [mout,]
     if unmout is not None:
@@ -944,24 +1972,10 @@ def gsea(args, finalCls, mout, unmout=None):
         table['Hyper'] = [','.join(decodeSigCmp(i)[0]['3']) for i in table.index]
 
         if args.genesets and args.annotation:
-            import gseapy as gp
             j = 0
             for i in table.index:
-                gene_sets = args.genesets
                 gene_list = list(set(mout.loc[(mout['sig.comparison']==i)&(mout['meandiffabs']>args.minMethDiffHigh)]['SYMBOL'].dropna()))
-                
-                try:
-                    for gs in gene_sets.split(','):
-                        enr = gp.enrichr(gene_list=gene_list,
-                                    gene_sets=gs,
-                                    organism='human',
-                                    outdir=args.output+'/GSEA/'+i.replace('|','_'),
-                                    cutoff = 1,
-                                    format = 'jpg',
-                                    )
-                except:
-                    pass
-                    # print("GSEA error:",gene_list)
+                jobs.append((args.output+'/GSEA/'+i.replace('|','_'), gene_list))
                             
                 fig_path = './GSEA/'+i.replace('|','_')+\
                             "/"+args.genesets.split(',')[0].split('/')[-1]+".human.enrichr.reports.jpg"
@@ -981,33 +1995,19 @@ def gsea(args, finalCls, mout, unmout=None):
         uors = 'sup'
         for dmrs in dmrs_list:
             if dmrs is not None:
-                table = pd.DataFrame([dmrs['DMTree'].str.contains(('P'+i+',').replace('|',r'\|')).sum() for i in finalCls.columns[1:]], list(finalCls.columns[1:]))
+                table = pd.DataFrame([DMTreeMembers(dmrs, 'P'+i).sum() for i in finalCls.columns[1:]], list(finalCls.columns[1:]))
                 table.columns = ['#DMRs_hypo_in_left']
-                table['#DMRs_hypo_in_right'] = [dmrs['DMTree'].str.contains(('N'+i+',').replace('|',r'\|')).sum() for i in table.index]
+                table['#DMRs_hypo_in_right'] = [DMTreeMembers(dmrs, 'N'+i).sum() for i in table.index]
                 # print(table)
                 
                 table['left'] = [','.join(decodeSigCmpLR(i)['L']) for i in table.index]
                 table['right'] = [','.join(decodeSigCmpLR(i)['R']) for i in table.index]
     
                 if args.genesets and args.annotation:
-                    import gseapy as gp
                     j = 0
                     for i in table.index:
-                        gene_sets = args.genesets
-                        gene_list = list(set(dmrs.loc[(dmrs['DMTree'].str.contains(('P'+i+',').replace('|',r'\|')))&(dmrs['meandiffabs']>args.minMethDiffHigh)]['SYMBOL'].dropna()))
-                        
-                        try:
-                            for gs in gene_sets.split(','):
-                                enr = gp.enrichr(gene_list=gene_list,
-                                            gene_sets=gs,
-                                            organism='human',
-                                            outdir=args.output+'/GSEA/'+'P'+uors+i.replace('|','_'),
-                                            cutoff = 1,
-                                            format = 'jpg',
-                                            )
-                        except:
-                            pass
-                            # print("GSEA error:",gene_list)
+                        gene_list = list(set(dmrs.loc[(DMTreeMembers(dmrs, 'P'+i))&(dmrs['meandiffabs']>args.minMethDiffHigh)]['SYMBOL'].dropna()))
+                        jobs.append((args.output+'/GSEA/'+'P'+uors+i.replace('|','_'), gene_list))
                                     
                         fig_path = './GSEA/'+'P'+uors+i.replace('|','_')+\
                                     "/"+args.genesets.split(',')[0].split('/')[-1]+".human.enrichr.reports.jpg"
@@ -1023,21 +2023,8 @@ def gsea(args, finalCls, mout, unmout=None):
                     
                     j = 0
                     for i in table.index:
-                        gene_sets = args.genesets
-                        gene_list = list(set(dmrs.loc[(dmrs['DMTree'].str.contains(('N'+i+',').replace('|',r'\|')))&(dmrs['meandiffabs']>args.minMethDiffHigh)]['SYMBOL'].dropna()))
-                        
-                        try:
-                            for gs in gene_sets.split(','):
-                                enr = gp.enrichr(gene_list=gene_list,
-                                            gene_sets=gs,
-                                            organism='human',
-                                            outdir=args.output+'/GSEA/'+'N'+uors+i.replace('|','_'),
-                                            cutoff = 1,
-                                            format = 'jpg',
-                                            )
-                        except:
-                            pass
-                            # print("GSEA error:",gene_list)
+                        gene_list = list(set(dmrs.loc[(DMTreeMembers(dmrs, 'N'+i))&(dmrs['meandiffabs']>args.minMethDiffHigh)]['SYMBOL'].dropna()))
+                        jobs.append((args.output+'/GSEA/'+'N'+uors+i.replace('|','_'), gene_list))
                                     
                         fig_path = './GSEA/'+'N'+uors+i.replace('|','_')+\
                                     "/"+args.genesets.split(',')[0].split('/')[-1]+".human.enrichr.reports.jpg"
@@ -1056,7 +2043,9 @@ def gsea(args, finalCls, mout, unmout=None):
             else:
                 tables.append(None)
             uors = 'unsup'
-    
+
+    if jobs:
+        enrichment(args, jobs)
     return (gseapopup, tables)
 
 
@@ -1087,7 +2076,7 @@ def report_unsup(args, start_time, end_time, unmout, finalCls, mout):
     final_html = final_html.replace('<div>Number of supervised DMRs: XXX</div><br>', 'Number of supervised DMRs: '+str(mout.shape[0])+'</div><br>')
     
     if args.genesets and args.annotation:
-        gseapopup, tables = gsea(args, finalCls, mout, unmout)
+        gseapopup, tables = gseaStage(args, finalCls, mout, unmout)
         final_html = final_html.replace('<div id="pandas_table_placeholder_dmr_sup"></div>', tables[0].to_html(escape=False))
         final_html = final_html.replace('<div id="pandas_table_placeholder_dmr_unsup"></div>', tables[1].to_html(escape=False))
         final_html = final_html.replace('<div id="gsea_placeholder"></div>', gseapopup)
@@ -1115,7 +2104,7 @@ def report_sup(args, start_time, end_time, mout):
     finalCls = pd.read_table(args.groupinfo, index_col='ID')[['Group']]
     finalCls['Group'] = finalCls['Group'].astype(str)
     if args.genesets and args.annotation:
-        gseapopup, tables = gsea(args, finalCls, mout)
+        gseapopup, tables = gseaStage(args, finalCls, mout)
         final_html = final_html.replace('<div id="pandas_table_placeholder_dmr_sup"></div>', tables[0].to_html(escape=False))
         final_html = final_html.replace('<div id="gsea_placeholder"></div>', gseapopup)
     else:
@@ -1145,7 +2134,7 @@ def report_wosup(args, start_time, end_time, unmout, finalCls):
         final_html = final_html.replace('<button onclick="showPopup(\'popupTree\')">Click to show the figures</button>', '')
 
     if args.genesets and args.annotation:
-        gseapopup, tables = gsea(args, finalCls, None, unmout)
+        gseapopup, tables = gseaStage(args, finalCls, None, unmout)
         final_html = final_html.replace('<div id="pandas_table_placeholder_dmr_unsup"></div>', tables[1].to_html(escape=False))
         final_html = final_html.replace('<div id="gsea_placeholder"></div>', gseapopup)
     if not args.genesets:
@@ -1174,11 +2163,11 @@ def report_nocls(args, start_time, end_time, unmout):
     final_html = final_html.replace('<button onclick="showPopup(\'popupTree\')">Click to show the figures</button>', '')
     final_html = final_html.replace('<button onclick="showPopup(\'popupCluster\')">Click to show the Table of clusters</button>', '')
 
-    finalCls = pd.read_table(args.input, nrows=0).T[2:]
+    finalCls = readInputHeader(args.input).T[2:]
     finalCls['Group'] = finalCls.index
     finalCls['Group'] = finalCls['Group'].astype(str)
     if args.genesets and args.annotation:
-        gseapopup, tables = gsea(args, finalCls, unmout)
+        gseapopup, tables = gseaStage(args, finalCls, unmout)
         final_html = final_html.replace('<div id="pandas_table_placeholder_dmr_unsup"></div>', tables[0].to_html(escape=False))
         final_html = final_html.replace('<div id="gsea_placeholder"></div>', gseapopup)
     if not args.genesets:
@@ -1199,6 +2188,9 @@ def checkParams(args):
     if args.genesets and (not args.annotation):
         msg = 'ERROR: please also provide annotation if you want to run GSEA.'
         
+    if args.refSeq and isCompressed(args.refSeq):
+        msg = 'ERROR: please provide the reference genome as an uncompressed FASTA file.'
+
     if args.groupinfo and args.visualization:
         msg = 'ERROR: visualization function is only for unsupervised mode.'
 
@@ -1209,7 +2201,7 @@ def checkParams(args):
             msg = 'ERROR: please check the format of the table of group information and provide a tab-separated tsv file.'
 
     try:
-        pd.read_table(args.input, nrows=1)
+        readInputHeader(args.input, nrows=1)
     except:
         msg = 'ERROR: please check the format of the input matrix and provide a tab-separated tsv file.'
          
@@ -1249,14 +2241,21 @@ def main():
         os.mkdir(args.output)
     except:
         pass
+    args.matrix = getMatrixCache(args)
+    if args.stageCache:
+        try:
+            os.makedirs(args.stageCache, exist_ok=True)
+        except:
+            print('Warning: cannot create the stage cache directory '+args.stageCache+', running all stages.')
+            args.stageCache = None
         
     if args.groupinfo:
         print(time.ctime(),": Running supervised mode...")
         headerfile = args.output+'/'+args.input.split('/')[-1]+'.header'
         preprocess(args, headerfile, 'sup', \
                    args.groupinfo)
-        runMetilene(args, headerfile, 'sup')
-        mout = processOutput(args, 'sup', anno='T')
+        dmrs = engineStage(args, headerfile, 'sup')
+        mout = outputStage(args, 'sup', dmrs)
         end_time = time.ctime()
         if mout is None:
             print(end_time,": Finished.")
@@ -1276,8 +2275,11 @@ def main():
         if args.unsupervisedDMRs:
             unmout = commented_read_table(args.unsupervisedDMRs)
         else:
-            runMetilene(args, headerfile, 'unsup')
-            unmout = processOutput(args, 'unsup', anno='T')
+            thresholds = unsupThresholds(args)
+            dmrs = engineStage(args, headerfile, 'unsup', thresholds)
+            if thresholds:
+                selectThreshold(args, args.minMethDiffHigh)
+            unmout = outputStage(args, 'unsup', dmrs)
         if unmout is None:
             end_time = time.ctime()
             print(end_time,": Finished.")
@@ -1292,28 +2294,30 @@ def main():
         if args.test:
             args.minSumDMRs = 0
             
-        finalCls, cls = clustering(unmout, args)
+        finalCls, cls = clusterStage(args, unmout)
         if finalCls is None:
             if args.automatic and not args.unsupervisedDMRs:
                 print('Warning: No cluster found. Trying the second suggested parameter set.')
                 args.minMethDiffHigh = 0.25
                 args.minSumDMRs = bestw(N, ncpg, 1)
                 
-                headerfile = args.output+'/'+args.input.split('/')[-1]+'.unsup.header'
-                preprocess(args, headerfile, 'unsup')
-                runMetilene(args, headerfile, 'unsup')
-                unmout = processOutput(args, 'unsup', anno='T')
+                dmrs = None
+                if not (thresholds and selectThreshold(args, args.minMethDiffHigh)):
+                    headerfile = args.output+'/'+args.input.split('/')[-1]+'.unsup.header'
+                    preprocess(args, headerfile, 'unsup')
+                    dmrs = engineStage(args, headerfile, 'unsup')
+                unmout = outputStage(args, 'unsup', dmrs)
                 if unmout is None:
                     end_time = time.ctime()
                     print(end_time,": Finished.")
                     return
                 print(time.ctime(),": Clustering...")
-                finalCls, cls = clustering(unmout, args)
+                finalCls, cls = clusterStage(args, unmout)
                 if finalCls is None:
                     print('Warning: No cluster found. Please check the data or use smaller -D and/or -n and/or smaller -w for clustering.')
                     end_time = time.ctime()
                     headerfile = args.output+'/'+args.input.split('/')[-1]+'.header'
-                    finalCls = pd.read_table(args.input, nrows=0).T[2:]
+                    finalCls = readInputHeader(args.input).T[2:]
                     finalCls['Group'] = finalCls.index
                     finalCls['Group_ID'] = range(len(finalCls.index))
                     finalCls.to_csv(args.output+'/group-ID.tsv', sep='\t', index=False)
@@ -1326,7 +2330,7 @@ def main():
                 print('Warning: No cluster found. Please check the data or use smaller -D and/or -n and/or smaller -w for clustering.')
                 end_time = time.ctime()
                 headerfile = args.output+'/'+args.input.split('/')[-1]+'.header'
-                finalCls = pd.read_table(args.input, nrows=0).T[2:]
+                finalCls = readInputHeader(args.input).T[2:]
                 finalCls['Group'] = finalCls.index
                 finalCls['Group_ID'] = range(len(finalCls.index))
                 finalCls.to_csv(args.output+'/group-ID.tsv', sep='\t', index=False)
@@ -1352,8 +2356,8 @@ def main():
         headerfile = args.output+'/'+args.input.split('/')[-1]+'.header'
         preprocess(args, headerfile, 'sup', \
                    args.output+'/clusters.tsv')
-        runMetilene(args, headerfile, 'sup')
-        mout = processOutput(args, 'sup', anno='T')
+        dmrs = engineStage(args, headerfile, 'sup')
+        mout = outputStage(args, 'sup', dmrs)
         if mout is None:
             end_time = time.ctime()
             print(end_time,": Finished.")
@@ -1368,5 +2372,8 @@ def main():
     if not args.keeptmp:
         if not args.skipMetilene:
             os.system("rm "+args.output+"/*.header")
+            if os.path.isfile(args.output+'/DMRs-unsupervised.all.tsv'):
+                os.remove(args.output+'/DMRs-unsupervised.all.tsv')
         
-main()
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,11 @@
 /* bedavg.c
  *
- * Minimal single-threaded C version of the provided C++ program.
- * Compile:
- *   gcc -std=c99 -O2 -o bedavg bedavg.c
+ * Mean methylation of every sample over bed regions, in C with optional
+ * threads (-t). Compile with the Makefile (make bedavg), or:
+ *   gcc -std=c99 -O2 -o bedavg src/bedavg.c src/matcache.c src/zinput.c -lm -lpthread -lz
  *
  * Usage:
- *   ./bedavg met.tsv regions.bed out.tsv [--bedzero|--1based] [--inclusive]
+ *   ./bedavg met.tsv regions.bed out.tsv [--bedzero|--1based] [--inclusive] [--prefix] [-t threads]
  *
  * Notes:
  * - met.tsv: tab-separated header: chr\tpos\tSample1\tSample2...
@@ -13,8 +13,17 @@
  * - By default bed is treated as 0-based half-open (start <= pos-1 < end).
  * - --1based will treat regions as 1-based inclusive (start <= pos <= end).
  * - --inclusive makes matching use start <= pos <= end regardless of --bedzero/--1based.
+ * - met.tsv may also be a binary matrix cache written by `metilene -C`, or gzip or
+ *   bgzip compressed; compressed input is read in one pass and -t threads
+ *   decompress the bgzip blocks instead.
+ * - --prefix (cache input only) answers each interval by binary search on the
+ *   cached positions and per-sample prefix sums instead of scanning every row;
+ *   the sums are taken in another order, so a mean can round to the other 6th decimal.
+ * - -t/--threads spreads the chromosomes over threads; each thread reads its own
+ *   part of met.tsv, intervals of one chromosome are only touched by one thread.
  *
- * This is intentionally single-threaded and uses simple dynamic arrays and qsort.
+ * Each met row is parsed once (and only if an interval covers it) into a reusable
+ * buffer; lines are split in place, without per-cell allocations.
  */
 
 #define _GNU_SOURCE
@@ -22,6 +31,11 @@
 #include <stdlib.h>
 #include <string.h>
 #include <ctype.h>
+#include <math.h>
+#include <pthread.h>
+#include <sys/types.h>
+#include "matcache.h"
+#include "zinput.h"
 
 typedef long long ll;
 
@@ -62,32 +76,33 @@ static char *strtrim(char *s) {
     return strdup(s);
 }
 
-/* fast split by tab: returns array of pointers (allocated) and count in *cnt; caller must free array (but not the strings) */
-static char **split_tab(char *line, int *cnt) {
-    int cap = 8;
-    char **out = malloc(sizeof(char*) * cap);
+/* trim in place: returns a pointer into s */
+static char *trim_inplace(char *s) {
+    while (isspace((unsigned char)*s)) s++;
+    char *e = s + strlen(s);
+    while (e > s && isspace((unsigned char)e[-1])) *--e = '\0';
+    return s;
+}
+
+/* split by tab in place: the tabs are overwritten by NUL and *cols (grown as needed, reused
+ * across calls) points into line; the line ends at the first NUL, \r or \n */
+static int split_tab(char *line, char ***cols, int *cap) {
     int n = 0;
     char *p = line;
     while (1) {
         char *q = p;
         while (*q && *q != '\t' && *q != '\r' && *q != '\n') q++;
-        size_t len = q - p;
-        char *cell = malloc(len + 1);
-        memcpy(cell, p, len);
-        cell[len] = '\0';
-        if (n == cap) { cap *= 2; out = realloc(out, sizeof(char*) * cap); }
-        out[n++] = cell;
-        if (!*q || *q == '\r' || *q == '\n') break;
+        if (n == *cap) {
+            *cap = *cap ? *cap * 2 : 16;
+            *cols = realloc(*cols, sizeof(char*) * *cap);
+            if (!*cols) { perror("realloc"); exit(1); }
+        }
+        (*cols)[n++] = p;
+        if (*q != '\t') { *q = '\0'; break; }
+        *q = '\0';
         p = q + 1;
     }
-    *cnt = n;
-    return out;
-}
-
-/* free array returned by split_tab */
-static void free_split_tab(char **arr, int n) {
-    for (int i = 0; i < n; ++i) free(arr[i]);
-    free(arr);
+    return n;
 }
 
 /* qsort comparator: by chr then start then end */
@@ -110,19 +125,16 @@ static void read_bed(const char *bedfile, IntervalArray *ia) {
     char *line = NULL;
     size_t llen = 0;
     ssize_t l;
+    char **fields = NULL;
+    int fcap = 0;
     while ((l = getline(&line, &llen, f)) != -1) {
         if (l == 0) continue;
         if (line[0] == '#') continue;
-        /* split by tab safely */
-        int nfields = 0;
-        char *tmp = strdup(line);
-        char **fields = split_tab(tmp, &nfields);
+        int nfields = split_tab(line, &fields, &fcap);
         if (nfields >= 3) {
             char *chr = strtrim(fields[0]);
-            char *sstart = strtrim(fields[1]);
-            char *send = strtrim(fields[2]);
-            ll start = atoll(sstart);
-            ll end = atoll(send);
+            ll start = atoll(fields[1]);
+            ll end = atoll(fields[2]);
             char *name = NULL;
             if (nfields >= 4) name = strtrim(fields[3]);
             else {
@@ -140,20 +152,18 @@ static void read_bed(const char *bedfile, IntervalArray *ia) {
             iv.counts = NULL;
             iv.index = -1;
             ia_push(ia, iv);
-            free(sstart); free(send);
         }
-        free_split_tab(fields, nfields);
-        free(tmp);
     }
+    free(fields);
     free(line);
     fclose(f);
 }
 
 /* parse met header line to get sample names; returns sample count and an array of strdup'd sample names (caller free) */
-static char **parse_met_header(const char *header_line, int *n_samples) {
-    char *tmp = strdup(header_line);
-    int nfields = 0;
-    char **fields = split_tab(tmp, &nfields);
+static char **parse_met_header(char *header_line, int *n_samples) {
+    char **fields = NULL;
+    int fcap = 0;
+    int nfields = split_tab(header_line, &fields, &fcap);
     if (nfields < 3) {
         fprintf(stderr, "met header must have at least chr,pos,sample...\n");
         exit(1);
@@ -162,17 +172,359 @@ static char **parse_met_header(const char *header_line, int *n_samples) {
     char **samples = malloc(sizeof(char*) * ns);
     for (int i = 0; i < ns; ++i) samples[i] = strtrim(fields[2 + i]);
     *n_samples = ns;
-    free_split_tab(fields, nfields);
-    free(tmp);
+    free(fields);
     return samples;
 }
 
+/* active interval bookkeeping shared by the text and the cache reader */
+typedef struct {
+    size_t interval_ptr; /* first interval not yet activated for current chr */
+    size_t *active;
+    size_t active_n, active_cap;
+    char *current_chr;
+} ActiveSet;
+
+/* chromosome changed: clear active and advance interval_ptr to first interval on this chr */
+static void active_reset(ActiveSet *as, IntervalArray *ia, const char *rchr) {
+    as->active_n = 0;
+    /* find first interval with chr == rchr; if there is none, this points to the first interval after chr */
+    size_t i = 0;
+    while (i < ia->n && strcmp(ia->a[i].chr, rchr) < 0) ++i;
+    as->interval_ptr = i;
+    free(as->current_chr);
+    as->current_chr = strdup(rchr);
+}
+
+/* activate intervals whose start is <= pos and drop expired ones; returns number of active intervals */
+static size_t active_update(ActiveSet *as, IntervalArray *ia, const char *rchr, ll pos, int bed_zero_based, int inclusive) {
+    /* Activate intervals whose start is <= pos (adjust criterion based on bed_zero_based/inclusive) */
+    while (as->interval_ptr < ia->n && strcmp(ia->a[as->interval_ptr].chr, rchr) == 0) {
+        int should_add = 0;
+        if (inclusive) {
+            if (ia->a[as->interval_ptr].start <= pos) should_add = 1;
+        } else if (bed_zero_based) {
+            /* interval applies if start <= pos-1 (conservative) */
+            if (ia->a[as->interval_ptr].start <= pos - 1) should_add = 1;
+        } else {
+            if (ia->a[as->interval_ptr].start <= pos) should_add = 1;
+        }
+        if (should_add) {
+            if (as->active_n == as->active_cap) {
+                as->active_cap *= 2;
+                as->active = realloc(as->active, as->active_cap * sizeof(size_t));
+                if (!as->active) { perror("realloc active"); exit(1); }
+            }
+            as->active[as->active_n++] = as->interval_ptr;
+            as->interval_ptr++;
+        } else break;
+    }
+
+    /* remove expired from active */
+    size_t out_i = 0;
+    for (size_t ai = 0; ai < as->active_n; ++ai) {
+        size_t idx = as->active[ai];
+        ll istart = ia->a[idx].start;
+        ll iend = ia->a[idx].end;
+        int still = 0;
+        if (inclusive) {
+            if (istart <= pos && pos <= iend) still = 1;
+        } else if (bed_zero_based) {
+            ll p0 = pos - 1;
+            if (istart <= p0 && p0 < iend) still = 1;
+        } else {
+            if (istart <= pos && pos <= iend) still = 1;
+        }
+        if (still) as->active[out_i++] = idx;
+    }
+    as->active_n = out_i;
+    return as->active_n;
+}
+
+/* lower bound: first row in [lo,hi) of the cache whose position is > x */
+static uint64_t pos_upper(const int32_t *pos, uint64_t lo, uint64_t hi, ll x) {
+    while (lo < hi) {
+        uint64_t mid = lo + (hi - lo) / 2;
+        if (pos[mid] <= x) lo = mid + 1;
+        else hi = mid;
+    }
+    return lo;
+}
+
+/* --prefix: add the rows [a,b) of the cache, one chromosome, to the sorted intervals [i0,i1).
+ * Overlapping intervals are grouped into segments and each segment gets its own prefix sums,
+ * so memory stays bounded by the largest segment rather than the chromosome. */
+static void prefix_run(matcache_t *mc, uint64_t a, uint64_t b, IntervalArray *ia, size_t i0, size_t i1,
+                       int bed_zero_based, int inclusive, double **psum, ll **pcnt, size_t *pcap) {
+    uint64_t ns = mc->nsamples;
+    uint64_t *lo = malloc(sizeof(uint64_t) * (i1 - i0 + 1));
+    uint64_t *hi = malloc(sizeof(uint64_t) * (i1 - i0 + 1));
+    double *v = malloc(sizeof(double) * (ns ? ns : 1));
+
+    /* rows covered by interval i are [lo,hi): start < pos <= end by default, start <= pos <= end otherwise */
+    for (size_t i = i0; i < i1; ++i) {
+        ll s = ia->a[i].start, e = ia->a[i].end;
+        if (inclusive || !bed_zero_based) s -= 1;
+        lo[i-i0] = pos_upper(mc->pos, a, b, s);
+        hi[i-i0] = pos_upper(mc->pos, lo[i-i0], b, e);
+    }
+
+    size_t i = i0;
+    while (i < i1) {
+        /* intervals are sorted by start, so lo is non-decreasing */
+        uint64_t seglo = lo[i-i0], seghi = hi[i-i0];
+        size_t j = i + 1;
+        while (j < i1 && lo[j-i0] < seghi) {
+            if (hi[j-i0] > seghi) seghi = hi[j-i0];
+            ++j;
+        }
+        size_t len = seghi > seglo ? seghi - seglo : 0;
+        if ((len + 1) * ns > *pcap) {
+            *pcap = (len + 1) * ns;
+            *psum = realloc(*psum, sizeof(double) * *pcap);
+            *pcnt = realloc(*pcnt, sizeof(ll) * *pcap);
+            if (!*psum || !*pcnt) { perror("realloc prefix"); exit(1); }
+        }
+        double *S = *psum;
+        ll *C = *pcnt;
+        for (uint64_t k = 0; k < ns; ++k) { S[k] = 0; C[k] = 0; }
+        for (size_t r = 0; r < len; ++r) {
+            getMatCacheRow(mc, seglo + r, v);
+            double *S0 = S + r * ns, *S1 = S0 + ns;
+            ll *C0 = C + r * ns, *C1 = C0 + ns;
+            for (uint64_t k = 0; k < ns; ++k) {
+                if (v[k] != v[k]) { S1[k] = S0[k]; C1[k] = C0[k]; }
+                else { S1[k] = S0[k] + v[k]; C1[k] = C0[k] + 1; }
+            }
+        }
+        for (; i < j; ++i) {
+            if (hi[i-i0] <= lo[i-i0]) continue;
+            Interval *iv = &ia->a[i];
+            size_t l = lo[i-i0] - seglo, h = hi[i-i0] - seglo;
+            for (uint64_t k = 0; k < ns; ++k) {
+                iv->sums[k] += S[h*ns+k] - S[l*ns+k];
+                iv->counts[k] += C[h*ns+k] - C[l*ns+k];
+            }
+        }
+    }
+    free(lo);
+    free(hi);
+    free(v);
+}
+
+/* does any interval lie on chr? intervals are sorted by chr */
+static int has_intervals(IntervalArray *ia, const char *chr) {
+    size_t lo = 0, hi = ia->n;
+    while (lo < hi) {
+        size_t mid = lo + (hi - lo) / 2;
+        if (strcmp(ia->a[mid].chr, chr) < 0) lo = mid + 1;
+        else hi = mid;
+    }
+    return lo < ia->n && strcmp(ia->a[lo].chr, chr) == 0;
+}
+
+/* a contiguous part of met.tsv on one chromosome: byte offsets for text, rows for the cache;
+ * to < 0 reads up to the end of the file */
+typedef struct {
+    ll from, to;
+    char *chr;
+} Segment;
+
+static int cmp_segment(const void *A, const void *B) {
+    const Segment *a = (const Segment*)A;
+    const Segment *b = (const Segment*)B;
+    int c = strcmp(a->chr, b->chr);
+    if (c) return c;
+    return (a->from > b->from) - (a->from < b->from);
+}
+
+/* shared state of the worker threads; segments are sorted by chr and a task is
+ * the run of segments of one chromosome, so no two threads touch the same interval */
+typedef struct {
+    IntervalArray *ia;
+    matcache_t *mc;
+    const char *metfile;
+    int compressed, dthreads; /* compressed input: one segment, dthreads decompress it */
+    int nsamples;
+    int bed_zero_based, inclusive, prefix;
+    Segment *segs;
+    size_t *tasks;
+    size_t ntasks, next;
+    pthread_mutex_t lock;
+} Work;
+
+static void active_init(ActiveSet *as) {
+    as->interval_ptr = 0;
+    as->active_cap = 64;
+    as->active = malloc(as->active_cap * sizeof(size_t));
+    as->active_n = 0;
+    as->current_chr = NULL;
+}
+
+/* add one parsed row to the active intervals; NaN marks missing values */
+static void add_row(ActiveSet *as, IntervalArray *ia, const double *v, int nsamples) {
+    for (size_t k = 0; k < as->active_n; ++k) {
+        Interval *iv = &ia->a[as->active[k]];
+        for (int s = 0; s < nsamples; ++s) {
+            if (v[s] != v[s]) continue;
+            iv->sums[s] += v[s];
+            iv->counts[s] += 1;
+        }
+    }
+}
+
+/* walk the text rows in [seg->from, seg->to) */
+static void process_text(Work *w, Segment *seg) {
+    FILE *f = w->compressed ? openInputStream(w->metfile, w->dthreads) : fopen(w->metfile, "r");
+    if (!f) { perror(w->metfile); exit(1); }
+
+    ActiveSet as;
+    active_init(&as);
+    char *linebuf = NULL;
+    size_t linecap = 0;
+    ssize_t mread;
+    /* a compressed stream cannot seek; its only segment starts after the header */
+    if (w->compressed) {
+        if (getline(&linebuf, &linecap, f) == -1) { fprintf(stderr, "Empty met file or can't read header\n"); exit(1); }
+    } else if (fseeko(f, (off_t)seg->from, SEEK_SET) != 0) { perror(w->metfile); exit(1); }
+    ll at = seg->from;
+    double *v = malloc(sizeof(double) * (w->nsamples ? w->nsamples : 1));
+
+    while ((seg->to < 0 || at < seg->to) && (mread = getline(&linebuf, &linecap, f)) != -1) {
+        at += mread;
+        if (mread <= 0) continue;
+        /* trim newline */
+        while (mread > 0 && (linebuf[mread-1] == '\n' || linebuf[mread-1] == '\r')) { linebuf[mread-1] = '\0'; --mread; }
+        if (linebuf[0] == '\0') continue;
+
+        /* chr and pos only; the samples are parsed once the row is known to be covered */
+        char *tab = linebuf;
+        while (*tab && *tab != '\t' && *tab != '\r') tab++;
+        if (*tab != '\t') continue;
+        *tab = '\0';
+        char *rchr = trim_inplace(linebuf);
+        char *cell = tab + 1;
+        ll pos = atoll(cell);
+
+        /* if chromosome changed, clear active and advance interval_ptr to first interval on this chr;
+         * as before, the first row of a chromosome only resets the active set */
+        if (!as.current_chr || strcmp(as.current_chr, rchr) != 0) {
+            active_reset(&as, w->ia, rchr);
+            continue;
+        }
+        if (active_update(&as, w->ia, rchr, pos, w->bed_zero_based, w->inclusive) == 0) continue;
+
+        /* parse the samples into v; rows without enough columns are skipped */
+        while (*cell && *cell != '\t' && *cell != '\r') cell++;
+        int s = 0;
+        while (s < w->nsamples && *cell == '\t') {
+            char *sv = ++cell;
+            while (*cell && *cell != '\t' && *cell != '\r') cell++;
+            char c = *cell;
+            *cell = '\0';
+            char *endptr = NULL;
+            if (sv[0] == '\0' || strcmp(sv, ".") == 0 || strcmp(sv, "-") == 0 || strcmp(sv, "NA") == 0) v[s] = NAN;
+            else {
+                v[s] = strtod(sv, &endptr);
+                if (endptr == sv) v[s] = NAN; /* not a number */
+            }
+            *cell = c;
+            ++s;
+        }
+        if (s < w->nsamples) continue;
+
+        add_row(&as, w->ia, v, w->nsamples);
+    }
+
+    fclose(f);
+    free(v);
+    free(linebuf);
+    free(as.active);
+    free(as.current_chr);
+}
+
+/* walk the cache rows in [seg->from, seg->to) */
+static void process_cache(Work *w, Segment *seg) {
+    matcache_t *mc = w->mc;
+    IntervalArray *ia = w->ia;
+    uint64_t from = (uint64_t)seg->from, to = seg->to < 0 ? mc->nrows : (uint64_t)seg->to;
+
+    if (w->prefix) {
+        double *psum = NULL;
+        ll *pcnt = NULL;
+        size_t pcap = 0;
+        uint64_t a = from;
+        while (a < to) {
+            uint64_t b = a + 1;
+            while (b < to && mc->chrid[b] == mc->chrid[a]) ++b;
+            const char *rchr = mc->chrnames[mc->chrid[a]];
+            size_t i0 = 0, i1;
+            while (i0 < ia->n && strcmp(ia->a[i0].chr, rchr) < 0) ++i0;
+            for (i1 = i0; i1 < ia->n && strcmp(ia->a[i1].chr, rchr) == 0; ++i1);
+            /* the first row of a chromosome is skipped, as in the scan below */
+            if (i1 > i0) prefix_run(mc, a + 1, b, ia, i0, i1, w->bed_zero_based, w->inclusive, &psum, &pcnt, &pcap);
+            a = b;
+        }
+        free(psum);
+        free(pcnt);
+        return;
+    }
+
+    ActiveSet as;
+    active_init(&as);
+    double *v = malloc(sizeof(double) * (w->nsamples ? w->nsamples : 1));
+    for (uint64_t r = from; r < to; ++r) {
+        const char *rchr = mc->chrnames[mc->chrid[r]];
+        ll pos = mc->pos[r];
+
+        if (!as.current_chr || strcmp(as.current_chr, rchr) != 0) {
+            active_reset(&as, ia, rchr);
+            continue; /* as for the text input, the first row of a chromosome only resets the active set */
+        }
+        if (active_update(&as, ia, rchr, pos, w->bed_zero_based, w->inclusive) == 0) continue;
+
+        getMatCacheRow(mc, r, v);
+        add_row(&as, ia, v, w->nsamples);
+    }
+    free(v);
+    free(as.active);
+    free(as.current_chr);
+}
+
+static void *worker(void *arg) {
+    Work *w = (Work*)arg;
+    while (1) {
+        pthread_mutex_lock(&w->lock);
+        size_t t = w->next++;
+        pthread_mutex_unlock(&w->lock);
+        if (t >= w->ntasks) break;
+        for (size_t i = w->tasks[t]; i < w->tasks[t+1]; ++i) {
+            if (w->mc) process_cache(w, &w->segs[i]);
+            else process_text(w, &w->segs[i]);
+        }
+    }
+    return NULL;
+}
+
+/* add a segment unless no interval lies on its chromosome */
+static void push_segment(Segment **segs, size_t *n, size_t *cap, IntervalArray *ia, ll from, ll to, const char *chr) {
+    if (!has_intervals(ia, chr)) return;
+    if (*n == *cap) {
+        *cap = *cap ? *cap * 2 : 64;
+        *segs = realloc(*segs, sizeof(Segment) * *cap);
+        if (!*segs) { perror("realloc segments"); exit(1); }
+    }
+    (*segs)[*n].from = from;
+    (*segs)[*n].to = to;
+    (*segs)[*n].chr = strdup(chr);
+    (*n)++;
+}
+
 /* main processing: walk through met file (assumed sorted). Use active interval approach.
  * We assume intervals array ia->a is sorted by chr,start.
  */
 int main(int argc, char **argv) {
     if (argc < 4) {
-        fprintf(stderr, "Usage: %s met.tsv regions.bed out.tsv [--bedzero|--1based] [--inclusive]\n", argv[0]);
+        fprintf(stderr, "Usage: %s met.tsv regions.bed out.tsv [--bedzero|--1based] [--inclusive] [--prefix] [-t threads]\n", argv[0]);
         return 1;
     }
     const char *metfile = argv[1];
@@ -180,12 +532,16 @@ int main(int argc, char **argv) {
     const char *outfile = argv[3];
     int bed_zero_based = 1;
     int inclusive = 0;
+    int prefix = 0;
+    int threads = 1;
     for (int i = 4; i < argc; ++i) {
         if (strcmp(argv[i], "--1based") == 0) bed_zero_based = 0;
         else if (strcmp(argv[i], "--bedzero") == 0) bed_zero_based = 1;
         else if (strcmp(argv[i], "--inclusive") == 0) inclusive = 1;
-        else {
-            /* ignore numeric threads param in minimal C version */
+        else if (strcmp(argv[i], "--prefix") == 0) prefix = 1;
+        else if ((strcmp(argv[i], "-t") == 0 || strcmp(argv[i], "--threads") == 0) && i + 1 < argc) {
+            threads = atoi(argv[++i]);
+            if (threads < 1) threads = 1;
         }
     }
 
@@ -198,22 +554,34 @@ int main(int argc, char **argv) {
     qsort(ia.a, ia.n, sizeof(Interval), cmp_interval);
     for (size_t i = 0; i < ia.n; ++i) ia.a[i].index = (int)i;
 
-    /* open met file and read header */
-    FILE *mf = fopen(metfile, "r");
-    if (!mf) { perror(metfile); return 1; }
+    /* open met file (text or binary cache) and read header */
+    matcache_t *mc = openMatCache((char*)metfile);
+    FILE *mf = NULL;
     char *mline = NULL;
     size_t mlen = 0;
     ssize_t mread;
-
-    if ((mread = getline(&mline, &mlen, mf)) == -1) {
-        fprintf(stderr, "Empty met file or can't read header\n");
-        return 1;
-    }
-    /* remove trailing newline */
-    while (mread > 0 && (mline[mread-1] == '\n' || mline[mread-1] == '\r')) { mline[mread-1] = '\0'; --mread; }
-
     int nsamples = 0;
-    char **sample_names = parse_met_header(mline, &nsamples);
+    char **sample_names = NULL;
+    ll body = 0;
+    int compressed = 0;
+
+    if (mc) {
+        nsamples = (int)mc->nsamples;
+        sample_names = malloc(sizeof(char*) * nsamples);
+        for (int i = 0; i < nsamples; ++i) sample_names[i] = strdup(mc->samples[i]);
+    } else {
+        compressed = isCompressedInput(metfile);
+        mf = openInputStream(metfile, 1);
+        if (!mf) { perror(metfile); return 1; }
+        if ((mread = getline(&mline, &mlen, mf)) == -1) {
+            fprintf(stderr, "Empty met file or can't read header\n");
+            return 1;
+        }
+        body = mread;
+        /* remove trailing newline */
+        while (mread > 0 && (mline[mread-1] == '\n' || mline[mread-1] == '\r')) { mline[mread-1] = '\0'; --mread; }
+        sample_names = parse_met_header(mline, &nsamples);
+    }
 
     /* allocate accumulators per interval */
     for (size_t i = 0; i < ia.n; ++i) {
@@ -228,120 +596,79 @@ int main(int argc, char **argv) {
     for (int i = 0; i < nsamples; ++i) fprintf(of, "\t%s", sample_names[i]);
     fprintf(of, "\n");
 
-    /* PROCESS: read met line by line; maintain active intervals for current chromosome */
-    /* We'll iterate intervals using an index pointer into ia.a */
-    size_t interval_ptr = 0; /* first interval not yet activated for current chr */
-    size_t active_cap = 64;
-    size_t *active = malloc(active_cap * sizeof(size_t));
-    size_t active_n = 0;
-
-    char *linebuf = NULL;
-    size_t linecap = 0;
-    char *current_chr = NULL;
-
-    while ((mread = getline(&linebuf, &linecap, mf)) != -1) {
-        if (mread <= 0) continue;
-        /* trim newline */
-        while (mread > 0 && (linebuf[mread-1] == '\n' || linebuf[mread-1] == '\r')) { linebuf[mread-1] = '\0'; --mread; }
-        if (linebuf[0] == '\0') continue;
-
-        /* split the met row quickly */
-        int ncols = 0;
-        char *row = strdup(linebuf);
-        char **cols = split_tab(row, &ncols);
-        if (ncols < 2) { free_split_tab(cols,ncols); free(row); continue; }
-        char *rchr = strtrim(cols[0]);
-        char *posstr = strtrim(cols[1]);
-        ll pos = atoll(posstr);
-
-        /* if chromosome changed, clear active and advance interval_ptr to first interval on this chr */
-        if (!current_chr || strcmp(current_chr, rchr) != 0) {
-            /* flush active */
-            active_n = 0;
-            /* find first interval with chr == rchr */
-            size_t i = 0;
-            while (i < ia.n && strcmp(ia.a[i].chr, rchr) < 0) ++i;
-            /* now i is first >= rchr; if equal, set interval_ptr = i, else there are no intervals for this chr */
-            if (i < ia.n && strcmp(ia.a[i].chr, rchr) == 0) interval_ptr = i;
-            else interval_ptr = i; /* points to first interval after chr */
-            /* replace current_chr */
-            free(current_chr);
-            current_chr = rchr; /* note: rchr is strdup'd by strtrim; we want to own it */
-            /* free some temporaries */
-            free(posstr);
-            free_split_tab(cols, ncols);
-            free(row);
-            continue; /* we will re-process this line after resetting? No — we skipped adding active intervals; better to re-read: simpler: rewind file pointer back by line and continue outer loop doesn't support re-reading -> instead process this row now: we already advanced interval_ptr appropriate for this chr; so continue processing below using current_chr==rchr */
+    /* split met into per-chromosome segments; a single thread simply reads everything */
+    Segment *segs = NULL;
+    size_t nsegs = 0, segcap = 0;
+    if (threads == 1 || compressed) {
+        segcap = 1;
+        segs = malloc(sizeof(Segment));
+        segs[0].from = body;
+        segs[0].to = -1;
+        segs[0].chr = strdup("");
+        nsegs = 1;
+    } else if (mc) {
+        uint64_t a = 0;
+        while (a < mc->nrows) {
+            uint64_t b = a + 1;
+            while (b < mc->nrows && mc->chrid[b] == mc->chrid[a]) ++b;
+            push_segment(&segs, &nsegs, &segcap, &ia, (ll)a, (ll)b, mc->chrnames[mc->chrid[a]]);
+            a = b;
         }
-
-        /* Activate intervals whose start is <= pos (adjust criterion based on bed_zero_based/inclusive) */
-        while (interval_ptr < ia.n && strcmp(ia.a[interval_ptr].chr, rchr) == 0) {
-            int should_add = 0;
-            if (inclusive) {
-                if (ia.a[interval_ptr].start <= pos) should_add = 1;
-            } else if (bed_zero_based) {
-                /* interval applies if start <= pos-1 (conservative) */
-                if (ia.a[interval_ptr].start <= pos - 1) should_add = 1;
-            } else {
-                if (ia.a[interval_ptr].start <= pos) should_add = 1;
-            }
-            if (should_add) {
-                if (active_n == active_cap) {
-                    active_cap *= 2;
-                    active = realloc(active, active_cap * sizeof(size_t));
-                    if (!active) { perror("realloc active"); exit(1); }
-                }
-                active[active_n++] = interval_ptr;
-                interval_ptr++;
-            } else break;
-        }
-
-        /* remove expired from active */
-        size_t out_i = 0;
-        for (size_t ai = 0; ai < active_n; ++ai) {
-            size_t idx = active[ai];
-            ll istart = ia.a[idx].start;
-            ll iend = ia.a[idx].end;
-            int still = 0;
-            if (inclusive) {
-                if (istart <= pos && pos <= iend) still = 1;
-            } else if (bed_zero_based) {
-                ll p0 = pos - 1;
-                if (istart <= p0 && p0 < iend) still = 1;
-            } else {
-                if (istart <= pos && pos <= iend) still = 1;
+    } else {
+        /* one pass over the first column to find where each chromosome starts */
+        char *cur = NULL;
+        ll at = body, from = body;
+        while ((mread = getline(&mline, &mlen, mf)) != -1) {
+            char *tab = mline;
+            while (*tab && *tab != '\t' && *tab != '\r' && *tab != '\n') tab++;
+            *tab = '\0';
+            char *rchr = trim_inplace(mline);
+            if (!cur || strcmp(cur, rchr) != 0) {
+                if (cur) push_segment(&segs, &nsegs, &segcap, &ia, from, at, cur);
+                free(cur);
+                cur = strdup(rchr);
+                from = at;
             }
-            if (still) active[out_i++] = idx;
-        }
-        active_n = out_i;
-
-        if (active_n == 0) { /* no interval covering this pos */ free(posstr); free_split_tab(cols,ncols); free(row); continue; }
-
-        /* check that we have enough columns for samples */
-        if (ncols < 2 + nsamples) {
-            free(posstr); free_split_tab(cols,ncols); free(row); continue;
+            at += mread;
         }
-
-        /* for each active interval, add sample values */
-        for (size_t k = 0; k < active_n; ++k) {
-            size_t idx = active[k];
-            Interval *iv = &ia.a[idx];
-            for (int s = 0; s < nsamples; ++s) {
-                char *sv = cols[2 + s];
-                if (!sv || sv[0] == '\0' || strcmp(sv, ".") == 0 || strcmp(sv, "-") == 0 || strcmp(sv, "NA") == 0) continue;
-                /* use strtod for parsing */
-                char *endptr = NULL;
-                double v = strtod(sv, &endptr);
-                if (endptr == sv) continue; /* not a number */
-                iv->sums[s] += v;
-                iv->counts[s] += 1;
-            }
+        if (cur) push_segment(&segs, &nsegs, &segcap, &ia, from, at, cur);
+        free(cur);
+    }
+    if (mf) fclose(mf);
+
+    /* tasks: runs of segments of the same chromosome */
+    qsort(segs, nsegs, sizeof(Segment), cmp_segment);
+    Work w;
+    w.ia = &ia;
+    w.mc = mc;
+    w.metfile = metfile;
+    w.compressed = compressed;
+    w.dthreads = threads;
+    w.nsamples = nsamples;
+    w.bed_zero_based = bed_zero_based;
+    w.inclusive = inclusive;
+    w.prefix = prefix;
+    w.segs = segs;
+    w.tasks = malloc(sizeof(size_t) * (nsegs + 1));
+    w.ntasks = 0;
+    w.next = 0;
+    for (size_t i = 0; i < nsegs; ++i) {
+        if (i == 0 || strcmp(segs[i].chr, segs[i-1].chr) != 0) w.tasks[w.ntasks++] = i;
+    }
+    w.tasks[w.ntasks] = nsegs;
+    pthread_mutex_init(&w.lock, NULL);
+
+    if (threads > (int)w.ntasks || compressed) threads = w.ntasks ? (int)w.ntasks : 1;
+    if (threads == 1) worker(&w);
+    else {
+        pthread_t *th = malloc(sizeof(pthread_t) * threads);
+        for (int i = 0; i < threads; ++i) {
+            if (pthread_create(&th[i], NULL, worker, &w) != 0) { perror("pthread_create"); exit(1); }
         }
-
-        free(posstr);
-        free_split_tab(cols, ncols);
-        free(row);
-    } /* end reading met */
+        for (int i = 0; i < threads; ++i) pthread_join(th[i], NULL);
+        free(th);
+    }
+    pthread_mutex_destroy(&w.lock);
 
     /* write results */
     for (size_t i = 0; i < ia.n; ++i) {
@@ -358,14 +685,14 @@ int main(int argc, char **argv) {
     }
 
     /* cleanup */
-    fclose(mf);
+    closeMatCache(mc);
     fclose(of);
     for (int i = 0; i < nsamples; ++i) free(sample_names[i]);
     free(sample_names);
-    free(active);
     free(mline);
-    free(linebuf);
-    free(current_chr); /* may be NULL */
+    for (size_t i = 0; i < nsegs; ++i) free(segs[i].chr);
+    free(segs);
+    free(w.tasks);
 
     for (size_t i = 0; i < ia.n; ++i) {
         free(ia.a[i].chr);
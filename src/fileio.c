@@ -21,6 +21,7 @@
 #include "stringutils.h"
 #include "basic-types.h"
 #include "fileio.h"
+#include "zinput.h"
 
 #ifndef DIR_SEPARATOR
 #define DIR_SEPARATOR '/'
@@ -115,12 +116,27 @@ bl_fgetsBuffered(void *space, fileiterator_t *fi, char **str) {
 
   fileiterator_t*
 initFileIterator (void *space, char *filename)
+{
+  return initFileIteratorThreads(space, filename, 1);
+}
+
+/*-------------------------- initFileIteratorThreads --------------------------
+ *    
+ * @brief initalize and open fileiterator; gzip and bgzip files are read
+ * through a decompressing stream, bgzip blocks are inflated by nthreads
+ * threads
+ * @author zzhu
+ *   
+ */
+
+  fileiterator_t*
+initFileIteratorThreads (void *space, char *filename, int nthreads)
 {
 
   fileiterator_t *fi;   
   fi = ALLOCMEMORY(space, NULL, fileiterator_t, 1);
   fi->filename = filename;
-  fi->fp = fopen(filename, "r");
+  fi->fp = openInputStream(filename, nthreads);
   if (fi->fp == NULL){
     fprintf(stderr, "Opening of file %s failed. Exit forced.\n", filename);
     exit(EXIT_FAILURE);
@@ -131,6 +147,8 @@ initFileIterator (void *space, char *filename)
   fi->ptr = 0;
   fi->bufferfill = 0;
   fi->eof = 0;
+  fi->fields = NULL;
+  fi->fieldsize = 0;
   return fi;
 }
 
@@ -153,6 +171,8 @@ closeFileIterator (void *space, fileiterator_t *fi)
 
   if(fi->buffer)
     FREEMEMORY(NULL, fi->buffer);
+  if(fi->fields)
+    FREEMEMORY(NULL, fi->fields);
 
   return;
 }
@@ -183,3 +203,66 @@ readcsvlines(void *space,
   *out = csv;
   return i;
 }
+
+
+/*------------------------------- readcsvfields -------------------------------
+ *    
+ * @brief read the next line and split it at delim in place: the fields
+ * point into the buffer of the iterator and stay valid until the next
+ * call. Every delim ends a field, so two in a row give an empty field,
+ * and an empty line gives none. Like readcsvlines, a last line without a
+ * line break is dropped. Returns the length of the line or EOF.
+ * @author zzhu
+ *   
+ */
+
+int
+readcsvfields(void *space, fileiterator_t *fi, char delim, 
+    char ***fields, Uint *nfields) {
+
+  char *line, *end, *s;
+  size_t len;
+  Uint n = 0;
+
+  //large blocks, the buffer may already hold data of readcsvlines
+  if(!fi->buffer || fi->buffersize < CSVBLOCKSIZE) {
+    if(fi->buffersize < CSVBLOCKSIZE) fi->buffersize = CSVBLOCKSIZE;
+    fi->buffer = ALLOCMEMORY(space, fi->buffer, char, fi->buffersize+1);
+  }
+
+  while(!(end = memchr(fi->buffer+fi->ptr, '\n', fi->bufferfill-fi->ptr))) {
+    //move the incomplete line to the front, grow if it fills the buffer
+    memmove(fi->buffer, fi->buffer+fi->ptr, fi->bufferfill-fi->ptr);
+    fi->bufferfill -= fi->ptr;
+    fi->ptr = 0;
+    if(fi->bufferfill == fi->buffersize) {
+      fi->buffersize *= 2;
+      fi->buffer = ALLOCMEMORY(space, fi->buffer, char, fi->buffersize+1);
+    }
+    len = fread(fi->buffer+fi->bufferfill, 1, fi->buffersize-fi->bufferfill, fi->fp);
+    if(len == 0) {
+      return EOF;
+    }
+    fi->bufferfill += len;
+  }
+
+  line = fi->buffer+fi->ptr;
+  len = end-line;
+  *end = '\0';
+  fi->ptr += len+1;
+
+  for(s=line; len > 0; ) {
+    if(n == fi->fieldsize) {
+      fi->fieldsize = fi->fieldsize ? 2*fi->fieldsize : 64;
+      fi->fields = ALLOCMEMORY(space, fi->fields, char*, fi->fieldsize);
+    }
+    fi->fields[n++] = s;
+    while(s < end && *s != delim) s++;
+    if(s == end) break;
+    *s++ = '\0';
+  }
+
+  *fields = fi->fields;
+  *nfields = n;
+  return len;
+}
@@ -23,6 +23,8 @@
 #include <math.h>
 #include "stringutils.h"
 
+#define CSVBLOCKSIZE (1<<20)
+
 typedef struct {
   char *filename;
   FILE *fp;
@@ -33,10 +35,14 @@ typedef struct {
   size_t bufferfill;
   size_t ptr;
   char *buffer;
+  char **fields; // cells of the last line read by readcsvfields
+  Uint fieldsize;
 } fileiterator_t;
 
 fileiterator_t* initFileIterator (void *space, char *filename);
+fileiterator_t* initFileIteratorThreads (void *space, char *filename, int nthreads);
 void closeFileIterator (void *space, fileiterator_t *fi);
 Uint readcsvlines(void *space, fileiterator_t *fi, char delim, Uint linecount, stringset_t ***out); 
+int readcsvfields(void *space, fileiterator_t *fi, char delim, char ***fields, Uint *nfields);
 
 #endif
@@ -0,0 +1,577 @@
+/*
+ *
+ *  ingest.c
+ *  parallel parsing of the text input matrix through a byte-offset index
+ *
+ *  With one reader the main thread parses every row itself and cannot keep
+ *  many workers busy. Here -R reader threads parse separate blocks of the
+ *  input at once, while the main thread still takes the rows one by one in
+ *  input order, so imputation and chunking see exactly the same sequence.
+ *
+ *  @author zzhu
+ *
+ */
+
+#define _POSIX_C_SOURCE 200809L
+
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <ctype.h>
+#include <math.h>
+#include <inttypes.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include "memory.h"
+#include "stringutils.h"
+#include "ingest.h"
+
+/*--------------------------------- parseValue ---------------------------------
+ *
+ * @brief one value of the input matrix as checkSetNAN reads it. Plain
+ * decimals of up to 15 digits are converted directly: digits/10^k is
+ * correctly rounded, i.e. the same double as atof. Anything else takes
+ * the general path
+ * @author zzhu
+ *
+ */
+
+static double
+parseValue(char *s) {
+  static const double p10[] = {1e0, 1e1, 1e2, 1e3, 1e4, 1e5, 1e6, 1e7,
+    1e8, 1e9, 1e10, 1e11, 1e12, 1e13, 1e14, 1e15};
+  char *c = s;
+  int neg = 0, digits = 0, frac = 0;
+  uint64_t m = 0;
+  double v;
+
+  if(*c == '\0') {
+    //an empty cell
+    return NAN;
+  }
+  if(*c == '-' || *c == '+') {
+    neg = (*c == '-');
+    c++;
+  }
+  for(; *c >= '0' && *c <= '9'; c++, digits++) {
+    m = 10*m + (*c-'0');
+  }
+  if(*c == '.') {
+    for(c++; *c >= '0' && *c <= '9'; c++, digits++, frac++) {
+      m = 10*m + (*c-'0');
+    }
+  }
+  if(*c == '\0' && digits > 0 && digits <= 15) {
+    v = (double)m / p10[frac];
+    return neg ? -v : v;
+  }
+
+  v = atof(s);
+  if(strcmp(".", s) == 0 || strcmp("-", s) == 0 || strcmp("", s) == 0 || strcmp(" ", s) == 0){
+    v = NAN;
+  }
+  for(c=s; v == v && *c; c++) {
+    if (isalpha(*c)) {
+      v = NAN;
+      break;
+    }
+  }
+  return v;
+}
+
+/*-------------------------------- checkSetNAN ---------------------------------
+ *
+ * @brief for checking NaNs in input data
+ * @author Frank Juehling and Steve Hoffmann
+ *
+ */
+
+int
+checkSetNAN(char **fields, Uint nfields, double *values){
+//check line for NANs and set . to NAN
+    int nan=0;
+    values[0] = -1;
+    values[1] = -1;
+    for(Uint k=2; k < nfields; k++) {
+        values[k] = parseValue(fields[k]);
+        if(values[k] != values[k] ) {
+            nan+=1;
+        }
+    }
+    return nan;
+}
+
+/*--------------------------------- ig_die ----------------------------------
+ *
+ * @brief report an i/o error on the input or its index and exit
+ * @author zzhu
+ *
+ */
+
+static void
+ig_die(char *msg, char *filename) {
+  fprintf(stderr, "input %s: %s. Exit forced.\n", filename, msg);
+  exit(-1);
+}
+
+/*-------------------------------- splitLine ---------------------------------
+ *
+ * @brief split the line [s, end) at tabs in place, as readcsvfields does:
+ * two tabs in a row give an empty field
+ * @author zzhu
+ *
+ */
+
+static Uint
+splitLine(char *s, char *end, char ***fields, Uint *size) {
+  Uint n = 0;
+
+  while(s < end || n > 0) {
+    if(n == *size) {
+      *size = *size ? 2*(*size) : 64;
+      *fields = ALLOCMEMORY(NULL, *fields, char*, *size);
+    }
+    (*fields)[n++] = s;
+    while(s < end && *s != '\t') s++;
+    if(s == end) break;
+    *s++ = '\0';
+  }
+  *end = '\0';
+  return n;
+}
+
+/*------------------------------ addIndexBlock -------------------------------
+ *
+ * @brief append a block to the index
+ * @author zzhu
+ *
+ */
+
+static inputblock_t*
+addIndexBlock(inputindex_t *idx, uint64_t *alloc, char *chr, size_t len,
+    uint64_t offset) {
+  inputblock_t *b;
+
+  if(idx->n == *alloc) {
+    *alloc = *alloc ? 2*(*alloc) : 1024;
+    idx->blocks = ALLOCMEMORY(NULL, idx->blocks, inputblock_t, *alloc);
+  }
+  b = &idx->blocks[idx->n++];
+  b->chr = ALLOCMEMORY(NULL, NULL, char, len+1);
+  memcpy(b->chr, chr, len);
+  b->chr[len] = '\0';
+  b->offset = offset;
+  b->length = 0;
+  b->rows = 0;
+  return b;
+}
+
+/*----------------------------- buildInputIndex ------------------------------
+ *
+ * @brief scan the mapped input for line breaks and cut it into blocks of
+ * one chromosome and at most about INGEST_STEP bytes. The header line
+ * and a last line without a line break are not indexed
+ * @author zzhu
+ *
+ */
+
+static void
+buildInputIndex(inputindex_t *idx, char *filename) {
+  inputblock_t *b = NULL;
+  uint64_t alloc = 0;
+  char *map, *p, *q, *end, *chr;
+  size_t len;
+  int fd;
+
+  if(idx->size == 0) return;
+  fd = open(filename, O_RDONLY);
+  if(fd < 0) ig_die("cannot open file", filename);
+  map = mmap(NULL, idx->size, PROT_READ, MAP_PRIVATE, fd, 0);
+  close(fd);
+  if(map == MAP_FAILED) ig_die("cannot map file", filename);
+  posix_madvise(map, idx->size, POSIX_MADV_SEQUENTIAL);
+
+  end = map + idx->size;
+  p = memchr(map, '\n', idx->size);
+  p = p ? p+1 : end;
+
+  while(p < end && (q = memchr(p, '\n', end-p))) {
+    for(chr=p; chr < q && *chr == '\t'; chr++);
+    for(len=0; chr+len < q && chr[len] != '\t'; len++);
+    if(!b || strlen(b->chr) != len || memcmp(b->chr, chr, len) != 0 ||
+        b->length >= INGEST_STEP) {
+      b = addIndexBlock(idx, &alloc, chr, len, p-map);
+    }
+    b->length += q+1-p;
+    b->rows++;
+    p = q+1;
+  }
+
+  munmap(map, idx->size);
+}
+
+/*----------------------------- readInputIndex -------------------------------
+ *
+ * @brief read an index file; returns 0 if it is missing or does not match
+ * the size and mtime of the input
+ * @author zzhu
+ *
+ */
+
+static int
+readInputIndex(inputindex_t *idx, char *idxname) {
+  FILE *fp = fopen(idxname, "r");
+  char *line = NULL, *tab, magic[16];
+  size_t linesize = 0;
+  uint64_t size, step, alloc = 0;
+  int64_t mtime;
+  inputblock_t *b;
+  int ok = 0;
+
+  if(!fp) return 0;
+  if(fscanf(fp, "%15s %" SCNu64 " %" SCNd64 " %" SCNu64,
+        magic, &size, &mtime, &step) == 4 && strcmp(magic, INGEST_MAGIC) == 0 &&
+      size == idx->size && mtime == idx->mtime && getline(&line, &linesize, fp) > 0) {
+    ok = 1;
+    while(getline(&line, &linesize, fp) > 0) {
+      if(!(tab = strchr(line, '\t'))) {
+        ok = 0;
+        break;
+      }
+      b = addIndexBlock(idx, &alloc, line, tab-line, 0);
+      if(sscanf(tab+1, "%" SCNu64 " %" SCNu64 " %" SCNu64,
+            &b->offset, &b->length, &b->rows) != 3) {
+        ok = 0;
+        break;
+      }
+    }
+  }
+  free(line);
+  fclose(fp);
+
+  if(!ok) {
+    for(uint64_t i=0; i < idx->n; i++) {
+      FREEMEMORY(NULL, idx->blocks[i].chr);
+    }
+    FREEMEMORY(NULL, idx->blocks);
+    idx->n = 0;
+  }
+  return ok;
+}
+
+/*----------------------------- writeInputIndex ------------------------------
+ *
+ * @brief write the index next to the input; a temporary file is renamed,
+ * so concurrent runs never see a partial index. Returns 0 on failure
+ * @author zzhu
+ *
+ */
+
+static int
+writeInputIndex(inputindex_t *idx, char *idxname) {
+  char *tmpname;
+  FILE *fp;
+  int ok;
+
+  tmpname = ALLOCMEMORY(NULL, NULL, char, strlen(idxname)+32);
+  sprintf(tmpname, "%s.tmp.%ld", idxname, (long)getpid());
+  if(!(fp = fopen(tmpname, "w"))) {
+    FREEMEMORY(NULL, tmpname);
+    return 0;
+  }
+  fprintf(fp, "%s\t%" PRIu64 "\t%" PRId64 "\t%d\n",
+      INGEST_MAGIC, idx->size, idx->mtime, INGEST_STEP);
+  for(uint64_t i=0; i < idx->n; i++) {
+    fprintf(fp, "%s\t%" PRIu64 "\t%" PRIu64 "\t%" PRIu64 "\n", idx->blocks[i].chr,
+        idx->blocks[i].offset, idx->blocks[i].length, idx->blocks[i].rows);
+  }
+  ok = (fclose(fp) == 0 && rename(tmpname, idxname) == 0);
+  if(!ok) unlink(tmpname);
+  FREEMEMORY(NULL, tmpname);
+  return ok;
+}
+
+/*------------------------------ loadInputIndex ------------------------------
+ *
+ * @brief the index of the text input: <filename>.m3i is reused if it
+ * matches the input, otherwise it is built and written. If the index
+ * cannot be written it is only kept in memory
+ * @author zzhu
+ *
+ */
+
+inputindex_t*
+loadInputIndex(char *filename, int verbose) {
+  inputindex_t *idx;
+  struct stat st;
+  char *idxname;
+
+  if(stat(filename, &st) != 0) ig_die("cannot open file", filename);
+  idx = ALLOCMEMORY(NULL, NULL, inputindex_t, 1);
+  idx->size = st.st_size;
+  idx->mtime = st.st_mtime;
+  idx->n = 0;
+  idx->blocks = NULL;
+
+  idxname = ALLOCMEMORY(NULL, NULL, char, strlen(filename)+5);
+  sprintf(idxname, "%s.m3i", filename);
+
+  if(!readInputIndex(idx, idxname)) {
+    if(verbose){fprintf(stderr, "Indexing %s\n", filename);}
+    buildInputIndex(idx, filename);
+    if(!writeInputIndex(idx, idxname)) {
+      fprintf(stderr, "Warning: could not write index %s, it is rebuilt on every run.\n", idxname);
+    }
+  }
+  if(verbose){fprintf(stderr, "Index %s: %" PRIu64 " blocks\n", idxname, idx->n);}
+
+  FREEMEMORY(NULL, idxname);
+  return idx;
+}
+
+/*---------------------------- destructInputIndex ----------------------------
+ *
+ * @brief free the index
+ * @author zzhu
+ *
+ */
+
+void
+destructInputIndex(inputindex_t *idx) {
+  if(!idx) return;
+  for(uint64_t i=0; i < idx->n; i++) {
+    FREEMEMORY(NULL, idx->blocks[i].chr);
+  }
+  FREEMEMORY(NULL, idx->blocks);
+  FREEMEMORY(NULL, idx);
+}
+
+/*-------------------------------- parseBlock --------------------------------
+ *
+ * @brief read block b of the input and parse its rows into the slot
+ * @author zzhu
+ *
+ */
+
+static void
+parseBlock(inputreader_t *r, uint64_t b, inputslot_t *s, char **buffer,
+    size_t *bufsize, char ***fields, Uint *fieldsize) {
+  inputblock_t *blk = &r->idx->blocks[b];
+  char *p, *q, *end;
+  size_t got = 0, width;
+  ssize_t len;
+  Uint n, i;
+
+  if(*bufsize < blk->length) {
+    *bufsize = blk->length;
+    *buffer = ALLOCMEMORY(NULL, *buffer, char, *bufsize);
+  }
+  while(got < blk->length) {
+    len = pread(r->fd, *buffer+got, blk->length-got, blk->offset+got);
+    if(len <= 0) ig_die("read failed, the index may be out of date", r->filename);
+    got += len;
+  }
+
+  if(s->alloc < blk->rows) {
+    s->alloc = blk->rows;
+    s->pos = ALLOCMEMORY(NULL, s->pos, int, s->alloc);
+    s->nan = ALLOCMEMORY(NULL, s->nan, int, s->alloc);
+    s->ncols = ALLOCMEMORY(NULL, s->ncols, Uint, s->alloc);
+    s->start = ALLOCMEMORY(NULL, s->start, size_t, s->alloc);
+  }
+
+  s->nrows = 0;
+  width = 0;
+  p = *buffer;
+  end = *buffer + blk->length;
+  for(i=0; i < blk->rows; i++) {
+    if(p >= end || !(q = memchr(p, '\n', end-p))) {
+      ig_die("short block, the index may be out of date", r->filename);
+    }
+    n = splitLine(p, q, fields, fieldsize);
+    if(strcmp(n ? (*fields)[0] : "", blk->chr) != 0) {
+      ig_die("chromosome does not match the index, the index may be out of date", r->filename);
+    }
+    s->start[i] = (i == 0) ? 0 : s->start[i-1] + width;
+    width = (n > 2) ? n : 2;
+    if(s->valloc < s->start[i] + width) {
+      s->valloc = 2*(s->start[i] + width);
+      s->values = ALLOCMEMORY(NULL, s->values, double, s->valloc);
+    }
+    s->ncols[i] = n;
+    s->nan[i] = checkSetNAN(*fields, n, s->values + s->start[i]);
+    s->pos[i] = (n > 1) ? atoi((*fields)[1]) : 0;
+    s->nrows++;
+    p = q+1;
+  }
+}
+
+/*---------------------------- inputReaderThread -----------------------------
+ *
+ * @brief claim the next block as soon as its slot is free and parse it
+ * @author zzhu
+ *
+ */
+
+static void*
+inputReaderThread(void *args) {
+  inputreader_t *r = (inputreader_t*) args;
+  char *buffer = NULL, **fields = NULL;
+  size_t bufsize = 0;
+  Uint fieldsize = 0;
+  inputslot_t *s;
+  uint64_t b;
+
+  while(1) {
+    pthread_mutex_lock(&r->lock);
+    while(!r->stop && r->next < r->idx->n && r->next >= r->cur + r->nslots) {
+      pthread_cond_wait(&r->free, &r->lock);
+    }
+    if(r->stop || r->next >= r->idx->n) {
+      pthread_mutex_unlock(&r->lock);
+      break;
+    }
+    b = r->next++;
+    pthread_mutex_unlock(&r->lock);
+
+    s = &r->slots[b % r->nslots];
+    parseBlock(r, b, s, &buffer, &bufsize, &fields, &fieldsize);
+
+    pthread_mutex_lock(&r->lock);
+    s->ready = 1;
+    pthread_cond_broadcast(&r->ready);
+    pthread_mutex_unlock(&r->lock);
+  }
+
+  FREEMEMORY(NULL, buffer);
+  FREEMEMORY(NULL, fields);
+  return NULL;
+}
+
+/*------------------------------ initInputReader -----------------------------
+ *
+ * @brief start nreaders threads parsing the blocks of idx; at most four
+ * blocks per reader are parsed ahead of the main thread
+ * @author zzhu
+ *
+ */
+
+inputreader_t*
+initInputReader(char *filename, inputindex_t *idx, int nreaders) {
+  inputreader_t *r;
+  int i;
+
+  r = ALLOCMEMORY(NULL, NULL, inputreader_t, 1);
+  r->filename = filename;
+  r->idx = idx;
+  r->fd = open(filename, O_RDONLY);
+  if(r->fd < 0) ig_die("cannot open file", filename);
+  r->nreaders = nreaders;
+  r->nslots = 4*nreaders;
+  r->slots = ALLOCMEMORY(NULL, NULL, inputslot_t, r->nslots);
+  memset(r->slots, 0, sizeof(inputslot_t)*r->nslots);
+  r->next = 0;
+  r->cur = 0;
+  r->row = 0;
+  r->stop = 0;
+  pthread_mutex_init(&r->lock, NULL);
+  pthread_cond_init(&r->ready, NULL);
+  pthread_cond_init(&r->free, NULL);
+
+  r->threads = ALLOCMEMORY(NULL, NULL, pthread_t, nreaders);
+  for(i=0; i < nreaders; i++) {
+    pthread_create(&r->threads[i], NULL, inputReaderThread, r);
+  }
+  return r;
+}
+
+/*---------------------------- readInputReaderRow ----------------------------
+ *
+ * @brief the next row in input order, as readInputRow returns it; chr
+ * points into the index. Returns the number of columns or 0 at the end
+ * @author zzhu
+ *
+ */
+
+Uint
+readInputReaderRow(inputreader_t *r, char **chr, int *pos, double **values,
+    int *nan) {
+  inputslot_t *s;
+  Uint i, ncols;
+
+  if(r->cur >= r->idx->n) {
+    FREEMEMORY(NULL, *values);
+    return 0;
+  }
+
+  s = &r->slots[r->cur % r->nslots];
+  if(r->row == 0) {
+    pthread_mutex_lock(&r->lock);
+    while(!s->ready) {
+      pthread_cond_wait(&r->ready, &r->lock);
+    }
+    pthread_mutex_unlock(&r->lock);
+  }
+
+  i = r->row++;
+  ncols = s->ncols[i];
+  if(ncols == 0) {
+    FREEMEMORY(NULL, *values);
+  } else {
+    *values = ALLOCMEMORY(NULL, *values, double, (ncols > 2) ? ncols : 2);
+    memcpy(*values, s->values + s->start[i], sizeof(double)*((ncols > 2) ? ncols : 2));
+    *nan = s->nan[i];
+    *pos = s->pos[i];
+    *chr = r->idx->blocks[r->cur].chr;
+  }
+
+  if(r->row == s->nrows) {
+    pthread_mutex_lock(&r->lock);
+    s->ready = 0;
+    r->cur++;
+    r->row = 0;
+    pthread_cond_broadcast(&r->free);
+    pthread_mutex_unlock(&r->lock);
+  }
+
+  return ncols;
+}
+
+/*---------------------------- destructInputReader ---------------------------
+ *
+ * @brief stop the readers, also before the end of the input, and free
+ * everything but the index
+ * @author zzhu
+ *
+ */
+
+void
+destructInputReader(inputreader_t *r) {
+  int i;
+
+  if(!r) return;
+  pthread_mutex_lock(&r->lock);
+  r->stop = 1;
+  pthread_cond_broadcast(&r->free);
+  pthread_mutex_unlock(&r->lock);
+  for(i=0; i < r->nreaders; i++) {
+    pthread_join(r->threads[i], NULL);
+  }
+
+  for(i=0; i < r->nslots; i++) {
+    FREEMEMORY(NULL, r->slots[i].pos);
+    FREEMEMORY(NULL, r->slots[i].nan);
+    FREEMEMORY(NULL, r->slots[i].ncols);
+    FREEMEMORY(NULL, r->slots[i].start);
+    FREEMEMORY(NULL, r->slots[i].values);
+  }
+  FREEMEMORY(NULL, r->slots);
+  FREEMEMORY(NULL, r->threads);
+  close(r->fd);
+  pthread_mutex_destroy(&r->lock);
+  pthread_cond_destroy(&r->ready);
+  pthread_cond_destroy(&r->free);
+  FREEMEMORY(NULL, r);
+}
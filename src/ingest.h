@@ -0,0 +1,84 @@
+#ifndef INGEST_H
+#define INGEST_H
+/*
+ *
+ *  ingest.h
+ *  parallel parsing of the text input matrix through a byte-offset index
+ *
+ *  The index is a sidecar text file <input>.m3i, built once by a scan for
+ *  line breaks and reused while the size and mtime of the input match:
+ *
+ *    #M3IDXv1  size  mtime  step
+ *    chr  offset  length  rows     one line per block
+ *
+ *  A block starts at a line and holds the rows of one chromosome, at most
+ *  about step bytes; every chromosome starts a new block. Reader threads
+ *  parse whole blocks into a ring of slots, the main thread takes the rows
+ *  in input order.
+ *
+ *  @author zzhu
+ *
+ */
+
+#include <stdint.h>
+#include <pthread.h>
+#include "basic-types.h"
+
+#define INGEST_MAGIC "#M3IDXv1"
+#define INGEST_STEP (4<<20)
+
+typedef struct {
+  char *chr;
+  uint64_t offset;
+  uint64_t length;
+  uint64_t rows;
+} inputblock_t;
+
+typedef struct {
+  uint64_t size;
+  int64_t mtime;
+  uint64_t n;
+  inputblock_t *blocks;
+} inputindex_t;
+
+/* the parsed rows of one block; row i has ncols[i] columns at
+ * values+start[i], laid out as in checkSetNAN */
+typedef struct {
+  Uint nrows;
+  Uint alloc;
+  int *pos;
+  int *nan;
+  Uint *ncols;
+  size_t *start;
+  size_t valloc;
+  double *values;
+  int ready;
+} inputslot_t;
+
+typedef struct {
+  char *filename;
+  inputindex_t *idx;
+  int fd;
+  int nreaders;
+  pthread_t *threads;
+  int nslots;
+  inputslot_t *slots;
+  uint64_t next; // next block claimed by a reader
+  uint64_t cur; // block read by the main thread
+  Uint row; // next row of cur
+  int stop;
+  pthread_mutex_t lock;
+  pthread_cond_t ready;
+  pthread_cond_t free;
+} inputreader_t;
+
+int checkSetNAN(char **fields, Uint nfields, double *values);
+
+inputindex_t* loadInputIndex(char *filename, int verbose);
+void destructInputIndex(inputindex_t *idx);
+
+inputreader_t* initInputReader(char *filename, inputindex_t *idx, int nreaders);
+Uint readInputReaderRow(inputreader_t *r, char **chr, int *pos, double **values, int *nan);
+void destructInputReader(inputreader_t *r);
+
+#endif
@@ -0,0 +1,380 @@
+/*
+ *
+ *  matcache.c
+ *  binary, memory-mapped cache of the methylation input matrix
+ *
+ *  The text input is converted once (metilene -C) and the cache is then
+ *  mapped read-only by every later pass, so no cell has to be parsed again.
+ *
+ *  @author zzhu
+ *
+ */
+
+#define _POSIX_C_SOURCE 200809L
+
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <math.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include "matcache.h"
+
+static const double p10[MATCACHE_MAXSCALE+1] = {1e0, 1e1, 1e2, 1e3, 1e4, 1e5,
+  1e6, 1e7, 1e8, 1e9};
+
+/*---------------------------------- mc_die ----------------------------------
+ *
+ * @brief report an i/o error on the cache and exit
+ * @author zzhu
+ *
+ */
+
+static void
+mc_die(char *msg, char *filename) {
+  fprintf(stderr, "matrix cache %s: %s. Exit forced.\n", filename, msg);
+  exit(-1);
+}
+
+/*-------------------------------- isMatCache --------------------------------
+ *
+ * @brief check the magic bytes to tell a matrix cache from a text matrix
+ * @author zzhu
+ *
+ */
+
+int
+isMatCache(char *filename) {
+  char magic[8];
+  FILE *fp = fopen(filename, "rb");
+  int ret = 0;
+
+  if(!fp) return 0;
+  if(fread(magic, 1, 8, fp) == 8 && memcmp(magic, MATCACHE_MAGIC, 8) == 0) {
+    ret = 1;
+  }
+  fclose(fp);
+  return ret;
+}
+
+/*------------------------------- openMatCache -------------------------------
+ *
+ * @brief map a matrix cache into memory; returns NULL if the file is not
+ * a matrix cache
+ * @author zzhu
+ *
+ */
+
+matcache_t*
+openMatCache(char *filename) {
+  matcache_t *mc;
+  struct stat st;
+  uint64_t *hdr, i;
+  char *names;
+  int fd;
+
+  if(!isMatCache(filename)) return NULL;
+
+  fd = open(filename, O_RDONLY);
+  if(fd < 0 || fstat(fd, &st) != 0) mc_die("cannot open file", filename);
+  if((size_t)st.st_size < MATCACHE_HEADERSIZE) mc_die("truncated header", filename);
+
+  mc = calloc(1, sizeof(matcache_t));
+  mc->filename = filename;
+  mc->size = st.st_size;
+  mc->map = mmap(NULL, mc->size, PROT_READ, MAP_SHARED, fd, 0);
+  close(fd);
+  if(mc->map == MAP_FAILED) mc_die("mmap failed", filename);
+#ifdef POSIX_MADV_SEQUENTIAL
+  posix_madvise(mc->map, mc->size, POSIX_MADV_SEQUENTIAL);
+#endif
+
+  hdr = (uint64_t*)(mc->map + 8);
+  mc->nrows = hdr[0];
+  mc->nsamples = hdr[1];
+  mc->nchr = hdr[2];
+  mc->nexceptions = hdr[9];
+  if(hdr[6] > mc->size ||
+     hdr[3] + mc->nrows*mc->nsamples*sizeof(int32_t) > mc->size ||
+     hdr[4] + mc->nrows*sizeof(int32_t) > mc->size ||
+     hdr[5] + mc->nrows*sizeof(int32_t) > mc->size ||
+     hdr[7] + mc->nrows*sizeof(int8_t) > mc->size ||
+     hdr[8] + mc->nexceptions*mc->nsamples*sizeof(double) > mc->size) {
+    mc_die("truncated file", filename);
+  }
+  mc->values = (int32_t*)(mc->map + hdr[3]);
+  mc->chrid = (int32_t*)(mc->map + hdr[4]);
+  mc->pos = (int32_t*)(mc->map + hdr[5]);
+  mc->scale = (int8_t*)(mc->map + hdr[7]);
+  mc->exceptions = (double*)(mc->map + hdr[8]);
+
+  mc->samples = malloc(sizeof(char*)*(mc->nsamples+1));
+  mc->chrnames = malloc(sizeof(char*)*(mc->nchr+1));
+  names = (char*)(mc->map + hdr[6]);
+  for(i=0; i < mc->nsamples; i++) {
+    mc->samples[i] = names;
+    names += strlen(names)+1;
+  }
+  for(i=0; i < mc->nchr; i++) {
+    mc->chrnames[i] = names;
+    names += strlen(names)+1;
+  }
+  mc->row = 0;
+
+  return mc;
+}
+
+/*------------------------------- closeMatCache ------------------------------
+ *
+ * @brief unmap a matrix cache
+ * @author zzhu
+ *
+ */
+
+void
+closeMatCache(matcache_t *mc) {
+  if(!mc) return;
+  munmap(mc->map, mc->size);
+  free(mc->samples);
+  free(mc->chrnames);
+  free(mc);
+}
+
+/*------------------------------ getMatCacheRow ------------------------------
+ *
+ * @brief decode the values of row r into values[0..nsamples), NaN for
+ * missing
+ * @author zzhu
+ *
+ */
+
+void
+getMatCacheRow(matcache_t *mc, uint64_t r, double *values) {
+  int32_t *row = mc->values + r*mc->nsamples;
+  uint64_t k;
+  double d;
+
+  if(mc->scale[r] < 0) {
+    memcpy(values, mc->exceptions + (uint64_t)row[0]*mc->nsamples, 
+        sizeof(double)*mc->nsamples);
+    return;
+  }
+  d = p10[mc->scale[r]];
+  for(k=0; k < mc->nsamples; k++) {
+    values[k] = (row[k] == MATCACHE_NA) ? NAN : row[k] / d;
+  }
+}
+
+/*------------------------------ readMatCacheRow -----------------------------
+ *
+ * @brief fetch the next row; values are laid out as in checkSetNAN, i.e.
+ * values[0] and values[1] are -1 and the samples start at index 2.
+ * chr points into the mapping and must not be freed.
+ * Returns the number of NaNs in the row or -1 at the end of the cache.
+ * @author zzhu
+ *
+ */
+
+int
+readMatCacheRow(matcache_t *mc, char **chr, int *pos, double *values) {
+  uint64_t k;
+  int nan = 0;
+
+  if(mc->row >= mc->nrows) return -1;
+
+  *chr = mc->chrnames[mc->chrid[mc->row]];
+  *pos = mc->pos[mc->row];
+  values[0] = -1;
+  values[1] = -1;
+  getMatCacheRow(mc, mc->row, values+2);
+  for(k=0; k < mc->nsamples; k++) {
+    if(values[k+2] != values[k+2]) nan++;
+  }
+  mc->row++;
+
+  return nan;
+}
+
+/*-------------------------------- encodeRow ---------------------------------
+ *
+ * @brief fixed-point values of a row: the fewest decimals with which every
+ * value is decoded to the same double. Returns the decimals or -1 if the
+ * row does not fit
+ * @author zzhu
+ *
+ */
+
+static int
+encodeRow(double *values, uint64_t n, int32_t *q) {
+  int scale = 0;
+  uint64_t k;
+  double x;
+
+  for(k=0; k < n; k++) {
+    if(values[k] != values[k]) continue;
+    for(; scale <= MATCACHE_MAXSCALE; scale++) {
+      x = values[k]*p10[scale];
+      if(fabs(x) < INT32_MAX && llround(x)/p10[scale] == values[k]) break;
+    }
+    if(scale > MATCACHE_MAXSCALE) return -1;
+  }
+
+  for(k=0; k < n; k++) {
+    if(values[k] != values[k]) {
+      q[k] = MATCACHE_NA;
+      continue;
+    }
+    x = values[k]*p10[scale];
+    if(!(fabs(x) < INT32_MAX)) return -1;
+    q[k] = (int32_t)llround(x);
+    //-0.0 would come back as 0.0
+    if(q[k]/p10[scale] != values[k] || (q[k] == 0 && signbit(values[k]))) return -1;
+  }
+  return scale;
+}
+
+/*---------------------------- initMatCacheWriter ----------------------------
+ *
+ * @brief start writing a matrix cache; the values are streamed to disk,
+ * the index is kept in memory until finishMatCacheWriter
+ * @author zzhu
+ *
+ */
+
+matcachewriter_t*
+initMatCacheWriter(char *filename, char **samples, uint64_t nsamples) {
+  matcachewriter_t *w = calloc(1, sizeof(matcachewriter_t));
+  unsigned char hdr[MATCACHE_HEADERSIZE];
+  uint64_t i;
+
+  w->filename = filename;
+  w->fp = fopen(filename, "wb");
+  if(!w->fp) mc_die("cannot open file for writing", filename);
+
+  /* header is rewritten once the number of rows is known */
+  memset(hdr, 0, MATCACHE_HEADERSIZE);
+  if(fwrite(hdr, 1, MATCACHE_HEADERSIZE, w->fp) != MATCACHE_HEADERSIZE) {
+    mc_die("write failed", filename);
+  }
+
+  w->nsamples = nsamples;
+  w->samples = malloc(sizeof(char*)*nsamples);
+  for(i=0; i < nsamples; i++) {
+    w->samples[i] = malloc(strlen(samples[i])+1);
+    strcpy(w->samples[i], samples[i]);
+  }
+  w->row = malloc(sizeof(int32_t)*(nsamples ? nsamples : 1));
+  w->exfp = tmpfile();
+  if(!w->exfp) mc_die("cannot open a temporary file", filename);
+
+  return w;
+}
+
+/*---------------------------- appendMatCacheRow -----------------------------
+ *
+ * @brief append a row given in the layout of checkSetNAN
+ * @author zzhu
+ *
+ */
+
+void
+appendMatCacheRow(matcachewriter_t *w, char *chr, int pos, double *values) {
+  uint64_t k;
+
+  if(w->nrows == w->alloc) {
+    w->alloc = w->alloc ? w->alloc*2 : 1<<16;
+    w->chrid = realloc(w->chrid, sizeof(int32_t)*w->alloc);
+    w->pos = realloc(w->pos, sizeof(int32_t)*w->alloc);
+    w->scale = realloc(w->scale, sizeof(int8_t)*w->alloc);
+    if(!w->chrid || !w->pos || !w->scale) mc_die("out of memory", w->filename);
+  }
+
+  /* input is sorted by chromosome, so only the last name needs checking */
+  if(w->nchr == 0 || strcmp(w->chrnames[w->nchr-1], chr) != 0) {
+    w->chrnames = realloc(w->chrnames, sizeof(char*)*(w->nchr+1));
+    w->chrnames[w->nchr] = malloc(strlen(chr)+1);
+    strcpy(w->chrnames[w->nchr], chr);
+    w->nchr++;
+  }
+
+  w->scale[w->nrows] = encodeRow(values+2, w->nsamples, w->row);
+  if(w->scale[w->nrows] < 0) {
+    if(fwrite(values+2, sizeof(double), w->nsamples, w->exfp) != w->nsamples) {
+      mc_die("write failed", w->filename);
+    }
+    memset(w->row, 0, sizeof(int32_t)*w->nsamples);
+    w->row[0] = (int32_t)w->nexceptions++;
+  }
+  if(fwrite(w->row, sizeof(int32_t), w->nsamples, w->fp) != w->nsamples) {
+    mc_die("write failed", w->filename);
+  }
+  w->chrid[w->nrows] = w->nchr-1;
+  w->pos[w->nrows] = pos;
+  w->nrows++;
+}
+
+/*---------------------------- finishMatCacheWriter --------------------------
+ *
+ * @brief write index and names, patch the header and release the writer
+ * @author zzhu
+ *
+ */
+
+void
+finishMatCacheWriter(matcachewriter_t *w) {
+  uint64_t hdr[10], i;
+  long off;
+  size_t len;
+  char buf[1<<16];
+  static const char pad[8] = {0};
+
+  off = ftell(w->fp);
+  if(off % 8) fwrite(pad, 1, 8 - off % 8, w->fp);
+  hdr[4] = ftell(w->fp);
+  fwrite(w->chrid, sizeof(int32_t), w->nrows, w->fp);
+  off = ftell(w->fp);
+  if(off % 8) fwrite(pad, 1, 8 - off % 8, w->fp);
+  hdr[5] = ftell(w->fp);
+  fwrite(w->pos, sizeof(int32_t), w->nrows, w->fp);
+  hdr[7] = ftell(w->fp);
+  fwrite(w->scale, sizeof(int8_t), w->nrows, w->fp);
+  off = ftell(w->fp);
+  if(off % 8) fwrite(pad, 1, 8 - off % 8, w->fp);
+  hdr[8] = ftell(w->fp);
+  rewind(w->exfp);
+  while((len = fread(buf, 1, sizeof(buf), w->exfp)) > 0) {
+    if(fwrite(buf, 1, len, w->fp) != len) mc_die("write failed", w->filename);
+  }
+  fclose(w->exfp);
+  hdr[9] = w->nexceptions;
+  hdr[6] = ftell(w->fp);
+  for(i=0; i < w->nsamples; i++) {
+    fwrite(w->samples[i], 1, strlen(w->samples[i])+1, w->fp);
+  }
+  for(i=0; i < w->nchr; i++) {
+    fwrite(w->chrnames[i], 1, strlen(w->chrnames[i])+1, w->fp);
+  }
+
+  hdr[0] = w->nrows;
+  hdr[1] = w->nsamples;
+  hdr[2] = w->nchr;
+  hdr[3] = MATCACHE_HEADERSIZE;
+  fseek(w->fp, 0, SEEK_SET);
+  if(fwrite(MATCACHE_MAGIC, 1, 8, w->fp) != 8 ||
+     fwrite(hdr, sizeof(uint64_t), 10, w->fp) != 10 ||
+     fclose(w->fp) != 0) {
+    mc_die("write failed", w->filename);
+  }
+
+  for(i=0; i < w->nsamples; i++) free(w->samples[i]);
+  for(i=0; i < w->nchr; i++) free(w->chrnames[i]);
+  free(w->samples);
+  free(w->chrnames);
+  free(w->chrid);
+  free(w->pos);
+  free(w->scale);
+  free(w->row);
+  free(w);
+}
@@ -0,0 +1,86 @@
+#ifndef MATCACHE_H
+#define MATCACHE_H
+/*
+ *
+ *  matcache.h
+ *  binary, memory-mapped cache of the methylation input matrix
+ *
+ *  Layout (native byte order, 8-byte aligned blocks):
+ *    header   magic[8] "M3MATv3", nrows, nsamples, nchr, offset of
+ *             values, chrid, pos and names block, offset of scale and
+ *             exceptions, nexceptions (uint64 each)
+ *    values   int32 [nrows x nsamples], row-major, fixed point: a cell
+ *             is q / 10^scale[row], MATCACHE_NA for missing
+ *    chrid    int32 [nrows], index into the chromosome names
+ *    pos      int32 [nrows]
+ *    scale    int8 [nrows], decimals of the row, -1 if the row is kept
+ *             as doubles: then its first cell is the index of the row
+ *             in exceptions
+ *    excepts  double [nexceptions x nsamples]
+ *    names    nsamples sample names followed by nchr chromosome
+ *             names, each NUL-terminated
+ *
+ *  A row gets the fewest decimals (at most 9) with which every value
+ *  comes back as the same double that was parsed from the text, e.g. 3
+ *  for beta values like 0.123, so the cache is lossless and gives the
+ *  same results as the text input at half the size of doubles. Rows
+ *  that do not fit in 32 bits this way are stored as doubles.
+ *
+ *  @author zzhu
+ *
+ */
+
+#include <stdint.h>
+#include <stdio.h>
+
+#define MATCACHE_MAGIC "M3MATv3"
+#define MATCACHE_HEADERSIZE 88
+#define MATCACHE_NA INT32_MIN
+#define MATCACHE_MAXSCALE 9
+
+typedef struct {
+  char *filename;
+  size_t size;
+  unsigned char *map;
+  uint64_t nrows;
+  uint64_t nsamples;
+  uint64_t nchr;
+  int32_t *values;
+  int32_t *chrid;
+  int32_t *pos;
+  int8_t *scale;
+  double *exceptions;
+  uint64_t nexceptions;
+  char **samples;
+  char **chrnames;
+  uint64_t row;
+} matcache_t;
+
+typedef struct {
+  char *filename;
+  FILE *fp;
+  uint64_t nrows;
+  uint64_t nsamples;
+  uint64_t nchr;
+  uint64_t alloc;
+  int32_t *chrid;
+  int32_t *pos;
+  int8_t *scale;
+  char **samples;
+  char **chrnames;
+  int32_t *row;
+  FILE *exfp; // exception rows until finishMatCacheWriter
+  uint64_t nexceptions;
+} matcachewriter_t;
+
+int isMatCache(char *filename);
+matcache_t* openMatCache(char *filename);
+void closeMatCache(matcache_t *mc);
+void getMatCacheRow(matcache_t *mc, uint64_t r, double *values);
+int readMatCacheRow(matcache_t *mc, char **chr, int *pos, double *values);
+
+matcachewriter_t* initMatCacheWriter(char *filename, char **samples, uint64_t nsamples);
+void appendMatCacheRow(matcachewriter_t *w, char *chr, int pos, double *values);
+void finishMatCacheWriter(matcachewriter_t *w);
+
+#endif
@@ -7,6 +7,9 @@
  *  @date 09/09/2014 08:54:52 AM CEST
  *  
  */
+
+#define _POSIX_C_SOURCE 200809L
+
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
@@ -23,10 +26,14 @@
 #include "fileio.h"
 #include "metseg.h"
 #include "mtc.h"
+#include "matcache.h"
 #include <string.h>
 #include "mathematics.h"
 #include "vstack.h"
 #include "segmentstack.h"
+#include "threadpool.h"
+#include "ingest.h"
+#include "zinput.h"
 #include <time.h>
 #include <ctype.h>
 #include <float.h>
@@ -343,6 +350,31 @@ calcMax(double *l1, double *l2, double c1, double c2, int a, int b,
   return d; 
 }
 
+/*------------------------------- quadrantMax --------------------------------
+ *    
+ * @brief largest difference between both groups over the four quadrants,
+ * given the quadrant counts c and the counts l on the quadrant borders
+ * @author Frank Juehling and Steve Hoffmann 
+ *   
+ */
+
+double
+quadrantMax(double l[2][5], double c[2][4], int m, int n) {
+
+  double d[4];
+
+  d[0]=calcMax(l[0],l[1],c[0][0],c[1][0],2,4,m,n);
+  d[1]=calcMax(l[0],l[1],c[0][1],c[1][1],1,4,m,n);
+  d[2]=calcMax(l[0],l[1],c[0][2],c[1][2],2,3,m,n);
+  d[3]=calcMax(l[0],l[1],c[0][3],c[1][3],1,3,m,n);
+
+  //fprintf(stdout, "d[0]:%f, d[1]:%f, d[2]:%f, d[3]:%f, d[4]:%f\n", d[0], d[1], d[2], d[3], d[4]);
+
+  double D = MAX(MAX(MAX(d[0],d[1]),d[2]),d[3]);
+
+  return D;  
+}
+
 /*--------------------------------- counter ----------------------------------
  *    
  * @brief count the data points in the four quadrants with center (x,y)
@@ -354,22 +386,10 @@ double
 counter(double x, double y, double *x0, double *x1, int m, 
     double *y0, double *y1, int n) {
 
-  double **c, **l;
+  double c[2][4] = {{0,0,0,0},{0,0,0,0}};
+  double l[2][5] = {{0,0,0,0,0},{0,0,0,0,0}};
   int i;
 
-  c = ALLOCMEMORY(NULL, NULL, double*, 2);
-  l = ALLOCMEMORY(NULL, NULL, double*, 2);
-
-  c[0] = ALLOCMEMORY(NULL, NULL, double, 4);
-  c[1] = ALLOCMEMORY(NULL, NULL, double, 4);
-  l[0] = ALLOCMEMORY(NULL, NULL, double, 5);
-  l[1] = ALLOCMEMORY(NULL, NULL, double, 5);
-  memset(c[0], 0, sizeof(double)*4);
-  memset(c[1], 0, sizeof(double)*4);
-  memset(l[0], 0, sizeof(double)*5);
-  memset(l[1], 0, sizeof(double)*5);
-
-
   for(i=0; i < m; i++) {
     //central point
     if(x0[i] == x && x1[i] == y) {l[0][0]++; continue;}  
@@ -418,25 +438,141 @@ counter(double x, double y, double *x0, double *x1, int m,
     }
   }
 
-  double d[4];
+  return quadrantMax(l, c, m, n);
+}
 
-  d[0]=calcMax(l[0],l[1],c[0][0],c[1][0],2,4,m,n);
-  d[1]=calcMax(l[0],l[1],c[0][1],c[1][1],1,4,m,n);
-  d[2]=calcMax(l[0],l[1],c[0][2],c[1][2],2,3,m,n);
-  d[3]=calcMax(l[0],l[1],c[0][3],c[1][3],1,3,m,n);
+/*------------------------------ cmp_kspoint -------------------------------
+ *    
+ * @brief order points by value or by position
+ * @author zzhu
+ *   
+ */
 
-  //fprintf(stdout, "d[0]:%f, d[1]:%f, d[2]:%f, d[3]:%f, d[4]:%f\n", d[0], d[1], d[2], d[3], d[4]);
+static int cmp_kspoint_v(const void *a, const void *b){
+  double x = ((const kspoint_t*)a)->v;
+  double y = ((const kspoint_t*)b)->v;
+  return (x > y) - (x < y);
+}
 
-  double D = MAX(MAX(MAX(d[0],d[1]),d[2]),d[3]);
+static int cmp_kspoint_pos(const void *a, const void *b){
+  double x = ((const kspoint_t*)a)->pos;
+  double y = ((const kspoint_t*)b)->pos;
+  return (x > y) - (x < y);
+}
+
+/*------------------------------ fenwickAdd/Sum ------------------------------
+ *    
+ * @brief binary indexed tree over the value ranks 1..r
+ * @author zzhu
+ *   
+ */
 
-  FREEMEMORY(NULL, c[0]);
-  FREEMEMORY(NULL, c[1]);
-  FREEMEMORY(NULL, l[0]);
-  FREEMEMORY(NULL, l[1]);
-  FREEMEMORY(NULL, c);
-  FREEMEMORY(NULL, l);
+static void fenwickAdd(int *t, int r, int i, int d){
+  for(; i <= r; i += i & -i) t[i] += d;
+}
 
-  return D;  
+static int fenwickSum(int *t, int i){
+  int s = 0;
+  for(; i > 0; i -= i & -i) s += t[i];
+  return s;
+}
+
+/*------------------------------- counterSweep -------------------------------
+ *    
+ * @brief the maximum of counter over all centers of both groups, as
+ * d[0] (centers in x) and d[1] (centers in y). The points are swept by
+ * position with a binary indexed tree over the value ranks, which gives 
+ * the same integer counts as counter in O((m+n) log(m+n)) instead of 
+ * O((m+n)^2). Returns 0 if a value or position is NaN, then the caller
+ * falls back to counter.
+ * @author zzhu
+ *   
+ */
+
+int
+counterSweep(double *x0, double *x1, int m, double *y0, double *y1, int n,
+    double *d, kscratch_t *sc) {
+
+  int N = m+n, R = 0, i, j, k, q;
+  int *bit[2], *grp[2], *cnt[2], *less[2];
+  int ins[2] = {0,0}, tot[2], gsize[2];
+  kspoint_t *p;
+
+  growScratch(sc, 0, N);
+  p = sc->pts;
+  for(i=0; i < m; i++) {
+    p[i].v = x0[i]; p[i].pos = x1[i]; p[i].set = 0;
+  }
+  for(i=0; i < n; i++) {
+    p[m+i].v = y0[i]; p[m+i].pos = y1[i]; p[m+i].set = 1;
+  }
+  for(i=0; i < N; i++) {
+    if(isnan(p[i].v) || isnan(p[i].pos)) return 0;
+  }
+
+  //ranks 1..R of the distinct values
+  qsort(p, N, sizeof(kspoint_t), cmp_kspoint_v);
+  for(i=0; i < N; i++) {
+    if(i == 0 || p[i].v != p[i-1].v) R++;
+    p[i].rank = R;
+  }
+
+  for(k=0; k < 2; k++) {
+    bit[k] = &sc->ints[(size_t)k*(R+2)];
+    grp[k] = &sc->ints[(size_t)(2+k)*(R+2)];
+    cnt[k] = &sc->ints[(size_t)(4+k)*(R+2)];
+    less[k] = &sc->ints[(size_t)(6+k)*(R+2)];
+  }
+  memset(sc->ints, 0, sizeof(int)*8*(R+2));
+  for(i=0; i < N; i++) {
+    cnt[p[i].set][p[i].rank]++;
+  }
+  for(k=0; k < 2; k++) {
+    for(i=1; i <= R; i++) {
+      less[k][i+1] = less[k][i] + cnt[k][i];
+    }
+  }
+  tot[0] = m;
+  tot[1] = n;
+
+  qsort(p, N, sizeof(kspoint_t), cmp_kspoint_pos);
+  for(i=0; i < N; i = j) {
+    //points i..j-1 share a position
+    gsize[0] = gsize[1] = 0;
+    for(j=i; j < N && p[j].pos == p[i].pos; j++) {
+      fenwickAdd(grp[p[j].set], R, p[j].rank, 1);
+      gsize[p[j].set]++;
+    }
+
+    for(q=i; q < j; q++) {
+      double c[2][4], l[2][5];
+      int r = p[q].rank;
+      for(k=0; k < 2; k++) {
+        int ltlt = fenwickSum(bit[k], r-1);
+        int eqlt = fenwickSum(bit[k], r) - ltlt;
+        int gtlt = ins[k] - ltlt - eqlt;
+        int lteq = fenwickSum(grp[k], r-1);
+        int eqeq = fenwickSum(grp[k], r) - lteq;
+        int gteq = gsize[k] - lteq - eqeq;
+        int ltgt = less[k][r] - ltlt - lteq;
+        int eqgt = cnt[k][r] - eqlt - eqeq;
+        int gtgt = tot[k] - less[k][r] - cnt[k][r] - gtlt - gteq;
+
+        l[k][0] = eqeq; l[k][1] = eqlt; l[k][2] = eqgt; 
+        l[k][3] = lteq; l[k][4] = gteq;
+        c[k][0] = gtgt; c[k][1] = gtlt; c[k][2] = ltgt; c[k][3] = ltlt;
+      }
+      d[p[q].set] = MAX(d[p[q].set], quadrantMax(l, c, m, n));
+    }
+
+    for(q=i; q < j; q++) {
+      fenwickAdd(grp[p[q].set], R, p[q].rank, -1);
+      fenwickAdd(bit[p[q].set], R, p[q].rank, 1);
+      ins[p[q].set]++;
+    }
+  }
+
+  return 1;
 }
 
 /*--------------------------------- kstest2d ---------------------------------
@@ -448,19 +584,22 @@ counter(double x, double y, double *x0, double *x1, int m,
 
 void 
 kstest2d(double *x0, double *x1, int m, double *y0, double *y1, int n, 
-    double *kstest) {
+    double *kstest, kscratch_t *sc) {
 
   double cor[] = {0.0,0.0};
   double ks[] = {0.0,0.0};
   double d[] = {0.0,0.0};
   double dl1, dl2, s;
 
-  for(int j=0; j < m; j++) {
-    d[0] = MAX(d[0],counter(x0[j],x1[j],x0,x1,m,y0,y1,n));
-  }
+  if(!counterSweep(x0, x1, m, y0, y1, n, d, sc)) {
+    d[0] = d[1] = 0.0;
+    for(int j=0; j < m; j++) {
+      d[0] = MAX(d[0],counter(x0[j],x1[j],x0,x1,m,y0,y1,n));
+    }
 
-  for(int j=0; j< n; j++) {
-    d[1]=  MAX(d[1],counter(y0[j],y1[j],x0,x1,m,y0,y1,n));
+    for(int j=0; j< n; j++) {
+      d[1]=  MAX(d[1],counter(y0[j],y1[j],x0,x1,m,y0,y1,n));
+    }
   }
 
   ks[1]=(d[0]+d[1])*0.5;
@@ -479,6 +618,141 @@ kstest2d(double *x0, double *x1, int m, double *y0, double *y1, int n,
   return;
 }
 
+/*------------------------------- initScratch --------------------------------
+ *    
+ * @brief allocate empty kstest scratch space for one thread
+ * @author zzhu
+ *   
+ */
+
+kscratch_t*
+initScratch() {
+  kscratch_t *sc = ALLOCMEMORY(NULL, NULL, kscratch_t, 1);
+  sc->la[0] = sc->la[1] = sc->lb[0] = sc->lb[1] = NULL;
+  sc->size = 0;
+  sc->pts = NULL;
+  sc->ints = NULL;
+  sc->points = 0;
+  sc->memo = NULL;
+  sc->memosize = 0;
+  sc->memoused = 0;
+  sc->gen = 0;
+  return sc;
+}
+
+/*------------------------------ destructScratch -------------------------------
+ *    
+ * @brief free the kstest scratch space of one thread
+ * @author zzhu
+ *   
+ */
+
+void
+destructScratch(kscratch_t *sc) {
+  if(sc->size > 0) {
+    FREEMEMORY(NULL, sc->la[0]);
+    FREEMEMORY(NULL, sc->la[1]);
+    FREEMEMORY(NULL, sc->lb[0]);
+    FREEMEMORY(NULL, sc->lb[1]);
+  }
+  if(sc->points > 0) {
+    FREEMEMORY(NULL, sc->pts);
+    FREEMEMORY(NULL, sc->ints);
+  }
+  if(sc->memosize > 0) {
+    FREEMEMORY(NULL, sc->memo);
+  }
+  FREEMEMORY(NULL, sc);
+}
+
+/*------------------------------ initFilterStats -------------------------------
+ *    
+ * @brief zeroed rejection counters for one thread
+ * @author zzhu
+ *   
+ */
+
+filterstats_t*
+initFilterStats() {
+  filterstats_t *f = ALLOCMEMORY(NULL, NULL, filterstats_t, 1);
+  memset(f, 0, sizeof(filterstats_t));
+  return f;
+}
+
+/*------------------------------ printFilterStats ------------------------------
+ *    
+ * @brief report how many candidates each check dropped before kstest
+ * @author zzhu
+ *   
+ */
+
+void
+printFilterStats(filterstats_t *f) {
+  fprintf(stderr, "Combinations with too few sig. CpGs: %ld\n", f->sigcpgs);
+  fprintf(stderr, "Candidate intervals: %ld\n", f->candidates);
+  fprintf(stderr, "  dropped by CpG number: %ld\n", f->mincpgs);
+  fprintf(stderr, "  dropped by trend: %ld\n", f->trend);
+  fprintf(stderr, "  dropped by valley: %ld\n", f->valley);
+  fprintf(stderr, "  kstests run: %ld, reused: %ld\n", f->tested, f->reused);
+}
+
+/*------------------------------ initChunkStats ------------------------------
+ *    
+ * @brief zeroed chunk statistics for one thread
+ * @author zzhu
+ *   
+ */
+
+chunkstats_t*
+initChunkStats() {
+  chunkstats_t *cs = ALLOCMEMORY(NULL, NULL, chunkstats_t, 1);
+  memset(cs, 0, sizeof(chunkstats_t));
+  return cs;
+}
+
+/*------------------------------ printChunkStats -----------------------------
+ *    
+ * @brief report chunk sizes and segmentation times, e.g. to find the chunks
+ * that keep one thread busy
+ * @author zzhu
+ *   
+ */
+
+void
+printChunkStats(chunkstats_t *cs) {
+  fprintf(stderr, "Chunks segmented: %ld, %ld CpGs\n", cs->chunks, cs->cpgs);
+  fprintf(stderr, "  largest: %d CpGs, mean: %.1f CpGs\n", cs->maxcpgs, 
+      cs->chunks ? (double)cs->cpgs/cs->chunks : 0);
+  fprintf(stderr, "  segmentation time: %.2fs, slowest chunk: %.3fs for %d CpGs\n", 
+      cs->seconds, cs->maxseconds, cs->slowcpgs);
+}
+
+/*-------------------------------- growScratch ---------------------------------
+ *    
+ * @brief make the value and position arrays of the scratch space hold at
+ * least size entries per group, and the sweep of counterSweep at least
+ * points points
+ * @author zzhu
+ *   
+ */
+
+void
+growScratch(kscratch_t *sc, size_t size, size_t points) {
+  if(size > sc->size) {
+    sc->size = MAX(size, 2*sc->size);
+    sc->la[0] = ALLOCMEMORY(NULL, sc->la[0], double, sc->size);
+    sc->la[1] = ALLOCMEMORY(NULL, sc->la[1], double, sc->size);
+    sc->lb[0] = ALLOCMEMORY(NULL, sc->lb[0], double, sc->size);
+    sc->lb[1] = ALLOCMEMORY(NULL, sc->lb[1], double, sc->size);
+  }
+  if(points > sc->points) {
+    sc->points = MAX(points, 2*sc->points);
+    sc->pts = ALLOCMEMORY(NULL, sc->pts, kspoint_t, sc->points);
+    //four trees and two count arrays over at most points+2 ranks
+    sc->ints = ALLOCMEMORY(NULL, sc->ints, int, 8*(sc->points+2));
+  }
+}
+
 /*---------------------------------- kstest ----------------------------------
  *    
  * @brief calculated the ks test
@@ -491,10 +765,8 @@ void kstest(segment_t *seg , int a, int b, char mindiff, char mincpgs, char test
 
   int i,j;
   int l = b-a+1;
-  double **la;
-  double **lb;
-  double *x;
-  double *y;
+  double *la[2];
+  double *lb[2];
   double mean1=0;
   double mean2=0;
   double meandiff = 0;
@@ -503,6 +775,7 @@ void kstest(segment_t *seg , int a, int b, char mindiff, char mincpgs, char test
   double dl = l;
   double p = 2;
   double faskstest[2] = {0,0};
+  kscratch_t *sc = nfo->scratch;
 
   //mincpgs set to false by default so this condition is never fullfilled
 
@@ -513,20 +786,11 @@ void kstest(segment_t *seg , int a, int b, char mindiff, char mincpgs, char test
   // }
   //debug
   //  fprintf(stderr, "kstest for: %d\n",l);
-  la = ALLOCMEMORY(NULL, NULL, double*, 2);
-  lb = ALLOCMEMORY(NULL, NULL, double*, 2);
-
-  la[0] = ALLOCMEMORY(NULL, NULL, double, l*noA);
-  la[1] = ALLOCMEMORY(NULL, NULL, double, l*noA);
-  lb[0] = ALLOCMEMORY(NULL, NULL, double, l*noB);
-  lb[1] = ALLOCMEMORY(NULL, NULL, double, l*noB);
-  memset(la[0], 0, sizeof(double)*l*noA);
-  memset(la[1], 0, sizeof(double)*l*noA);
-  memset(lb[0], 0, sizeof(double)*l*noB);
-  memset(lb[1], 0, sizeof(double)*l*noB);
-
-  x = ALLOCMEMORY(NULL, NULL, double, l);
-  y = ALLOCMEMORY(NULL, NULL, double, l);
+  growScratch(sc, l*MAX(noA,noB), 0);
+  la[0] = sc->la[0];
+  la[1] = sc->la[1];
+  lb[0] = sc->lb[0];
+  lb[1] = sc->lb[1];
 
   ks[0]=0;ks[1]=0;ks[2]=0;
 
@@ -535,74 +799,58 @@ void kstest(segment_t *seg , int a, int b, char mindiff, char mincpgs, char test
       la[0][((i-a)*noA)+j]=seg->value[i][grpA[j]];
       la[1][((i-a)*noA)+j]=seg->pos[i];
       mean1+=seg->value[i][grpA[j]];
-      x[i-a] += seg->value[i][grpA[j]];
     }
-    x[i-a]/=dl1;
   }
   for(i=a; i<=b; i++) {
     for(j=0;j<noB;j++) {
       lb[0][((i-a)*noB)+j]=seg->value[i][grpB[j]];
       lb[1][((i-a)*noB)+j]=seg->pos[i];
       mean2+=seg->value[i][grpB[j]];
-      y[i-a] += seg->value[i][grpB[j]];
     }
-    y[i-a]/=dl2;
   }
   int u = mannwhitney( la[0], l*noA , lb[0], l*noB);
   p = mannwhitneyPvalue(u, l*noA, l*noB, nfo->MWU, MAXM, MAXN);
  // fprintf(stdout,"pVALUE %f\n",p);
   
-
   mean1/=dl1*dl;
   mean2/=dl2*dl;
   meandiff = mean1-mean2;
   seg->methA=-1.0;
   seg->methB=-1.0;
   
-  kstest2d(la[0], la[1], l*noA, lb[0],lb[1], l*noB, faskstest);
+  kstest2d(la[0], la[1], l*noA, lb[0],lb[1], l*noB, faskstest, sc);
 
   ks[0]=faskstest[0];
   ks[1]=meandiff;
   ks[2]=p;
-
-  FREEMEMORY(NULL, la[0]);
-  FREEMEMORY(NULL, la[1]);
-  FREEMEMORY(NULL, lb[0]);
-  FREEMEMORY(NULL, lb[1]);
-  FREEMEMORY(NULL, la);
-  FREEMEMORY(NULL, lb);
-  FREEMEMORY(NULL, x);
-  FREEMEMORY(NULL, y);
-
 }
 
-/*---------------------------------- kstest ----------------------------------
+/*--------------------------- concatFloatsToString ---------------------------
  *    
- * @brief calculated the means
- * @author Frank Juehling and Steve Hoffmann 
+ * @brief write y as "%.3f" separated by sep into the buffer *x of *len
+ * bytes, which is grown if needed and may be reused by the next call
+ * @author zzhu
  *   
  */
 
-void concatFloatsToString(char **x, float *y, size_t size, char sep) {
-    size_t total_length = 0;
-    for (size_t i = 0; i < size; ++i) {
-        total_length += snprintf(NULL, 0, "%.3f", y[i]) + 1;
-    }
-    total_length -= 1;
+void concatFloatsToString(char **x, size_t *len, float *y, size_t size, char sep) {
+    // "%.3f" of a float takes at most 47 characters
+    size_t need = size*48 + 1;
+    char *ptr;
 
-    *x = (char *)malloc(total_length + 1);
+    if (*x == NULL || *len < need) {
+        *x = ALLOCMEMORY(NULL, *x, char, need);
+        *len = need;
+    }
 
-    char *ptr = *x;
+    ptr = *x;
     for (size_t i = 0; i < size; ++i) {
-        int written = snprintf(ptr, total_length + 1, "%.3f", y[i]);
-        ptr += written;
-        total_length -= written;
-        if (total_length > 0) {
-          *ptr = sep;
-          ++ptr;
-          --total_length;
+        if (i > 0) {
+          *ptr++ = sep;
         }
+        ptr += sprintf(ptr, "%.3f", y[i]);
     }
+    *ptr = 0;
 }
 
 void outputImputedValues(char **x, double *y, size_t size, char sep) {
@@ -628,7 +876,14 @@ void outputImputedValues(char **x, double *y, size_t size, char sep) {
     }
 }
 
-void means(segment_t *seg , int a, int b, int ***groupID, int **groupSize, int groupNumber, int **subgroupID, int *subgroupSize, int subgroupNumber, char **meansA, char **meansB){
+/*---------------------------------- kstest ----------------------------------
+ *    
+ * @brief calculated the means
+ * @author Frank Juehling and Steve Hoffmann 
+ *   
+ */
+
+void means(segment_t *seg , int a, int b, int ***groupID, int **groupSize, int groupNumber, int **subgroupID, int *subgroupSize, int subgroupNumber, char **meansA, char **meansB, fmtbuf_t *fmt){
 
   int i,j;
   float meanvalues[subgroupNumber];
@@ -671,9 +926,8 @@ void means(segment_t *seg , int a, int b, int ***groupID, int **groupSize, int g
   //   ci++;
   // }
 
-  char *subtmp =NULL;
-  concatFloatsToString(&subtmp, submeanvalues, subgroupNumber, '|');
-  *meansA = subtmp;
+  concatFloatsToString(&fmt->str[0], &fmt->len[0], submeanvalues, subgroupNumber, '|');
+  *meansA = fmt->str[0];
 
   // char *tmp =NULL;
   // concatFloatsToString(&tmp, meanvalues, subgroupNumber, '|');
@@ -888,6 +1142,124 @@ noValley(double **S, int s, int t, metseg_t *nfo){
   return 1;
 }
 
+/*------------------------------ newChunkScratch -------------------------------
+ *    
+ * @brief forget the kstest results of the previous chunk
+ * @author zzhu
+ *   
+ */
+
+void
+newChunkScratch(kscratch_t *sc) {
+  sc->gen++;
+  sc->memoused = 0;
+}
+
+/*--------------------------------- memoSlot ---------------------------------
+ *    
+ * @brief the entry of [s,t] and gn in the results of the chunk, or the free
+ * slot to store it in; the table is doubled when half full
+ * @author zzhu
+ *   
+ */
+
+ksmemo_t*
+memoSlot(kscratch_t *sc, int s, int t, int gn) {
+  size_t i, h;
+
+  if(2*(sc->memoused+1) > sc->memosize) {
+    ksmemo_t *old = sc->memo;
+    size_t oldsize = sc->memosize;
+
+    sc->memosize = oldsize ? 2*oldsize : 1024;
+    sc->memo = ALLOCMEMORY(NULL, NULL, ksmemo_t, sc->memosize);
+    memset(sc->memo, 0, sizeof(ksmemo_t)*sc->memosize);
+    for(i=0; i < oldsize; i++) {
+      if(old[i].gen == sc->gen) {
+        ksmemo_t *e = memoSlot(sc, old[i].s, old[i].t, old[i].gn);
+        *e = old[i];
+      }
+    }
+    if(oldsize) FREEMEMORY(NULL, old);
+  }
+
+  h = ((size_t)s*2654435761u) ^ ((size_t)t*40503u) ^ ((size_t)gn*97u);
+  for(i = h & (sc->memosize-1); ; i = (i+1) & (sc->memosize-1)) {
+    ksmemo_t *e = &sc->memo[i];
+    if(e->gen != sc->gen || (e->s == s && e->t == t && e->gn == gn)) {
+      return e;
+    }
+  }
+}
+
+/*------------------------------- testInterval -------------------------------
+ *    
+ * @brief kstest of [s,t] for combination gn if the interval passes the
+ * checks before it, in order of cost: the number of CpGs, the trend and
+ * the valley check on the prefix sums S. Intervals tested before in this
+ * chunk take the stored result. Returns 1 if ks was set.
+ * @author zzhu
+ *   
+ */
+
+char
+testInterval(segment_t *seg, double **S, int s, int t, int gn, double *ks,
+    int ***groupID, int **groupSize, metseg_t *nfo) {
+  filterstats_t *f = nfo->stats;
+  kscratch_t *sc = nfo->scratch;
+  ksmemo_t *e;
+
+  f->candidates++;
+  if(t-s+1 < nfo->mincpgs) {
+    f->mincpgs++;
+    return 0;
+  }
+  if(!(calcSingleTrendAbs(S, s, t) > nfo->trend)) {
+    f->trend++;
+    return 0;
+  }
+  if(!noValley(S, s, t, nfo)) {
+    f->valley++;
+    return 0;
+  }
+
+  e = memoSlot(sc, s, t, gn);
+  if(e->gen == sc->gen) {
+    memmove(ks, e->ks, sizeof(double)*3);
+    f->reused++;
+    return 1;
+  }
+
+  kstest(seg, s, t, 0, 1, 1, ks, groupID[0][gn], groupSize[0][gn], groupID[1][gn], groupSize[1][gn], nfo);
+  f->tested++;
+
+  e->s = s;
+  e->t = t;
+  e->gn = gn;
+  e->gen = sc->gen;
+  memmove(e->ks, ks, sizeof(double)*3);
+  sc->memoused++;
+  return 1;
+}
+
+/*------------------------------- enoughSigCpGs ------------------------------
+ *    
+ * @brief check the number of significant CpGs of a combination in [s,t]
+ * against -r
+ * @author zzhu
+ *   
+ */
+
+char
+enoughSigCpGs(double **S, int s, int t, metseg_t *nfo) {
+  if(calcSigCpGs(S, s, t) < nfo->minDMR) {
+    nfo->stats->sigcpgs++;
+    return 0;
+  }
+  return 1;
+}
+
+
 
 
 /*--------------------------------- findMaxZ ---------------------------------
@@ -1126,26 +1498,31 @@ void concatStrings(char **x, char *y, char sep) {
     *x = concatenated;
 }
 
-void concatIntsToString(char **x, int *y, size_t size, char sep) {
-    size_t total_length = 0;
-    for (size_t i = 0; i < size; ++i) {
-        total_length += snprintf(NULL, 0, "%d", y[i]) + 1;
-    }
-    total_length -= 1;
+/*---------------------------- concatIntsToString ----------------------------
+ *    
+ * @brief write y separated by sep into the buffer *x of *len bytes, which
+ * is grown if needed and may be reused by the next call
+ * @author zzhu
+ *   
+ */
 
-    *x = (char *)malloc(total_length + 1);
+void concatIntsToString(char **x, size_t *len, int *y, size_t size, char sep) {
+    size_t need = size*12 + 1;
+    char *ptr;
 
-    char *ptr = *x;
+    if (*x == NULL || *len < need) {
+        *x = ALLOCMEMORY(NULL, *x, char, need);
+        *len = need;
+    }
+
+    ptr = *x;
     for (size_t i = 0; i < size; ++i) {
-        int written = snprintf(ptr, total_length + 1, "%d", y[i]);
-        ptr += written;
-        total_length -= written;
-        if (total_length > 0) {
-          *ptr = sep;
-          ++ptr;
-          --total_length;
+        if (i > 0) {
+          *ptr++ = sep;
         }
+        ptr += sprintf(ptr, "%d", y[i]);
     }
+    *ptr = 0;
 }
 
 
@@ -1160,6 +1537,9 @@ void
 clustering(int ***clusters, int *nclusters, int numberSubGroup, int **subgroupID, int *subgroupSize, 
   segment_t *seg, metseg_t *nfo, double ***S, double *ks, int s, int t)
 {
+  // S is indexed by the pairs of calGroupNumber, which -S 1 does not use
+  if (nfo->search == 1) return;
+
   if (ks[3]!=-1)
   {
 
@@ -1397,7 +1777,7 @@ segment_pSTKopt(segment_t *seg, segment_t *breaks, int *nbreaks, double ***XS,
 
 
           // add a filter step here
-          if (calcSigCpGs(XS[gn], a, b) < nfo->minDMR)
+          if (!enoughSigCpGs(XS[gn], a, b, nfo))
           {
             if ((gn==(groupNumber-1))&&(existSigGn==0))
             {
@@ -1457,31 +1837,15 @@ segment_pSTKopt(segment_t *seg, segment_t *breaks, int *nbreaks, double ***XS,
           if (nfo->clustering == 0)
           {  
             //check the left side of the maximum interval with ks
-            n=a; m=ab_tmp[0]-1;
-            if(ab_tmp[0] > 0 && m-n+1 >= nfo->mincpgs 
-                && calcSingleTrendAbs(XS[gn],a,ab_tmp[0]-1) > nfo->trend 
-                && noValley(XS[gn], a, ab_tmp[0]-1, nfo)) {
-
-              kstest(seg, a, ab_tmp[0]-1, 0, 1, 1, ks1_tmp, groupID[0][gn], groupSize[0][gn], groupID[1][gn], groupSize[1][gn], nfo);
+            if(ab_tmp[0] > 0) {
+              testInterval(seg, XS[gn], a, ab_tmp[0]-1, gn, ks1_tmp, groupID, groupSize, nfo);
             }
 
             //check the maximum interval interval with ks
-            n=ab_tmp[0];m=ab_tmp[1];
-            if(m-n+1 >= nfo->mincpgs 
-                && calcSingleTrendAbs(XS[gn],ab_tmp[0],ab_tmp[1]) > nfo->trend 
-                && noValley(XS[gn], ab_tmp[0], ab_tmp[1], nfo) ) {
-
-              kstest(seg, ab_tmp[0], ab_tmp[1], 0, 1, 1, ks2_tmp, groupID[0][gn], groupSize[0][gn], groupID[1][gn], groupSize[1][gn], nfo);
-            }
+            testInterval(seg, XS[gn], ab_tmp[0], ab_tmp[1], gn, ks2_tmp, groupID, groupSize, nfo);
 
             //check the right side of the maximum interval with ks
-            n=ab_tmp[1]+1;m=b;
-            if(m-n+1 >= nfo->mincpgs 
-                && calcSingleTrendAbs(XS[gn],ab_tmp[1]+1,b)> nfo->trend 
-                && noValley(XS[gn], ab_tmp[1]+1, b, nfo)) {
-
-              kstest(seg, ab_tmp[1]+1, b, 0, 1, 1, ks3_tmp, groupID[0][gn], groupSize[0][gn], groupID[1][gn], groupSize[1][gn], nfo);
-            }
+            testInterval(seg, XS[gn], ab_tmp[1]+1, b, gn, ks3_tmp, groupID, groupSize, nfo);
 
             if (MIN(ks1_tmp[0],MIN(ks2_tmp[0],ks3_tmp[0]))<MIN(ks1[0],MIN(ks2[0],ks3[0])))
             {
@@ -1571,37 +1935,22 @@ segment_pSTKopt(segment_t *seg, segment_t *breaks, int *nbreaks, double ***XS,
               memmove(ks3_tmp, init_kstmp, sizeof(double)*3);
               
               // add a filter step here
-              if (calcSigCpGs(XS[gn], a, b) < nfo->minDMR)
+              if (!enoughSigCpGs(XS[gn], a, b, nfo))
               {
                 continue;
               }
               // end a filter step here
               
               //check the left side of the maximum interval with ks
-              n=a; m=ab[0]-1;
-              if(ab[0] > 0 && m-n+1 >= nfo->mincpgs 
-                  && calcSingleTrendAbs(XS[gn],a,ab[0]-1) > nfo->trend 
-                  && noValley(XS[gn], a, ab[0]-1, nfo)) {
-
-                kstest(seg, a, ab[0]-1, 0, 1, 1, ks1_tmp, groupID[0][gn], groupSize[0][gn], groupID[1][gn], groupSize[1][gn], nfo);
+              if(ab[0] > 0) {
+                testInterval(seg, XS[gn], a, ab[0]-1, gn, ks1_tmp, groupID, groupSize, nfo);
               }
 
               //check the maximum interval interval with ks
-              n=ab[0];m=ab[1];
-              if(m-n+1 >= nfo->mincpgs 
-                  && calcSingleTrendAbs(XS[gn],ab[0],ab[1]) > nfo->trend 
-                  && noValley(XS[gn], ab[0], ab[1], nfo) ) {
-
-                kstest(seg, ab[0], ab[1], 0, 1, 1, ks2_tmp, groupID[0][gn], groupSize[0][gn], groupID[1][gn], groupSize[1][gn], nfo);
-              }
+              testInterval(seg, XS[gn], ab[0], ab[1], gn, ks2_tmp, groupID, groupSize, nfo);
 
               //check the right side of the maximum interval with ks
-              n=ab[1]+1;m=b;
-              if(m-n+1 >= nfo->mincpgs 
-                  && calcSingleTrendAbs(XS[gn],ab[1]+1,b)> nfo->trend 
-                  && noValley(XS[gn], ab[1]+1, b, nfo)) {
-                kstest(seg, ab[1]+1, b, 0, 1, 1, ks3_tmp, groupID[0][gn], groupSize[0][gn], groupID[1][gn], groupSize[1][gn], nfo);
-              }
+              testInterval(seg, XS[gn], ab[1]+1, b, gn, ks3_tmp, groupID, groupSize, nfo);
 
               if (ks1_tmp[0]<ks1[0])
               {
@@ -1788,7 +2137,6 @@ segmenterSTK(segment_t *seg, segment_t *globalbreaks, int *nglobal, double ***XS
   // zzhu$ a: the start pos of the region, b is the end pos.
 
   int nbreaks=0, i, n, m; //, *s, *t;
-  double trend[groupNumber];
   segment_t *breaks=NULL, *max; // zzhu$ breaks: pre-segments. max: the break with most significant p value.
 
   Segmentstack stack; 
@@ -1824,14 +2172,12 @@ segmenterSTK(segment_t *seg, segment_t *globalbreaks, int *nglobal, double ***XS
         for (int gn = 0; gn < groupNumber; gn++)
         {
           // add a filter step here
-          if (calcSigCpGs(XS[gn], n, m) < nfo->minDMR)
+          if (!enoughSigCpGs(XS[gn], n, m, nfo))
           {
             continue;
           }
           // end a filter step here
-          trend[gn] = calcSingleTrendAbs(XS[gn], n, m);
-          if(m-n+1 >= nfo->mincpgs && trend[gn] > nfo->trend && noValley(XS[gn], n, m, nfo)) { 
-            kstest(seg, n, m, 0, 1, 1, ks_tmp, groupID[0][gn], groupSize[0][gn], groupID[1][gn], groupSize[1][gn], nfo);
+          if(testInterval(seg, XS[gn], n, m, gn, ks_tmp, groupID, groupSize, nfo)) { 
             if (ks_tmp[0]<ks[0])
             {
               ks[0]=ks_tmp[0];
@@ -1874,15 +2220,13 @@ segmenterSTK(segment_t *seg, segment_t *globalbreaks, int *nglobal, double ***XS
         for (int gn = 0; gn < groupNumber; gn++)
         {
           // add a filter step here
-          if (calcSigCpGs(XS[gn], n, m) < nfo->minDMR)
+          if (!enoughSigCpGs(XS[gn], n, m, nfo))
           {
             continue;
           }
           // end a filter step here
 
-          trend[gn] = calcSingleTrendAbs(XS[gn], n, m);
-          if(m-n+1 >= nfo->mincpgs && trend[gn] > nfo->trend && noValley(XS[gn], n, m, nfo)) { 
-            kstest(seg, n, m, 0, 1, 1, ks_tmp, groupID[0][gn], groupSize[0][gn], groupID[1][gn], groupSize[1][gn], nfo);
+          if(testInterval(seg, XS[gn], n, m, gn, ks_tmp, groupID, groupSize, nfo)) { 
             if (ks_tmp[0]<ks[0])
             {
               ks[0]=ks_tmp[0];
@@ -1914,12 +2258,11 @@ segmenterSTK(segment_t *seg, segment_t *globalbreaks, int *nglobal, double ***XS
  * @author zzhu
  *   
  */
-void convert_sigcp2string(int nclusters, int sigcp, int **clusters, int subgroupNumber, char **meansB){
-  char *subtmp =NULL;
+void convert_sigcp2string(int nclusters, int sigcp, int **clusters, int subgroupNumber, char **meansB, fmtbuf_t *fmt){
   if (sigcp>=0 && sigcp<nclusters)
   {
-      concatIntsToString(&subtmp, clusters[sigcp], subgroupNumber, '|');
-      *meansB = subtmp;
+      concatIntsToString(&fmt->str[1], &fmt->len[1], clusters[sigcp], subgroupNumber, '|');
+      *meansB = fmt->str[1];
   }
 }
 
@@ -1937,10 +2280,7 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
     metseg_t *nfo) {
   
   // fprintf(stderr,"start out2*****:\t%d\n",*nclusters);
-  if(nfo->outputList->i >= nfo->outputList->n) {
-        nfo->outputList->n+=1000000;
-        nfo->outputList->segment_out = ALLOCMEMORY(NULL, nfo->outputList->segment_out, segment_out, nfo->outputList->n);
-  }
+  growOutputList(nfo->outputList);
 
   // for (int cl = 0; cl < nclusters; cl++)
   // {
@@ -1951,7 +2291,6 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
   // }
         
   int i;
-  double trend;
   segment_t *b, *tmp=NULL;
   nfo->outputList->numberTests+=nglobal;
   for(i=0; i<nglobal; i++) {
@@ -1973,7 +2312,7 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
         char *me[] = {"-2","-2"};
         // fprintf(stderr, "Output 0: \t%s\n", me[0]);
         // fprintf(stderr, "Output 02: \t%s\n", me[1]);
-        means(seg, tmp->start,tmp->stop, groupID, groupSize, groupNumber, subgroupID, subgroupSize, subgroupNumber, &me[0], &me[1]);
+        means(seg, tmp->start,tmp->stop, groupID, groupSize, groupNumber, subgroupID, subgroupSize, subgroupNumber, &me[0], &me[1], nfo->fmt);
         // fprintf(stderr, "Output 1: \t%s\n", me[0]);
         // fprintf(stderr, "Output 11: \t%f,%d\n", b->sigcp, *nclusters);
       //         for (int i = 0; i < subgroupNumber; i++)
@@ -1981,7 +2320,7 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
       //   fprintf(stderr, "sadfa%d,\t",(*clusters)[(int)tmp->sigcp][i]);
       // }
 
-        convert_sigcp2string(*nclusters, (int)tmp->sigcp, *clusters, subgroupNumber, &me[1]);
+        convert_sigcp2string(*nclusters, (int)tmp->sigcp, *clusters, subgroupNumber, &me[1], nfo->fmt);
         // fprintf(stderr, "Output 1: \t%s\n", me[0]);
         // fprintf(stderr, "Output 12: \t%s\n", me[1]);
         
@@ -2012,18 +2351,13 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
         int existSigGn = 0;
         for(int gn=0; gn<groupNumber; gn++){
           // add a filter step here
-          if (calcSigCpGs(XS[gn], tmp->start,tmp->stop) < nfo->minDMR)
+          if (!enoughSigCpGs(XS[gn], tmp->start, tmp->stop, nfo))
           {
             continue;
           }
           // end a filter step here
 
-          trend = calcSingleTrendAbs(XS[gn],tmp->start,tmp->stop);
-          if(tmp->stop-tmp->start + 1 >= nfo->mincpgs && trend>nfo->trend 
-              && noValley(XS[gn], tmp->start, tmp->stop, nfo)) {
-
-            kstest(seg, tmp->start,tmp->stop, 0, 1, 1, ks_tmp, 
-                groupID[0][gn], groupSize[0][gn], groupID[1][gn], groupSize[1][gn], nfo);
+          if(testInterval(seg, XS[gn], tmp->start, tmp->stop, gn, ks_tmp, groupID, groupSize, nfo)) {
             if (ks_tmp[0]<ks[0])
             {
               ks[0] = ks_tmp[0];
@@ -2041,6 +2375,7 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
         if(ks[0]<2) {
             nfo->outputList->segment_out[nfo->outputList->i].chr = ALLOCMEMORY(NULL, NULL, char, strlen(seg->chr)+1);
             nfo->outputList->segment_out[nfo->outputList->i].chr = strcpy(nfo->outputList->segment_out[nfo->outputList->i].chr,seg->chr);
+            nfo->outputList->segment_out[nfo->outputList->i].seq = nfo->seq;
             nfo->outputList->segment_out[nfo->outputList->i].start = seg->pos[tmp->start]-1;
             // if ((tmp->stop-tmp->start+1+1)<10)
             // {
@@ -2059,18 +2394,15 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
             nfo->outputList->segment_out[nfo->outputList->i].sigcp = ks[3];
             
             char *me[] = {"-2","-2"};
-            means(seg,tmp->start,tmp->stop, groupID, groupSize, groupNumber, subgroupID, subgroupSize, subgroupNumber, &me[0], &me[1]);
-            convert_sigcp2string(*nclusters, (int)tmp->sigcp, *clusters, subgroupNumber, &me[1]);
+            means(seg,tmp->start,tmp->stop, groupID, groupSize, groupNumber, subgroupID, subgroupSize, subgroupNumber, &me[0], &me[1], nfo->fmt);
+            convert_sigcp2string(*nclusters, (int)tmp->sigcp, *clusters, subgroupNumber, &me[1], nfo->fmt);
             nfo->outputList->segment_out[nfo->outputList->i].methA = ALLOCMEMORY(NULL, NULL, char, strlen(me[0])+1);
             nfo->outputList->segment_out[nfo->outputList->i].methB = ALLOCMEMORY(NULL, NULL, char, strlen(me[1])+1);
             nfo->outputList->segment_out[nfo->outputList->i].methA = strcpy(nfo->outputList->segment_out[nfo->outputList->i].methA,me[0]);
             nfo->outputList->segment_out[nfo->outputList->i].methB = strcpy(nfo->outputList->segment_out[nfo->outputList->i].methB,me[1]);
             
             nfo->outputList->i+=1;
-            if(nfo->outputList->i >= nfo->outputList->n) {
-                nfo->outputList->n+=1000000;
-                nfo->outputList->segment_out = ALLOCMEMORY(NULL, nfo->outputList->segment_out, segment_out, nfo->outputList->n);
-            }
+            growOutputList(nfo->outputList);
 
         } 
 
@@ -2086,6 +2418,7 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
       
       nfo->outputList->segment_out[nfo->outputList->i].chr = ALLOCMEMORY(NULL, NULL, char, strlen(seg->chr)+1);
       nfo->outputList->segment_out[nfo->outputList->i].chr = strcpy(nfo->outputList->segment_out[nfo->outputList->i].chr,seg->chr);
+      nfo->outputList->segment_out[nfo->outputList->i].seq = nfo->seq;
       nfo->outputList->segment_out[nfo->outputList->i].start = seg->pos[b->start]-1;
       nfo->outputList->segment_out[nfo->outputList->i].stop = seg->pos[b->stop];
       nfo->outputList->segment_out[nfo->outputList->i].p = b->prob;
@@ -2096,14 +2429,14 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
       nfo->outputList->segment_out[nfo->outputList->i].sigcp = b->sigcp;
       // fprintf(stderr,"start12:%f,%d\n",(b->prob),( seg->pos[b->stop]-seg->pos[b->start]+1+1));
       char *me[] = {"-2","-2"};
-      means(seg, b->start,b->stop, groupID, groupSize, groupNumber,subgroupID, subgroupSize, subgroupNumber, &me[0], &me[1]);
+      means(seg, b->start,b->stop, groupID, groupSize, groupNumber,subgroupID, subgroupSize, subgroupNumber, &me[0], &me[1], nfo->fmt);
 // fprintf(stderr,"start12:%f,%d\n",(b->prob),( seg->pos[b->stop]-seg->pos[b->start]+1+1));
       // for (int i = 0; i < subgroupNumber; i++)
       // {
       //   fprintf(stderr, "sadfa%d,\t",(*clusters)[(int)b->sigcp][i]);
       // }
 
-      convert_sigcp2string(*nclusters, (int)b->sigcp, *clusters, subgroupNumber, &me[1]);
+      convert_sigcp2string(*nclusters, (int)b->sigcp, *clusters, subgroupNumber, &me[1], nfo->fmt);
       // fprintf(stderr,"start12:%f,%d\n",(b->prob),( seg->pos[b->stop]-seg->pos[b->start]+1+1));
       nfo->outputList->segment_out[nfo->outputList->i].methA = ALLOCMEMORY(NULL, NULL, char, strlen(me[0])+1);
       nfo->outputList->segment_out[nfo->outputList->i].methB = ALLOCMEMORY(NULL, NULL, char, strlen(me[1])+1);
@@ -2113,10 +2446,7 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
       // if(nfo->outputList->i>=2){fprintf(stderr,"start2:%d,%d\n",nfo->outputList->segment_out[2].start,nfo->outputList->segment_out[nfo->outputList->i].stop);}
       
       nfo->outputList->i+=1;
-      if(nfo->outputList->i >= nfo->outputList->n) {
-          nfo->outputList->n+=1000000;
-          nfo->outputList->segment_out = ALLOCMEMORY(NULL, nfo->outputList->segment_out, segment_out, nfo->outputList->n);
-      }
+      growOutputList(nfo->outputList);
       // fprintf(stderr,"start13:%f,%d\n",(b->prob),( seg->pos[b->stop]-seg->pos[b->start]+1+1));
     }
   }
@@ -2137,18 +2467,13 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
     int existSigGn = 0;
     for(int gn=0; gn<groupNumber; gn++){
       // add a filter step here
-      if (calcSigCpGs(XS[gn], tmp->start,tmp->stop) < nfo->minDMR)
+      if (!enoughSigCpGs(XS[gn], tmp->start, tmp->stop, nfo))
       {
         continue;
       }
       // end a filter step here
       
-      trend = calcSingleTrendAbs(XS[gn],tmp->start,tmp->stop);
-      if(tmp->stop-tmp->start + 1 >= nfo->mincpgs && trend>nfo->trend 
-          && noValley(XS[gn], tmp->start, tmp->stop, nfo)) {
-
-        kstest(seg, tmp->start,tmp->stop, 0, 1, 1, ks_tmp, 
-            groupID[0][gn], groupSize[0][gn], groupID[1][gn], groupSize[1][gn], nfo);
+      if(testInterval(seg, XS[gn], tmp->start, tmp->stop, gn, ks_tmp, groupID, groupSize, nfo)) {
         if (ks_tmp[0]<ks[0])
         {
           ks[0] = ks_tmp[0];
@@ -2172,6 +2497,7 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
         // }
         nfo->outputList->segment_out[nfo->outputList->i].chr = ALLOCMEMORY(NULL, NULL, char, strlen(seg->chr)+1);
         nfo->outputList->segment_out[nfo->outputList->i].chr = strcpy(nfo->outputList->segment_out[nfo->outputList->i].chr,seg->chr);
+        nfo->outputList->segment_out[nfo->outputList->i].seq = nfo->seq;
         nfo->outputList->segment_out[nfo->outputList->i].start = seg->pos[tmp->start]-1;
         // fprintf(stderr,"start3:");
         // if(nfo->outputList->i>=2){fprintf(stderr,"start3:%d,%d",seg->pos[tmp->start]-1,nfo->outputList->segment_out[2].start);}
@@ -2184,19 +2510,15 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
         nfo->outputList->segment_out[nfo->outputList->i].sigcp = ks[3];
         
         char *me[] = {"-2","-2"};
-        means(seg, tmp->start,tmp->stop, groupID, groupSize, groupNumber, subgroupID, subgroupSize, subgroupNumber, &me[0], &me[1]);
-        convert_sigcp2string(*nclusters, (int)tmp->sigcp, *clusters, subgroupNumber, &me[1]);
+        means(seg, tmp->start,tmp->stop, groupID, groupSize, groupNumber, subgroupID, subgroupSize, subgroupNumber, &me[0], &me[1], nfo->fmt);
+        convert_sigcp2string(*nclusters, (int)tmp->sigcp, *clusters, subgroupNumber, &me[1], nfo->fmt);
         nfo->outputList->segment_out[nfo->outputList->i].methA = ALLOCMEMORY(NULL, NULL, char, strlen(me[0])+1);
         nfo->outputList->segment_out[nfo->outputList->i].methB = ALLOCMEMORY(NULL, NULL, char, strlen(me[1])+1);
         nfo->outputList->segment_out[nfo->outputList->i].methA = strcpy(nfo->outputList->segment_out[nfo->outputList->i].methA,me[0]);
         nfo->outputList->segment_out[nfo->outputList->i].methB = strcpy(nfo->outputList->segment_out[nfo->outputList->i].methB,me[1]);
         
         nfo->outputList->i+=1;
-        if(nfo->outputList->i >= nfo->outputList->n) {
-            nfo->outputList->n+=1000000;
-            nfo->outputList->segment_out = ALLOCMEMORY(NULL, nfo->outputList->segment_out, segment_out, nfo->outputList->n);
-            // if(nfo->outputList->i>=2){fprintf(stderr,"start4:%d",nfo->outputList->segment_out[2].start);}
-        }
+        growOutputList(nfo->outputList);
     }
     FREEMEMORY(NULL, tmp);
     tmp=NULL;
@@ -2205,13 +2527,6 @@ output(segment_t *seg, segment_t *breaks, int nglobal, double ***XS,
   return;
 }
 
-//these variables need to be volatile to stop the compiler from optimizing
-//as they are manipulated by the threads!
-static volatile unsigned int idle;
-volatile char *schedule = NULL;
-static pthread_mutex_t out;
-static pthread_mutex_t cnt;
-
 /*------------------------------- segmentation -------------------------------
  *    
  * @brief do the segmentation
@@ -2236,10 +2551,10 @@ segmentation(char **chr, int *pos, double **value, int n,
   //   ks[i][1] = 0;
   //   ks[i][2] = 2;
   // }
-  double trend[groupNumber];
-  char novalley[groupNumber];
   segment_t *seg, *global=NULL; // zzhu$ seg: containing all met. values in the two groups. global: the DMRs from segmenterSTK.
   int i, nglobal = 0;
+  combination_t comb;
+  int firstout;
 
   int **clusters = NULL;
   int nclusters = 0;
@@ -2250,14 +2565,24 @@ segmentation(char **chr, int *pos, double **value, int n,
   seg->n = n; // zzhu$ number of CpGs in the region
   seg->chr = chr[0];
   seg->pos = pos;
+  newChunkScratch(nfo->scratch);
   seg->value = value;
 
+  if(nfo->search == 1) {
+    orderedCombinations(seg, subgroupID, subgroupSize, nfo, &comb);
+    groupID = comb.groupID;
+    groupSize = comb.groupSize;
+    groupNumber = comb.n;
+  }
+  double trend[groupNumber+1];
+  char novalley[groupNumber+1];
+
   S = calcSingleDiffSum(seg, groupID, groupSize, groupNumber, nfo->mindiff, nfo->mindiff2);
   int existSigGn = 0;
   for (int gn = 0; gn < groupNumber; gn++)
   {
     // add a filter step here
-    if (calcSigCpGs(S[gn], 0, n-1) < nfo->minDMR)
+    if (!enoughSigCpGs(S[gn], 0, n-1, nfo))
     {
       // fprintf(stderr,"no sigcpgs gn:%d\n",gn);
       continue;
@@ -2285,10 +2610,6 @@ segmentation(char **chr, int *pos, double **value, int n,
   }
   
 
-  //set lock if necessary 
-  if(nfo->threads >1) { 
-    pthread_mutex_lock(&out);
-  }
   //output here   
   // for (int cl = 0; cl<nclusters; cl++) {
   //   for (int i = 0; i < nfo->groups; i++)
@@ -2298,11 +2619,17 @@ segmentation(char **chr, int *pos, double **value, int n,
   //   fprintf(stderr, "\n");
   // }
   // fprintf(stderr,"nfo->mincpgs:%d", nfo->mincpgs);
+  firstout = nfo->outputList->i;
   output(seg, global, nglobal, S, groupID, groupSize, groupNumber, subgroupID, subgroupSize, nfo->groups, &clusters, &nclusters, nfo);
-  
-  //unlock if necessary
-  if(nfo->threads > 1) {
-    pthread_mutex_unlock(&out);
+  if(nfo->search == 1) {
+    // sigcp is the index of a combination of this segment only
+    for(i=firstout; i < nfo->outputList->i; i++) {
+      segment_out *so = &nfo->outputList->segment_out[i];
+      if(so->sigcp >= 0 && so->sigcp < comb.n) {
+        FREEMEMORY(NULL, so->methB);
+        comparisonString(&comb, (int)so->sigcp, nfo->groups, &so->methB);
+      }
+    }
   }
 
   for(int gn=0;gn<groupNumber;gn++){
@@ -2326,6 +2653,9 @@ segmentation(char **chr, int *pos, double **value, int n,
   
 
 
+  if(nfo->search == 1) {
+    destructCombinations(&comb);
+  }
   FREEMEMORY(NULL, global);
   FREEMEMORY(NULL, seg);
   FREEMEMORY(NULL, S);
@@ -2335,39 +2665,137 @@ segmentation(char **chr, int *pos, double **value, int n,
 
 
 
-/*-------------------------------- segworker ---------------------------------
+/*--------------------------- segmentationThresholds ---------------------------
  *    
- * @brief for threaded segmentation
- * @author Frank Juehling and Steve Hoffma2nn 
+ * @brief segment a chunk once per threshold given with -T. Each threshold 
+ * is used as -d, -w and -q and the DMRs are collected in its own output 
+ * list, so all thresholds are served by a single pass over the input.
+ * @author zzhu
  *   
  */
- 
-void*
-segworker (void *args)
-{
-  int i;
-  metseg_t *t;
-  t = (metseg_t*) args;
-   
-  segmentation(t->chr, t->pos, t->value, t->n, t->groupID, t->groupSize, t->groupNumber, t->subgroupID, t->subgroupSize, t);
-  
-  //cleanup own data
-  for(i=0; i < t->n; i++) {
-    FREEMEMORY(NULL, t->chr[i]);
-    FREEMEMORY(NULL, t->value[i]);
+
+int 
+segmentationThresholds(char **chr, int *pos, double **value, int n, 
+    int ***groupID, int **groupSize, int groupNumber, 
+    int **subgroupID, int *subgroupSize,
+    metseg_t *nfo) {
+
+  metseg_t tnfo;
+
+  if(nfo->nthresholds == 0) {
+    return segmentation(chr, pos, value, n, groupID, groupSize, groupNumber, 
+        subgroupID, subgroupSize, nfo);
+  }
+
+  for(int k=0; k < nfo->nthresholds; k++) {
+    memmove(&tnfo, nfo, sizeof(metseg_t));
+    tnfo.minMethDist = nfo->thresholds[k];
+    tnfo.mindiff = nfo->thresholds[k];
+    tnfo.mindiff2 = nfo->thresholds[k];
+    tnfo.outputList = nfo->outputLists[k];
+    segmentation(chr, pos, value, n, groupID, groupSize, groupNumber, 
+        subgroupID, subgroupSize, &tnfo);
+  }
+
+  return 0;
+}
+
+/*--------------------------------- addBatch ---------------------------------
+ *    
+ * @brief append a chunk, region or CpG holding cpgs CpGs to a batch; a new
+ * batch is started if b is NULL. seq is the input order of the item
+ * @author zzhu
+ *   
+ */
+
+batch_t*
+addBatch(batch_t *b, void *item, int cpgs, int seq) {
+  if(!b) {
+    b = ALLOCMEMORY(NULL, NULL, batch_t, 1);
+    b->items = NULL;
+    b->n = 0;
+    b->cpgs = 0;
+    b->seq = seq;
+  }
+  b->items = ALLOCMEMORY(NULL, b->items, void*, b->n+1);
+  b->items[b->n++] = item;
+  b->cpgs += cpgs;
+  return b;
+}
+
+/*-------------------------------- submitBatch -------------------------------
+ *    
+ * @brief hand a batch to the workers once it holds BATCHCPGS CpGs, or in
+ * any case if flush is set
+ * @author zzhu
+ *   
+ */
+
+void
+submitBatch(threadpool_t *pool, batch_t **b, char flush) {
+  if(*b && (flush || (*b)->cpgs >= BATCHCPGS)) {
+    submitThreadPool(pool, *b, (*b)->cpgs);
+    *b = NULL;
   }
-  FREEMEMORY(NULL, t->chr);
-  FREEMEMORY(NULL, t->pos);
-  FREEMEMORY(NULL, t->value);
+}
 
+/*------------------------------- segmentChunk -------------------------------
+ *    
+ * @brief segment one chunk and record its size and time
+ * @author zzhu
+ *   
+ */
 
-  pthread_mutex_lock(&cnt);
-  schedule[t->threadno] = 0;
-  //decrement of idle at creation time
-  idle = idle+1;
-  pthread_mutex_unlock(&cnt);
+void
+segmentChunk(chunk_t *c, int ***groupID, int **groupSize, int groupNumber, 
+    int **subgroupID, int *subgroupSize, metseg_t *nfo) {
+  chunkstats_t *cs = nfo->chunkstats;
+  struct timespec t0, t1;
+  double el;
+
+  clock_gettime(CLOCK_MONOTONIC, &t0);
+  segmentationThresholds(&c->chr, c->pos, c->value, c->n, groupID, groupSize, 
+      groupNumber, subgroupID, subgroupSize, nfo);
+  clock_gettime(CLOCK_MONOTONIC, &t1);
+  el = (t1.tv_sec-t0.tv_sec) + (t1.tv_nsec-t0.tv_nsec)/1e9;
+
+  cs->chunks++;
+  cs->cpgs += c->n;
+  cs->seconds += el;
+  if(c->n > cs->maxcpgs) cs->maxcpgs = c->n;
+  if(el > cs->maxseconds) {
+    cs->maxseconds = el;
+    cs->slowcpgs = c->n;
+  }
+}
 
-  pthread_exit(args);
+/*-------------------------------- segworker ---------------------------------
+ *    
+ * @brief for threaded segmentation: segment a batch of chunks
+ * @author Frank Juehling and Steve Hoffma2nn 
+ *   
+ */
+ 
+void
+segworker (void *task, void *args)
+{
+  int k;
+  batch_t *b = (batch_t*) task;
+  metseg_t *t = (metseg_t*) args;
+
+  for(k=0; k < b->n; k++) {
+    chunk_t *c = (chunk_t*) b->items[k];
+    t->seq = b->seq + k;
+    segmentChunk(c, t->groupID, t->groupSize, t->groupNumber, t->subgroupID, t->subgroupSize, t);
+
+    //cleanup own data, the chromosome name belongs to main
+    FREEMEMORY(NULL, c->block);
+    FREEMEMORY(NULL, c->pos);
+    FREEMEMORY(NULL, c->value);
+    FREEMEMORY(NULL, c);
+  }
+  FREEMEMORY(NULL, b->items);
+  FREEMEMORY(NULL, b);
 }
 
 /*------------------------------- regionTest -------------------------------
@@ -2386,6 +2814,13 @@ int **subgroupID, int *subgroupSize, metseg_t *nfo) {
     int **clusters = NULL;
     int nclusters = 0;
     double maxZ = 0;
+    combination_t comb;
+    if(seg->n>0 && nfo->search == 1) {
+      orderedCombinations(seg, subgroupID, subgroupSize, nfo, &comb);
+      groupID = comb.groupID;
+      groupSize = comb.groupSize;
+      groupNumber = comb.n;
+    }
     if(seg->n>0) {
       if (nfo->clustering == 1)
       {
@@ -2432,19 +2867,24 @@ int **subgroupID, int *subgroupSize, metseg_t *nfo) {
       }
     }
     char *me[] = {"-2","-2"};
-    means(seg, 0, seg->n-1,groupID, groupSize, groupNumber, subgroupID, subgroupSize, nfo->groups, &me[0],&me[1]);
+    means(seg, 0, seg->n-1,groupID, groupSize, groupNumber, subgroupID, subgroupSize, nfo->groups, &me[0],&me[1], nfo->fmt);
     if (nfo->clustering == 1)
     {
-      convert_sigcp2string(nclusters, ks[3], clusters, nfo->groups, &me[1]);
+      convert_sigcp2string(nclusters, ks[3], clusters, nfo->groups, &me[1], nfo->fmt);
+    }
+    char *comparison = NULL;
+    if (seg->n>0 && nfo->search == 1)
+    {
+      if (ks[3] >= 0) {
+        comparisonString(&comb, (int)ks[3], nfo->groups, &comparison);
+        me[1] = comparison;
+      }
+      destructCombinations(&comb);
     }
 //    void kstest(segment_t *seg , int a, int b, char mindiff, char mincpgs, char test, 
 //  (segment_t *seg , int a, int b, char mindiff, char mincpgs, char test, 
 //    double *ks, int *grpA, int noA, int *grpB, int noB, metseg_t* nfo){
     
-    
-    if(nfo->threads >1) { 
-      pthread_mutex_lock(&out);
-    }
  
 /*    
   //output here   
@@ -2455,38 +2895,28 @@ int **subgroupID, int *subgroupSize, metseg_t *nfo) {
     fflush(stdout); 
   */  
     
-    if(nfo->outputList->i >= nfo->outputList->n-1) {
-      nfo->outputList->n+=1000000;
-      nfo->outputList->segment_out = ALLOCMEMORY(NULL, nfo->outputList->segment_out, segment_out, nfo->outputList->n);
-    }
+    growOutputList(nfo->outputList);
     
     nfo->outputList->segment_out[nfo->outputList->i].chr = ALLOCMEMORY(NULL, NULL, char, strlen(seg->chr)+1);
     nfo->outputList->segment_out[nfo->outputList->i].chr = strcpy(nfo->outputList->segment_out[nfo->outputList->i].chr,seg->chr);
+    nfo->outputList->segment_out[nfo->outputList->i].seq = nfo->seq;
     nfo->outputList->segment_out[nfo->outputList->i].start = seg->start-1;
     nfo->outputList->segment_out[nfo->outputList->i].stop = seg->stop;
     nfo->outputList->segment_out[nfo->outputList->i].p = ks[0];
     nfo->outputList->segment_out[nfo->outputList->i].meandiff = ks[1];
     nfo->outputList->segment_out[nfo->outputList->i].mwu = ks[2];
     nfo->outputList->segment_out[nfo->outputList->i].length = seg->n;
-    nfo->outputList->segment_out[nfo->outputList->i].methA = me[0];
-    nfo->outputList->segment_out[nfo->outputList->i].methB = me[1];
+    // me points into the format buffers of this thread, keep a copy
+    nfo->outputList->segment_out[nfo->outputList->i].methA = ALLOCMEMORY(NULL, NULL, char, strlen(me[0])+1);
+    nfo->outputList->segment_out[nfo->outputList->i].methB = ALLOCMEMORY(NULL, NULL, char, strlen(me[1])+1);
+    nfo->outputList->segment_out[nfo->outputList->i].methA = strcpy(nfo->outputList->segment_out[nfo->outputList->i].methA,me[0]);
+    nfo->outputList->segment_out[nfo->outputList->i].methB = strcpy(nfo->outputList->segment_out[nfo->outputList->i].methB,me[1]);
     nfo->outputList->segment_out[nfo->outputList->i].sigcp = ks[3];
     
     nfo->outputList->i+=1;
     nfo->outputList->numberTests+=1;
     
-    
-    
-    
-    
-    //unlock if necessary
-    if(nfo->threads > 1) {
-    pthread_mutex_unlock(&out);
-  }
-    
-    
-    
-    
+    if (comparison) FREEMEMORY(NULL, comparison);
 
     destructSegment(seg);
     return;
@@ -2495,15 +2925,10 @@ void
 cpgTest(char *chr, int start, int stop, double ratio, double p, metseg_t *nfo, double methA, double methB) {
 //cpg->chr, cpg->start,cpg->stop,ratio,p);    
     
-    if(nfo->threads >1) { 
-    pthread_mutex_lock(&out);
-  }
-    if(nfo->outputList->i >= nfo->outputList->n-1) {
-      nfo->outputList->n+=1000000;
-      nfo->outputList->segment_out = ALLOCMEMORY(NULL, nfo->outputList->segment_out, segment_out, nfo->outputList->n);
-    }
+    growOutputList(nfo->outputList);
     nfo->outputList->segment_out[nfo->outputList->i].chr = ALLOCMEMORY(NULL, NULL, char, strlen(chr)+1);
     nfo->outputList->segment_out[nfo->outputList->i].chr = strcpy(nfo->outputList->segment_out[nfo->outputList->i].chr,chr);
+    nfo->outputList->segment_out[nfo->outputList->i].seq = nfo->seq;
     nfo->outputList->segment_out[nfo->outputList->i].start = start-1;
     nfo->outputList->segment_out[nfo->outputList->i].stop = stop;
     //nfo->outputList->segment_out[nfo->outputList->i].p = p;
@@ -2515,115 +2940,284 @@ cpgTest(char *chr, int start, int stop, double ratio, double p, metseg_t *nfo, d
     
     nfo->outputList->i+=1;
     nfo->outputList->numberTests+=1;
-   //unlock if necessary
-    if(nfo->threads > 1) {
-    pthread_mutex_unlock(&out);
-    }
     return;
 }
 /*-------------------------------- segworker_CpG -----------------------------
  *    
- * @brief for threaded segmentation in single CpG mode
+ * @brief for threaded segmentation in single CpG mode: test a batch of CpGs
  * @author Frank Juehling and Steve Hoffmann 
  *   
  */
-void*
-segworker_CpG (void *args)
+void
+segworker_CpG (void *task, void *args)
 {
-    
-  metseg_t *t;
-  t = (metseg_t*) args;
-  cpg_t *cpg = t->cpg;
-  
-  
-  int ua = mannwhitney (cpg->groupA, cpg->noA, cpg->groupB, cpg->noB);
-  double p= mannwhitneyPvalue(ua, cpg->noA, cpg->noB, t->MWU, MAXM, MAXN);
-  //double p = mannwhitney (cpg->groupA, cpg->noA, cpg->groupB, cpg->noB);
-  double ratio = get_meandiff(cpg, cpg->groupA, cpg->noA, cpg->groupB, cpg->noB);
-  
-  
-  
-  
-  /*
-  //output here   
-  fprintf(stdout, "#%s\t%d\t%d\t.\t1\t%f\n", 
-              cpg->chr, cpg->start-1, 
-              cpg->stop,p);
-  */
-  cpgTest(cpg->chr, cpg->start,cpg->stop,ratio,p,t, cpg->methA,cpg->methB);
-  
-  
-  destructCpg(t->cpg);
-  
-  pthread_mutex_lock(&cnt);
-  schedule[t->threadno] = 0;
-  //decrement of idle at creation time
-  idle = idle+1;
-  pthread_mutex_unlock(&cnt);
-
-  pthread_exit(args);
+  batch_t *b = (batch_t*) task;
+  metseg_t *t = (metseg_t*) args;
+
+  for(int k=0; k < b->n; k++) {
+    cpg_t *cpg = (cpg_t*) b->items[k];
+    t->seq = b->seq + k;
+    int ua = mannwhitney (cpg->groupA, cpg->noA, cpg->groupB, cpg->noB);
+    double p= mannwhitneyPvalue(ua, cpg->noA, cpg->noB, t->MWU, MAXM, MAXN);
+    double ratio = get_meandiff(cpg, cpg->groupA, cpg->noA, cpg->groupB, cpg->noB);
+
+    cpgTest(cpg->chr, cpg->start,cpg->stop,ratio,p,t, cpg->methA,cpg->methB);
+    destructCpg(cpg);
+  }
+  FREEMEMORY(NULL, b->items);
+  FREEMEMORY(NULL, b);
 }
 /*-------------------------------- segworker_region --------------------------
  *    
- * @brief for threaded segmentation in region mode
+ * @brief for threaded segmentation in region mode: test a batch of regions
  * @author Frank Juehling and Steve Hoffmann 
  *   
  */
-void*
-segworker_region (void *args)
+void
+segworker_region (void *task, void *args)
 {
-  metseg_t *t;
-  t = (metseg_t*) args;
-  regionTest(t->seg, t->groupID, t->groupSize, t->groupNumber, t->subgroupID, t->subgroupSize, t);
-          
-  pthread_mutex_lock(&cnt);
-  schedule[t->threadno] = 0;
-  //decrement of idle at creation time
-  idle = idle+1;
-  pthread_mutex_unlock(&cnt);
+  batch_t *b = (batch_t*) task;
+  metseg_t *t = (metseg_t*) args;
 
-  pthread_exit(args);
+  for(int k=0; k < b->n; k++) {
+    t->seq = b->seq + k;
+    regionTest((segment_t*) b->items[k], t->groupID, t->groupSize, t->groupNumber, t->subgroupID, t->subgroupSize, t);
+  }
+  FREEMEMORY(NULL, b->items);
+  FREEMEMORY(NULL, b);
 }
 
 
 
-/*-------------------------------- checkSetNAN ---------------------------------
+/*--------------------------------- internChr ---------------------------------
  *    
- * @brief for checking NaNs in input data
- * @author Frank Juehling and Steve Hoffmann 
+ * @brief the stored copy of a chromosome name, added on first use. The
+ * input is sorted by chromosome, so the last name is checked first
+ * @author zzhu
  *   
  */
- 
+
+char*
+internChr(chrnames_t *cn, char *name) {
+  int i;
+
+  if(cn->n > 0 && strcmp(cn->names[cn->n-1], name) == 0) {
+    return cn->names[cn->n-1];
+  }
+  for(i=0; i < cn->n-1; i++) {
+    if(strcmp(cn->names[i], name) == 0) return cn->names[i];
+  }
+  cn->names = ALLOCMEMORY(NULL, cn->names, char*, cn->n+1);
+  cn->names[cn->n] = my_strdup(name);
+  return cn->names[cn->n++];
+}
+
+/*------------------------------ destructChrNames ------------------------------
+ *    
+ * @brief free the stored chromosome names
+ * @author zzhu
+ *   
+ */
+
+void
+destructChrNames(chrnames_t *cn) {
+  for(int i=0; i < cn->n; i++) {
+    FREEMEMORY(NULL, cn->names[i]);
+  }
+  FREEMEMORY(NULL, cn->names);
+  cn->n = 0;
+  for(int i=0; i < cn->nselect; i++) {
+    FREEMEMORY(NULL, cn->select[i]);
+  }
+  FREEMEMORY(NULL, cn->select);
+  FREEMEMORY(NULL, cn->last);
+  cn->nselect = 0;
+}
+
+/*------------------------------- selectChrNames -------------------------------
+ *    
+ * @brief restrict the input to the chromosomes of a comma-separated list
+ * @author zzhu
+ *   
+ */
+
+void
+selectChrNames(chrnames_t *cn, char *list) {
+  char *tok = strtok(list, ",");
+  while(tok) {
+    cn->select = ALLOCMEMORY(NULL, cn->select, char*, cn->nselect+1);
+    cn->select[cn->nselect++] = my_strdup(tok);
+    tok = strtok(NULL, ",");
+  }
+}
+
+/*------------------------------- isSelectedChr --------------------------------
+ *    
+ * @brief whether rows of chromosome name are read; the rows of a chromosome
+ * are consecutive, so the last answer is kept
+ * @author zzhu
+ *   
+ */
+
 int
-checkSetNAN(stringset_t **csv, double *values){
-//check line for NANs and set . to NAN
-    int nan=0;
-    values[0] = -1;
-    values[1] = -1;
-    for(int k=2; k < csv[0]->noofstrings; k++) { 
-        char *s = csv[0]->strings[k].str;
-        values[k] = atof(s);
-        if(strcmp(".", s) == 0 || strcmp("-", s) == 0 || strcmp("", s) == 0 || strcmp(" ", s) == 0){
-            values[k] = NAN;
-        }
-        int in=0;
-        while (values[k] == values[k] && s[in]) {
-          if (isalpha(s[in])) {
-              values[k] = NAN;
-              break;
-          }
-//          else printf ("character %c is not alphabetic\n",s[in]);
-          in++;
-        }  
-        if(values[k] != values[k] ) {
-            nan+=1;
-        }
+isSelectedChr(chrnames_t *cn, char *name) {
+  int i;
+
+  if(!cn || !cn->select) return 1;
+  if(cn->last && strcmp(cn->last, name) == 0) return cn->lastselected;
+
+  FREEMEMORY(NULL, cn->last);
+  cn->last = my_strdup(name);
+  cn->lastselected = 0;
+  for(i=0; i < cn->nselect; i++) {
+    if(strcmp(cn->select[i], name) == 0) {
+      cn->lastselected = 1;
+      break;
     }
-    return nan;
+  }
+  return cn->lastselected;
+}
+
+/*---------------------------------- chrSeed -----------------------------------
+ *    
+ * @brief the seed of the random generator for the rows of a chromosome (-Z),
+ * so the imputation of a chromosome does not depend on the rows before it
+ * @author zzhu
+ *   
+ */
+
+unsigned
+chrSeed(int seed, char *chr) {
+  unsigned h = 5381;
+  while(*chr) {
+    h = h*33 + (unsigned char) *chr++;
+  }
+  return (unsigned) seed ^ h;
+}
+
+/*------------------------------- readInputRow -------------------------------
+ *    
+ * @brief read the next row of the input matrix, either from the text file,
+ * from the parallel readers (-R) or from the binary matrix cache. values
+ * are laid out as in checkSetNAN
+ * and the buffer is reused if the caller keeps it. chr is a copy owned by
+ * the caller, or the interned name if names is given; rows of chromosomes
+ * not selected in names (-L) are skipped. Returns the number
+ * of columns (chr and pos included) or 0 at the end of the input.
+ * @author zzhu
+ *   
+ */
+
+Uint
+readInputRow(fileiterator_t *fi, matcache_t *mc, inputreader_t *ir, 
+    chrnames_t *names, char **chr, int *pos, double **values, int *nan) {
+
+  char **fields, *mcchr;
+  Uint ncols = 0;
+  int ret;
+
+  *chr = NULL;
+
+  if(ir) {
+    do {
+      ncols = readInputReaderRow(ir, &mcchr, pos, values, nan);
+    } while(ncols && !isSelectedChr(names, mcchr));
+    if(ncols) {
+      *chr = names ? internChr(names, mcchr) : my_strdup(mcchr);
+    }
+    return ncols;
+  }
+
+  if(mc) {
+    while(mc->row < mc->nrows && !isSelectedChr(names, mc->chrnames[mc->chrid[mc->row]])) {
+      mc->row++;
+    }
+    if(mc->row >= mc->nrows) {
+      FREEMEMORY(NULL, *values);
+      return 0;
+    }
+    ncols = mc->nsamples+2;
+    *values = ALLOCMEMORY(NULL, *values, double, ncols);
+    *nan = readMatCacheRow(mc, &mcchr, pos, *values);
+    *chr = names ? internChr(names, mcchr) : my_strdup(mcchr);
+    return ncols;
+  }
+
+  while((ret = readcsvfields(NULL, fi, '\t', &fields, &ncols)) != EOF && ncols > 0 && 
+      !isSelectedChr(names, fields[0]));
+  if(ret != EOF && ncols > 0) {
+    *values = ALLOCMEMORY(NULL, *values, double, (ncols > 2) ? ncols : 2);
+    *nan = checkSetNAN(fields, ncols, *values);
+    *chr = names ? internChr(names, fields[0]) : my_strdup(fields[0]);
+    *pos = (ncols > 1) ? atoi(fields[1]) : 0;
+  } else {
+    FREEMEMORY(NULL, *values);
+    ncols = 0;
+  }
+
+  return ncols;
+}
+
+/*------------------------------ outputImputedRow ------------------------------
+ *    
+ * @brief print a row with imputed values for -O
+ * @author zzhu
+ *   
+ */
+
+void
+outputImputedRow(char *chr, int pos, double *values, Uint ncols) {
+  char *subtmp = NULL;
+
+  outputImputedValues(&subtmp, values, ncols, '\t');
+  fprintf(stdout, "//Imputed:%s\t%d\t%s\n", chr, pos, subtmp);
+  free(subtmp);
+}
+
+/*------------------------------ writeInputCache -------------------------------
+ *    
+ * @brief convert the text input matrix to a binary matrix cache (-C)
+ * @author zzhu
+ *   
+ */
+
+void
+writeInputCache(fileiterator_t *fi, char *cachefile) {
+  stringset_t **csv = NULL;
+  matcachewriter_t *w;
+  char **samples, *chr;
+  double *values = NULL;
+  int pos, nan;
+  Uint k, ncols;
+
+  readcsvlines(NULL, fi, '\t', 1, &csv);
+  if(!csv[0] || csv[0]->noofstrings < 3) {
+    fprintf(stderr, "Error: could not read header of the input matrix. Exit forced.\n");
+    exit(-1);
+  }
+  samples = ALLOCMEMORY(NULL, NULL, char*, csv[0]->noofstrings-2);
+  for(k=2; k < csv[0]->noofstrings; k++) {
+    samples[k-2] = csv[0]->strings[k].str;
+  }
+  w = initMatCacheWriter(cachefile, samples, csv[0]->noofstrings-2);
+
+  while((ncols = readInputRow(fi, NULL, NULL, NULL, &chr, &pos, &values, &nan))) {
+    if(ncols != w->nsamples+2) {
+      fprintf(stderr, "Error: %s:%d has %u columns, expected %u. Exit forced.\n", 
+          chr, pos, ncols, (Uint)w->nsamples+2);
+      exit(-1);
+    }
+    appendMatCacheRow(w, chr, pos, values);
+    FREEMEMORY(NULL, chr);
+    FREEMEMORY(NULL, values);
+  }
+  finishMatCacheWriter(w);
+
+  FREEMEMORY(NULL, samples);
+  destructStringset(NULL, csv[0]);
+  FREEMEMORY(NULL, csv);
 }
-        
 
-   
 // /*-------------------------------- fillNAN ---------------------------------
 //  *    
 //  * @brief for replacing NaNs with betaDist
@@ -2711,199 +3305,706 @@ fillNAN(double *values, int **subgroupID, int *subgroupSize, int numberSubGroup,
 
 
 
-/*---------------------------- initProgramParams -----------------------------
+/*---------------------------- initProgramParams -----------------------------
+ *    
+ * @brief initialize program parameters
+ * @author Frank Juehling and Steve Hoffmann 
+ *   
+ */
+
+void
+initProgramParams (metseg_t *nfo)
+{
+  nfo->maxdist=300;
+  nfo->maxseg=-1;
+  nfo->mincpgs=10;
+  nfo->threads=1;
+  nfo->mode=1;
+  nfo->mtc=1;
+  // nfo->nameA = "g1";
+  // nfo->nameB = "g2";
+  nfo->groups = 2; // newcodes
+  nfo->minDMR = 1; // newcodes
+  nfo->mindiff = 0; // newcodes
+  nfo->minDMR2 = 1; // newcodes
+  nfo->mindiff2 = 0; // newcodes
+  nfo->clustering = 0; // newcodes
+  nfo->search = 0;
+  nfo->outputImputed = 0; // newcodes
+  nfo->nthresholds = 0;
+  nfo->thresholds = NULL;
+  nfo->outputLists = NULL;
+  nfo->seq = 0;
+  nfo->fmt = initFormatBuffer();
+  nfo->scratch = initScratch();
+  nfo->stats = initFilterStats();
+  nfo->chunkstats = initChunkStats();
+  nfo->readers = 1;
+  nfo->chrseed = 0;
+  nfo->shardoutput = 0;
+  nfo->trend = 0.6;
+  nfo->minNoA = -1;
+  nfo->minNoB = -1;
+  nfo->minFactor = 0.8;
+  nfo->valley = 0.7;
+  nfo->minMethDist = 0.1;
+  nfo->MWU = generateMannWhitneyCDFMatrix(MAXM, MAXN);
+  //  testMannWhitneyApprox (MAXM, MAXN, nfo->MWU);
+  nfo->randomseed=26061981;
+  return ;
+}
+
+// /*---------------------------- initProgramParams2 -----------------------------
+//  *    
+//  * @brief initialize program parameters that depend on group sizes
+//  * @author Frank Juehling and Steve Hoffmann 
+//  *   
+//  */
+
+// void
+// initProgramParams2 (metseg_t *nfo, int noA, int noB)
+// {
+//   if(nfo->minNoA<0) {
+//         nfo->minNoA = ceil((double)noA * nfo->minFactor);
+//   }
+  
+//   if(nfo->minNoB<0) {
+//         nfo->minNoB = ceil((double)noB * nfo->minFactor);
+//   }
+  
+//   return ;
+// }
+
+
+
+
+
+/*---------------------------- calGroupNumber -----------------------------
+ *    
+ * @brief find all possible combinations(groups). Combinations are stored
+ * as bitsets over the subgroups and are no longer listed on stdout; use
+ * -p 1 to print them to stderr.
+ * @author zzhu
+ *   
+ */
+
+int calGroupNumber(int n, combination_t *comb, int clustering){
+  int w = (n+63)/64;
+  uint64_t Nc, p3 = 1, p2 = 2;
+
+  if (clustering==0)
+  {
+    if (n > 20)
+    {
+      fprintf(stderr, "%d groups are too many for the exhaustive search of combinations; use -S 1. Exit forced.\n", n);
+      exit(-1);
+    }
+    for (int j = 0; j < n; j++)
+    {
+      p3 *= 3;
+      p2 *= 2;
+    }
+    Nc = (p3-p2+1)/2; // number of possible combinations
+  } else {
+    Nc = ((uint64_t)n*(n-1))/2; // number of possible combinations
+  }
+
+  comb->n = Nc;
+  comb->words = w;
+  comb->A = ALLOCMEMORY(NULL, NULL, uint64_t, Nc*w);
+  comb->B = ALLOCMEMORY(NULL, NULL, uint64_t, Nc*w);
+  memset(comb->A, 0, sizeof(uint64_t)*Nc*w);
+  memset(comb->B, 0, sizeof(uint64_t)*Nc*w);
+  comb->groupID = NULL;
+  comb->groupSize = NULL;
+
+  if (clustering==0)
+  {
+    // count in base 3, digit j: 0 unused, 1 group A, 2 group B
+    int digit[n];
+    uint64_t ii = 0; // index for effective combinations
+    memset(digit, 0, sizeof(int)*n);
+    while (ii < Nc)
+    {
+      int j, sumA = 0, sumB = 0;
+      int validAB; // to exclude duplicates
+      for (j = 0; j < n && digit[j] == 2; j++) digit[j] = 0;
+      if (j == n) break;
+      digit[j]++;
+
+      for (j = 0; j < n; j++)
+      {
+        sumA += (digit[j] == 1);
+        sumB += (digit[j] == 2);
+      }
+      // the last subgroup in use has to be in group B
+      for (j = n-1; digit[j] == 0; j--);
+      validAB = (digit[j] == 2);
+      if ((sumA>0)&&(sumB>0)&&(validAB))
+      {
+        for (j = 0; j < n; j++)
+        {
+          if (digit[j] == 1) SETCOMBBIT(comb->A, ii, j, w);
+          if (digit[j] == 2) SETCOMBBIT(comb->B, ii, j, w);
+        }
+        ii++;
+      }
+    }
+  }
+  else {
+    uint64_t ii = 0; // index for effective combinations
+    for (int i = 0; i < n; i++)
+    {
+      for (int j = i+1; j < n; j++)
+      {
+        SETCOMBBIT(comb->A, ii, i, w);
+        SETCOMBBIT(comb->B, ii, j, w);
+        ii++;
+      }
+    }
+  }
+
+  return Nc;
+}
+
+/*---------------------------- combinationGroups -----------------------------
+ *    
+ * @brief collect the sample columns of both sides of each combination
+ * @author zzhu
+ *   
+ */
+
+void combinationGroups(combination_t *comb, int **subgroupID, int *subgroupSize, int n){
+  int w = comb->words;
+
+  comb->groupID = ALLOCMEMORY(NULL, NULL, int**, 2);
+  comb->groupSize = ALLOCMEMORY(NULL, NULL, int*, 2);
+  for (int s = 0; s < 2; s++)
+  {
+    uint64_t *bits = (s == 0) ? comb->A : comb->B;
+    comb->groupID[s] = ALLOCMEMORY(NULL, NULL, int*, comb->n);
+    comb->groupSize[s] = ALLOCMEMORY(NULL, NULL, int, comb->n);
+    for (int c = 0; c < comb->n; c++)
+    {
+      int size = 0, k = 0;
+      for (int j = 0; j < n; j++)
+      {
+        if (COMBBIT(bits, c, j, w)) size += subgroupSize[j];
+      }
+      comb->groupID[s][c] = ALLOCMEMORY(NULL, NULL, int, size);
+      comb->groupSize[s][c] = size;
+      for (int j = 0; j < n; j++)
+      {
+        if (!COMBBIT(bits, c, j, w)) continue;
+        memcpy(&comb->groupID[s][c][k], subgroupID[j], sizeof(int)*subgroupSize[j]);
+        k += subgroupSize[j];
+      }
+    }
+  }
+}
+
+/*---------------------------- destructCombinations -----------------------------
+ *    
+ * @brief release combinations
+ * @author zzhu
+ *   
+ */
+
+void destructCombinations(combination_t *comb){
+  if (comb->groupID)
+  {
+    for (int s = 0; s < 2; s++)
+    {
+      for (int c = 0; c < comb->n; c++)
+      {
+        FREEMEMORY(NULL, comb->groupID[s][c]);
+      }
+      FREEMEMORY(NULL, comb->groupID[s]);
+      FREEMEMORY(NULL, comb->groupSize[s]);
+    }
+    FREEMEMORY(NULL, comb->groupID);
+    FREEMEMORY(NULL, comb->groupSize);
+  }
+  FREEMEMORY(NULL, comb->A);
+  FREEMEMORY(NULL, comb->B);
+}
+
+/*---------------------------- cmp_groupmean -----------------------------
+ *    
+ * @brief order subgroups by mean, ties by subgroup index
+ * @author zzhu
+ *   
+ */
+
+typedef struct{
+  double mean;
+  int id;
+} groupmean_t;
+
+static int cmp_groupmean(const void *a, const void *b){
+  const groupmean_t *x = a, *y = b;
+  if (x->mean < y->mean) return -1;
+  if (x->mean > y->mean) return 1;
+  return x->id - y->id;
+}
+
+/*---------------------------- cmp_splitkey -----------------------------
+ *    
+ * @brief order per-CpG splits by hash, then by CpG
+ * @author zzhu
+ *   
+ */
+
+typedef struct{
+  uint64_t hash;
+  int cpg;
+  int count;
+} splitkey_t;
+
+static int cmp_splitkey(const void *a, const void *b){
+  const splitkey_t *x = a, *y = b;
+  if (x->hash != y->hash) return (x->hash < y->hash) ? -1 : 1;
+  return x->cpg - y->cpg;
+}
+
+static int cmp_splitcount(const void *a, const void *b){
+  const splitkey_t *x = a, *y = b;
+  if (x->count != y->count) return y->count - x->count;
+  return x->cpg - y->cpg;
+}
+
+/*---------------------------- orderedCombinations -----------------------------
+ *    
+ * @brief candidate combinations of a segment for -S 1. The subgroups are
+ * sorted by their mean over the segment and each of the n-1 cuts of that
+ * order gives a hypo (group A) versus hyper (group B) split. Single CpGs
+ * add the cut at their largest gap between sorted subgroup means if it is
+ * at least -w; the n-1 most frequent of these are kept as well, so local
+ * DMRs with another order are not lost. At most 2(n-1) combinations are
+ * tested instead of (3^n-2^(n+1)+1)/2.
+ * @author zzhu
+ *   
+ */
+
+void orderedCombinations(segment_t *seg, int **subgroupID, int *subgroupSize, metseg_t *nfo, combination_t *comb){
+  int n = nfo->groups, w = (n+63)/64;
+  int i, j, k, c = 0, nkeys = 0;
+  groupmean_t gm[n];
+  uint64_t *cpgbits;
+  splitkey_t *keys;
+
+  comb->words = w;
+  comb->A = ALLOCMEMORY(NULL, NULL, uint64_t, (size_t)2*n*w);
+  comb->B = ALLOCMEMORY(NULL, NULL, uint64_t, (size_t)2*n*w);
+  memset(comb->A, 0, sizeof(uint64_t)*2*n*w);
+  memset(comb->B, 0, sizeof(uint64_t)*2*n*w);
+  comb->groupID = NULL;
+  comb->groupSize = NULL;
+
+  // cuts of the order over the whole segment
+  for (j = 0; j < n; j++)
+  {
+    double sum = 0;
+    for (i = 0; i < seg->n; i++)
+    {
+      for (k = 0; k < subgroupSize[j]; k++) sum += seg->value[i][subgroupID[j][k]];
+    }
+    gm[j].mean = sum/((double)seg->n*subgroupSize[j]);
+    gm[j].id = j;
+  }
+  qsort(gm, n, sizeof(groupmean_t), cmp_groupmean);
+  for (k = 1; k < n; k++, c++)
+  {
+    for (j = 0; j < k; j++) SETCOMBBIT(comb->A, c, gm[j].id, w);
+  }
+
+  // largest gap at each CpG
+  cpgbits = ALLOCMEMORY(NULL, NULL, uint64_t, (size_t)seg->n*w);
+  keys = ALLOCMEMORY(NULL, NULL, splitkey_t, seg->n);
+  memset(cpgbits, 0, sizeof(uint64_t)*seg->n*w);
+  for (i = 0; i < seg->n; i++)
+  {
+    int cut = 0;
+    double gap = -1;
+    uint64_t h = 1469598103934665603ULL;
+    for (j = 0; j < n; j++)
+    {
+      double sum = 0;
+      for (k = 0; k < subgroupSize[j]; k++) sum += seg->value[i][subgroupID[j][k]];
+      gm[j].mean = sum/subgroupSize[j];
+      gm[j].id = j;
+    }
+    qsort(gm, n, sizeof(groupmean_t), cmp_groupmean);
+    for (k = 1; k < n; k++)
+    {
+      if (gm[k].mean-gm[k-1].mean > gap)
+      {
+        gap = gm[k].mean-gm[k-1].mean;
+        cut = k;
+      }
+    }
+    if (cut == 0 || gap <= 0 || gap < nfo->mindiff) continue;
+    for (j = 0; j < cut; j++) SETCOMBBIT(cpgbits, nkeys, gm[j].id, w);
+    for (j = 0; j < w; j++)
+    {
+      h = (h ^ cpgbits[(size_t)nkeys*w+j]) * 1099511628211ULL;
+    }
+    keys[nkeys].hash = h;
+    keys[nkeys].cpg = nkeys;
+    keys[nkeys].count = 1;
+    nkeys++;
+  }
+
+  // count equal splits, most frequent first
+  qsort(keys, nkeys, sizeof(splitkey_t), cmp_splitkey);
+  int nruns = 0;
+  for (i = 0; i < nkeys; i++)
+  {
+    if (nruns > 0 && keys[nruns-1].hash == keys[i].hash &&
+        memcmp(&cpgbits[(size_t)keys[nruns-1].cpg*w], &cpgbits[(size_t)keys[i].cpg*w], sizeof(uint64_t)*w) == 0)
+    {
+      keys[nruns-1].count++;
+    } else {
+      keys[nruns++] = keys[i];
+    }
+  }
+  qsort(keys, nruns, sizeof(splitkey_t), cmp_splitcount);
+  for (i = 0; i < nruns && c < 2*(n-1); i++)
+  {
+    uint64_t *bits = &cpgbits[(size_t)keys[i].cpg*w];
+    for (k = 0; k < c; k++)
+    {
+      if (memcmp(&comb->A[(size_t)k*w], bits, sizeof(uint64_t)*w) == 0) break;
+    }
+    if (k < c) continue;
+    memcpy(&comb->A[(size_t)c*w], bits, sizeof(uint64_t)*w);
+    c++;
+  }
+  FREEMEMORY(NULL, cpgbits);
+  FREEMEMORY(NULL, keys);
+
+  // group B is the rest
+  for (k = 0; k < c; k++)
+  {
+    for (j = 0; j < n; j++)
+    {
+      if (!COMBBIT(comb->A, k, j, w)) SETCOMBBIT(comb->B, k, j, w);
+    }
+  }
+  comb->n = c;
+  combinationGroups(comb, subgroupID, subgroupSize, n);
+}
+
+/*---------------------------- comparisonString -----------------------------
+ *    
+ * @brief describe combination c as 1 (group A), 2 (group B) or 0 per
+ * subgroup, separated by '|'
+ * @author zzhu
+ *   
+ */
+
+void comparisonString(combination_t *comb, int c, int n, char **str){
+  int side[n];
+  for (int j = 0; j < n; j++)
+  {
+    side[j] = COMBBIT(comb->A, c, j, comb->words) ? 1 : 
+      (COMBBIT(comb->B, c, j, comb->words) ? 2 : 0);
+  }
+  size_t len = 0;
+  *str = NULL;
+  concatIntsToString(str, &len, side, n, '|');
+}
+
+/*---------------------------- selectGroups -----------------------------
+ *    
+ * @brief select meaningful combinations(groups)
+ * @author zzhu
+ *   
+ */
+
+// int selectGroups(int Nc, int ***grpA_subgroups, int ***grpB_subgroups){
+//   /* TBC */
+//   return 0;
+// }
+
+/*------------------------------- initOutputList -------------------------------
+ *    
+ * @brief allocate an empty output list
+ * @author zzhu
+ *   
+ */
+
+list_out*
+initOutputList() {
+  list_out *list = ALLOCMEMORY(NULL, NULL, list_out, 1);
+  list->n=1024;
+  list->i=0;
+  list->numberTests=0;
+  list->segment_out = ALLOCMEMORY(NULL, NULL, segment_out, list->n);
+  return list;
+}
+
+/*------------------------------ destructOutputList ------------------------------
+ *    
+ * @brief free an output list
+ * @author zzhu
+ *   
+ */
+
+void
+destructOutputList(list_out *list) {
+  for(int i=0;i<list->i;i++){
+    FREEMEMORY(NULL, list->segment_out[i].chr);
+  }
+  FREEMEMORY(NULL, list->segment_out);
+  FREEMEMORY(NULL, list);
+}
+
+/*------------------------------ growOutputList ------------------------------
+ *    
+ * @brief make room for the next entry of an output list
+ * @author zzhu
+ *   
+ */
+
+void
+growOutputList(list_out *list) {
+  if(list->i >= list->n) {
+    list->n *= 2;
+    list->segment_out = ALLOCMEMORY(NULL, list->segment_out, segment_out, list->n);
+  }
+}
+
+/*------------------------------- cmp_seqkey ---------------------------------
+ *    
+ * @brief order output entries by seq, then by their place in the list
+ * @author zzhu
+ *   
+ */
+
+static int cmp_seqkey(const void *a, const void *b){
+  const int *x = a, *y = b;
+  if(x[0] != y[0]) return (x[0] < y[0]) ? -1 : 1;
+  return (x[1] > y[1]) - (x[1] < y[1]);
+}
+
+/*------------------------------ sortOutputList ------------------------------
+ *    
+ * @brief order the entries of a worker by seq. The pool hands out the
+ * largest tasks first, so a worker holds ascending runs of seq; the
+ * entries of one seq keep their order
+ * @author zzhu
+ *   
+ */
+
+void
+sortOutputList(list_out *list) {
+  int (*keys)[2] = ALLOCMEMORY(NULL, NULL, int[2], list->i+1);
+  segment_out *sorted = ALLOCMEMORY(NULL, NULL, segment_out, list->n);
+  int i;
+
+  for(i=0; i < list->i; i++) {
+    keys[i][0] = list->segment_out[i].seq;
+    keys[i][1] = i;
+  }
+  qsort(keys, list->i, sizeof(int[2]), cmp_seqkey);
+  for(i=0; i < list->i; i++) {
+    sorted[i] = list->segment_out[keys[i][1]];
+  }
+  FREEMEMORY(NULL, list->segment_out);
+  list->segment_out = sorted;
+  FREEMEMORY(NULL, keys);
+}
+
+/*----------------------------- mergeOutputLists -----------------------------
+ *    
+ * @brief merge k output lists, each ordered by seq, into one list in input
+ * order; the entries are moved and the k lists are freed
+ * @author zzhu
+ *   
+ */
+
+list_out*
+mergeOutputLists(list_out **lists, int k) {
+  list_out *merged = ALLOCMEMORY(NULL, NULL, list_out, 1);
+  int pos[k];
+  int i, j, next;
+
+  merged->n = 1;
+  merged->numberTests = 0;
+  for(j=0; j < k; j++) {
+    merged->n += lists[j]->i;
+    merged->numberTests += lists[j]->numberTests;
+    pos[j] = 0;
+  }
+  merged->segment_out = ALLOCMEMORY(NULL, NULL, segment_out, merged->n);
+
+  for(i=0; i < merged->n-1; i++) {
+    next = -1;
+    for(j=0; j < k; j++) {
+      if(pos[j] < lists[j]->i && (next == -1 || 
+            lists[j]->segment_out[pos[j]].seq < lists[next]->segment_out[pos[next]].seq)) {
+        next = j;
+      }
+    }
+    merged->segment_out[i] = lists[next]->segment_out[pos[next]++];
+  }
+  merged->i = merged->n-1;
+
+  for(j=0; j < k; j++) {
+    FREEMEMORY(NULL, lists[j]->segment_out);
+    FREEMEMORY(NULL, lists[j]);
+  }
+  return merged;
+}
+
+/*----------------------------- initFormatBuffer -----------------------------
  *    
- * @brief initialize program parameters
- * @author Frank Juehling and Steve Hoffmann 
+ * @brief allocate empty format buffers for one thread
+ * @author zzhu
  *   
  */
 
-void
-initProgramParams (metseg_t *nfo)
-{
-  nfo->maxdist=300;
-  nfo->maxseg=-1;
-  nfo->mincpgs=10;
-  nfo->threads=1;
-  nfo->mode=1;
-  nfo->mtc=1;
-  // nfo->nameA = "g1";
-  // nfo->nameB = "g2";
-  nfo->groups = 2; // newcodes
-  nfo->minDMR = 1; // newcodes
-  nfo->mindiff = 0; // newcodes
-  nfo->minDMR2 = 1; // newcodes
-  nfo->mindiff2 = 0; // newcodes
-  nfo->clustering = 0; // newcodes
-  nfo->outputImputed = 0; // newcodes
-  nfo->trend = 0.6;
-  nfo->minNoA = -1;
-  nfo->minNoB = -1;
-  nfo->minFactor = 0.8;
-  nfo->valley = 0.7;
-  nfo->minMethDist = 0.1;
-  nfo->MWU = generateMannWhitneyCDFMatrix(MAXM, MAXN);
-  //  testMannWhitneyApprox (MAXM, MAXN, nfo->MWU);
-  nfo->randomseed=26061981;
-  return ;
+fmtbuf_t*
+initFormatBuffer() {
+  fmtbuf_t *fmt = ALLOCMEMORY(NULL, NULL, fmtbuf_t, 1);
+  for(int i=0; i < 2; i++) {
+    fmt->str[i] = NULL;
+    fmt->len[i] = 0;
+  }
+  return fmt;
 }
 
-// /*---------------------------- initProgramParams2 -----------------------------
-//  *    
-//  * @brief initialize program parameters that depend on group sizes
-//  * @author Frank Juehling and Steve Hoffmann 
-//  *   
-//  */
-
-// void
-// initProgramParams2 (metseg_t *nfo, int noA, int noB)
-// {
-//   if(nfo->minNoA<0) {
-//         nfo->minNoA = ceil((double)noA * nfo->minFactor);
-//   }
-  
-//   if(nfo->minNoB<0) {
-//         nfo->minNoB = ceil((double)noB * nfo->minFactor);
-//   }
-  
-//   return ;
-// }
+/*--------------------------- destructFormatBuffer ---------------------------
+ *    
+ * @brief free the format buffers of one thread
+ * @author zzhu
+ *   
+ */
 
+void
+destructFormatBuffer(fmtbuf_t *fmt) {
+  for(int i=0; i < 2; i++) {
+    if(fmt->str[i]) FREEMEMORY(NULL, fmt->str[i]);
+  }
+  FREEMEMORY(NULL, fmt);
+}
 
+/*-------------------------------- startWorkers --------------------------------
+ *    
+ * @brief give every worker its own copy of nfo and start the thread pool;
+ * a bounded queue of two batches per worker lets the reader parse ahead
+ * @author zzhu
+ *   
+ */
 
+threadpool_t*
+startWorkers(metseg_t *th_nfo, void **th_args, metseg_t *nfo, threadpool_fn fn,
+    int ***groupID, int **groupSize, int groupNumber, int **subgroupID, int *subgroupSize) {
+
+  for(int i=0; i < nfo->threads; i++) {
+    memmove(&th_nfo[i], nfo, sizeof(metseg_t));
+    th_nfo[i].groupID = groupID;
+    th_nfo[i].groupSize = groupSize;
+    th_nfo[i].groupNumber = groupNumber;
+    th_nfo[i].subgroupID = subgroupID;
+    th_nfo[i].subgroupSize = subgroupSize;
+    th_nfo[i].threadno = i;
+    th_nfo[i].outputList = initOutputList();
+    if(nfo->nthresholds > 0) {
+      th_nfo[i].outputLists = ALLOCMEMORY(NULL, NULL, list_out*, nfo->nthresholds);
+      for(int k=0; k < nfo->nthresholds; k++) {
+        th_nfo[i].outputLists[k] = initOutputList();
+      }
+    }
+    th_nfo[i].fmt = initFormatBuffer();
+    th_nfo[i].scratch = initScratch();
+    th_nfo[i].stats = initFilterStats();
+    th_nfo[i].chunkstats = initChunkStats();
+    th_args[i] = &th_nfo[i];
+  }
 
+  return initThreadPool(nfo->threads, POOLQUEUE*nfo->threads, fn, th_args);
+}
 
-/*---------------------------- calGroupNumber -----------------------------
+/*------------------------------- collectWorkers -------------------------------
  *    
- * @brief find all possible combinations(groups)
+ * @brief after the pool has finished, merge the output lists of the workers
+ * into those of nfo in input order, so the output does not depend on -t,
+ * and add up their rejection counters and chunk statistics
  * @author zzhu
  *   
  */
 
-int calGroupNumber(int n, int ***grpA_subgroups, int ***grpB_subgroups, int clustering){
-  if (clustering==0)
-  {
-    int Nc = (pow(3,n)-pow(2,n+1)+1)/2; // number of possible combinations
-    // fprintf(stderr, "# Combination %d\n",Nc);
-    int **A_subgroups;
-    int **B_subgroups;
-    A_subgroups = ALLOCMEMORY(NULL, NULL, int*, Nc);
-    B_subgroups = ALLOCMEMORY(NULL, NULL, int*, Nc);
-    for (int i = 0; i < Nc; i++)
-    {
-      A_subgroups[i] = NULL;
-      A_subgroups[i] = ALLOCMEMORY(NULL, A_subgroups[i], int, n);
-      B_subgroups[i] = NULL;
-      B_subgroups[i] = ALLOCMEMORY(NULL, B_subgroups[i], int, n);
-      for (int j = 0; j < n; j++)
-      {
-        A_subgroups[i][j] = 0;
-        B_subgroups[i][j] = 0;
-      }
-    }
-    int ii = 0; // index for effective combinations
-    for (int i = 0; i < pow(3,n); i++)
-    {
-      int i_copy = i;
-      int sumA = 0;
-      int sumB = 0;
-      int validAB=0; // to exclude duplicates
-      for (int j = 0; j < n; j++)
-      {
-        if (i_copy%3 == 1) {
-          A_subgroups[ii][j] = 1;
-          sumA++;
-          validAB = 0;
-        }
-        if (i_copy%3 == 2) {
-          B_subgroups[ii][j] = 1;
-          sumB++;
-          validAB = 1;
-        }
-        i_copy /= 3;
-      }
-      
-      if ((sumA>0)&&(sumB>0)&&(validAB))
-      {
-        fprintf(stdout, "# Combination %d:\tGroup A subgroups: ",ii);
-        for (int j = 0; j < n; j++)
-        {
-          if (A_subgroups[ii][j] == 1) {fprintf(stdout, "%d,",j);}
-        }
-        fprintf(stdout, "\tGroup B subgroups: ");
-        for (int j = 0; j < n; j++)
-        {
-          if (B_subgroups[ii][j] == 1) {fprintf(stdout, "%d,",j);}
-        }
-        fprintf(stdout, "\n");
-        ii++;
-        if (ii==Nc)
-        {
-          break;
-        }
-      } else {
-        for (int j = 0; j < n; j++)
-        {
-          A_subgroups[ii][j] = 0;
-          B_subgroups[ii][j] = 0;
-        }
-      }
+void
+collectWorkers(metseg_t *th_nfo, metseg_t *nfo) {
+  list_out *lists[nfo->threads+1];
+  int i, k;
+
+  lists[0] = nfo->outputList;
+  for(i=0; i < nfo->threads; i++) {
+    lists[i+1] = th_nfo[i].outputList;
+    sortOutputList(lists[i+1]);
+  }
+  nfo->outputList = mergeOutputLists(lists, nfo->threads+1);
+
+  for(k=0; k < nfo->nthresholds; k++) {
+    lists[0] = nfo->outputLists[k];
+    for(i=0; i < nfo->threads; i++) {
+      lists[i+1] = th_nfo[i].outputLists[k];
+      sortOutputList(lists[i+1]);
     }
-    *grpA_subgroups = A_subgroups;
-    *grpB_subgroups = B_subgroups;
-    return Nc;
+    nfo->outputLists[k] = mergeOutputLists(lists, nfo->threads+1);
   }
-  else {
-    int Nc = (n*(n-1))/2; // number of possible combinations
-    // fprintf(stderr, "# Combination %d\n",Nc);
-    int **A_subgroups;
-    int **B_subgroups;
-    A_subgroups = ALLOCMEMORY(NULL, NULL, int*, Nc);
-    B_subgroups = ALLOCMEMORY(NULL, NULL, int*, Nc);
-    for (int i = 0; i < Nc; i++)
-    {
-      A_subgroups[i] = NULL;
-      A_subgroups[i] = ALLOCMEMORY(NULL, A_subgroups[i], int, n);
-      B_subgroups[i] = NULL;
-      B_subgroups[i] = ALLOCMEMORY(NULL, B_subgroups[i], int, n);
-      for (int j = 0; j < n; j++)
-      {
-        A_subgroups[i][j] = 0;
-        B_subgroups[i][j] = 0;
-      }
+
+  for(i=0; i < nfo->threads; i++) {
+    if(nfo->nthresholds > 0) {
+      FREEMEMORY(NULL, th_nfo[i].outputLists);
     }
-    int ii = 0; // index for effective combinations
-    for (int i = 0; i < n; i++)
-    {
-      int i_copy = i;
-      for (int j = i+1; j < n; j++)
-      {
-        A_subgroups[ii][i] = 1;
-        B_subgroups[ii][j] = 1;
-        // fprintf(stdout, "# Combination %d:\tGroup A subgroups: %d,\tGroup B subgroups: %d,\n",ii,i,j);
-        ii++;
-      }
+    destructFormatBuffer(th_nfo[i].fmt);
+    destructScratch(th_nfo[i].scratch);
+    nfo->stats->candidates += th_nfo[i].stats->candidates;
+    nfo->stats->sigcpgs += th_nfo[i].stats->sigcpgs;
+    nfo->stats->mincpgs += th_nfo[i].stats->mincpgs;
+    nfo->stats->trend += th_nfo[i].stats->trend;
+    nfo->stats->valley += th_nfo[i].stats->valley;
+    nfo->stats->tested += th_nfo[i].stats->tested;
+    nfo->stats->reused += th_nfo[i].stats->reused;
+    FREEMEMORY(NULL, th_nfo[i].stats);
+    nfo->chunkstats->chunks += th_nfo[i].chunkstats->chunks;
+    nfo->chunkstats->cpgs += th_nfo[i].chunkstats->cpgs;
+    nfo->chunkstats->seconds += th_nfo[i].chunkstats->seconds;
+    if(th_nfo[i].chunkstats->maxcpgs > nfo->chunkstats->maxcpgs) {
+      nfo->chunkstats->maxcpgs = th_nfo[i].chunkstats->maxcpgs;
     }
-    *grpA_subgroups = A_subgroups;
-    *grpB_subgroups = B_subgroups;
-    return Nc;
+    if(th_nfo[i].chunkstats->maxseconds > nfo->chunkstats->maxseconds) {
+      nfo->chunkstats->maxseconds = th_nfo[i].chunkstats->maxseconds;
+      nfo->chunkstats->slowcpgs = th_nfo[i].chunkstats->slowcpgs;
+    }
+    FREEMEMORY(NULL, th_nfo[i].chunkstats);
   }
-  
 }
 
-
-
-/*---------------------------- selectGroups -----------------------------
+/*------------------------------ outputSegmentRow ------------------------------
  *    
- * @brief select meaningful combinations(groups)
+ * @brief print one DMR of mode 1 or 2 without the line break; exact (-E)
+ * prints meandiff and p at full precision
  * @author zzhu
  *   
  */
 
-// int selectGroups(int Nc, int ***grpA_subgroups, int ***grpB_subgroups){
-//   /* TBC */
-//   return 0;
-// }
+void
+outputSegmentRow(segment_out *so, int clustering, int search, int exact) {
+  fprintf(stdout, exact ? "%s\t%d\t%d\t%.5g\t%.17g\t%d\t%.5g\t%.17g\t%s" : "%s\t%d\t%d\t%.5g\t%f\t%d\t%.5g\t%.5g\t%s", 
+      so->chr, so->start, so->stop, so->q, so->meandiff, so->length,                
+      so->mwu, so->p, so->methA);
+  if (clustering==1 || search==1)
+  {
+    fprintf(stdout, "\t%s", so->methB);
+  } else {
+    fprintf(stdout, "\t%f", so->sigcp);
+  }
+}
 
 /*----------------------------------- main -----------------------------------
  *    
@@ -2922,16 +4023,31 @@ int main(int argc, char** argv) {
   manopt_intconstraint clusteringconstraint;
   metseg_t nfo; // zzhu$ nfo(metseg_t): parameters for the whole process and input data.
   metseg_t *th_nfo;
-  stringset_t **csv, **bedcsv, **headercsv; // zzhu$ input table
-  fileiterator_t *fi, *bedfi, *headerfi;
-  unsigned int i, j, k, ln, bedln, headerln;
-  pthread_t *threads = NULL;
-  pthread_attr_t tattr;
+  stringset_t **csv = NULL, **bedcsv, **headercsv; // zzhu$ input table
+  fileiterator_t *fi = NULL, *bedfi, *headerfi;
+  unsigned int i, j, k, bedln, headerln;
+  threadpool_t *pool = NULL;
+  batch_t *batch = NULL;
+  void **th_args;
   char *bedfile = NULL;
   char *headerfile = NULL;
-
-
-  char **chr = NULL;
+  char *cachefile = NULL;
+  char *thresholdlist = NULL;
+  char *chrlist = NULL;
+  matcache_t *mc = NULL;
+  inputindex_t *idx = NULL;
+  inputreader_t *ir = NULL;
+  char *rowchr = NULL;
+  int rowpos = 0;
+  Uint ncols = 0;
+  double *values = NULL;
+  int nan = 0;
+
+
+  char *chr = NULL; // chromosome of the current chunk
+  chrnames_t chrnames = {NULL, 0, NULL, 0, NULL, 0};
+  double *block = NULL;
+  Uint chunkrows = 0, nsamples = 0;
   int *grpA = NULL, noA=0;
   int *grpB = NULL, noB=0;
   double **val = NULL;
@@ -2949,17 +4065,10 @@ int main(int argc, char** argv) {
 
   int numnonnan = 0;
 
-   //we want to detach the threads to automatically have their resources freed
-  pthread_attr_init(&tattr); 
-  pthread_attr_setdetachstate(&tattr,PTHREAD_CREATE_DETACHED);
-
-
-  pthread_mutex_init(&out, NULL);
-  pthread_mutex_init(&cnt, NULL);
 
 // Options  
   manopt_initoptionset(&optset, argv[0], NULL, 
-      "metilene - a tool for fast and sensitive detection of differential DNA methylation\n\nDataInputFile\t\tneeds to be SORTED for chromosomes and genomic positions",
+      "metilene - a tool for fast and sensitive detection of differential DNA methylation\n\nDataInputFile\t\tneeds to be SORTED for chromosomes and genomic positions, may be gzip or bgzip compressed",
       "Implemented by Frank Juehling and Steve Hoffmann, and updated by Zhihan Zhu\n  2015-2026 Bioinformatik Leipzig\n",
       version,
       "Please report bugs to [frank,steve]@bioinf.uni-leipzig.de or zzhu@molgen.mpg.de");
@@ -2974,6 +4083,8 @@ int main(int argc, char** argv) {
       "minimum mean methylation difference", "<n>", NULL, &nfo.minMethDist);
   manopt(&optset, REQUINTOPT, 0, 't', "threads", 
       "number of threads", "<n>", NULL, &nfo.threads);
+  manopt(&optset, REQUINTOPT, 0, 'R', "readers", 
+      "number of threads parsing the text input at once, through the byte-offset index <DataInputFile>.m3i that is built once and reused (mode 1 only); for bgzip input, the number of threads decompressing it", "<n>", NULL, &nfo.readers);
   manopt(&optset, REQUINTOPT, 0, 'f', "mode", 
       "number of method: 1: de-novo, 2: pre-defined regions, 3: DMCs", "<n>", &modeconstraint, &nfo.mode);
   manopt(&optset, REQUINTOPT, 0, 'c', "mtc", 
@@ -3007,6 +4118,8 @@ int main(int argc, char** argv) {
 
   manopt(&optset, REQUINTOPT, 0, 'l', "clustering", 
       "clustering or not: 0: no, 1: yes", "<n>", &clusteringconstraint, &nfo.clustering);
+  manopt(&optset, REQUINTOPT, 0, 'S', "search", 
+      "combinations tested with -l 0: 0: all, 1: ordered by group means per segment (for many groups)", "<n>", &clusteringconstraint, &nfo.search);
 
   manopt(&optset, REQUINTOPT, 0, 'p', "verbose", 
       "print segmenting position: 0: no, 1: yes", "<n>", &clusteringconstraint, &verbose);
@@ -3017,6 +4130,17 @@ int main(int argc, char** argv) {
   manopt(&optset, REQUINTOPT, 0, 'O', "outputImputed", 
       "output the matrix with imputed values: 0: no, 1: yes", "<n>", &clusteringconstraint, &nfo.outputImputed);
 
+  manopt(&optset, REQSTRINGOPT, 0, 'T', "thresholds", 
+      "comma-separated minimal differences, each applied as -d, -w and -q in one pass (mode 1 only); rows are tagged by threshold", "<list>", NULL, &thresholdlist);
+  manopt(&optset, REQSTRINGOPT, 0, 'L', "chromosomes", 
+      "comma-separated chromosomes to read, the other rows are skipped (mode 1 only)", "<list>", NULL, &chrlist);
+  manopt(&optset, REQUINTOPT, 0, 'Z', "chrseed", 
+      "reseed the random generator at every chromosome from -s and its name, so the imputation of a chromosome does not depend on the rows before it (mode 1 only): 0: no, 1: yes", "<n>", &clusteringconstraint, &nfo.chrseed);
+  manopt(&optset, REQUINTOPT, 0, 'E', "shardoutput", 
+      "print every tested segment, with meandiff and p at full precision, for merging the outputs of runs on parts of the input (mode 1 only): 0: no, 1: yes", "<n>", &clusteringconstraint, &nfo.shardoutput);
+  manopt(&optset, REQSTRINGOPT, 0, 'C', "cache", 
+      "convert DataInputFile to a binary matrix cache <file> and exit; a cache can be given instead of DataInputFile", "<file>", NULL, &cachefile);
+
 
   args = manopt_getopts(&optset, argc, argv);
   if(args->noofvalues == 1) {
@@ -3026,8 +4150,62 @@ int main(int argc, char** argv) {
 
   srand ((unsigned) nfo.randomseed);
 
+  if(nfo.search == 1 && nfo.clustering == 1) {
+    fprintf(stderr, "Warning: -S 1 only applies to -l 0 and is ignored.\n");
+    nfo.search = 0;
+  }
+
+  if(nfo.readers > 1 && nfo.mode != 1 && !isCompressedInput(args->values[1])) {
+    fprintf(stderr, "Warning: -R only applies to mode 1 or compressed input and is ignored.\n");
+    nfo.readers = 1;
+  }
+
+  if((chrlist || nfo.chrseed || nfo.shardoutput) && nfo.mode != 1) {
+    fprintf(stderr, "Warning: -L, -Z and -E only apply to mode 1 and are ignored.\n");
+    chrlist = NULL;
+    nfo.chrseed = 0;
+    nfo.shardoutput = 0;
+  }
+  if(chrlist) {
+    selectChrNames(&chrnames, chrlist);
+  }
+
+  if(thresholdlist) {
+    if(nfo.mode != 1) {
+      fprintf(stderr, "Error: -T is only supported in mode 1. Exit forced.\n");
+      exit(-1);
+    }
+    char *tok = strtok(thresholdlist, ",");
+    while(tok) {
+      nfo.thresholds = ALLOCMEMORY(NULL, nfo.thresholds, double, nfo.nthresholds+1);
+      nfo.thresholds[nfo.nthresholds] = atof(tok);
+      nfo.outputLists = ALLOCMEMORY(NULL, nfo.outputLists, list_out*, nfo.nthresholds+1);
+      nfo.outputLists[nfo.nthresholds] = initOutputList();
+      nfo.nthresholds++;
+      tok = strtok(NULL, ",");
+    }
+  }
+
+
+  mc = openMatCache(args->values[1]);
+  if(!mc) {
+    fi = initFileIteratorThreads(NULL, args->values[1], nfo.readers);
+  }
 
-  fi = initFileIterator(NULL, args->values[1]);
+  if(cachefile) {
+    if(mc) {
+      fprintf(stderr, "Error: %s is already a matrix cache. Exit forced.\n", args->values[1]);
+      exit(-1);
+    }
+    writeInputCache(fi, cachefile);
+    closeFileIterator(NULL, fi);
+    FREEMEMORY(NULL, fi);
+    destructMannWhitneyCDFMatrix(nfo.MWU, MAXM, MAXN);
+    manopt_destructoptionset(&optset);
+    manopt_destructarg(args);
+    FREEMEMORY(NULL, args);
+    exit(EXIT_SUCCESS);
+  }
 
   // newcodes
   // /* check if groups are prefixes from one another */
@@ -3038,8 +4216,29 @@ int main(int argc, char** argv) {
   //   exit(-1);
   // }
 
-  /* read header line with ids and assign to groups (prefix matches only) */
-  ln = readcsvlines(NULL, fi, '\t', 1, &csv);
+  /* skip header line of the text input; ids and groups come from the header file */
+  if(fi) {
+    readcsvlines(NULL, fi, '\t', 1, &csv);
+    destructStringset(NULL, csv[0]);
+    FREEMEMORY(NULL, csv);
+    csv = NULL;
+  }
+
+  /* the indexed blocks start after the header line; compressed input is
+   * decompressed by the -R threads instead */
+  if(fi && nfo.readers > 1 && !isCompressedInput(args->values[1])) {
+    idx = loadInputIndex(args->values[1], verbose);
+    //only the blocks of the selected chromosomes are parsed
+    for(i=0, k=0; i < idx->n; i++) {
+      if(isSelectedChr(&chrnames, idx->blocks[i].chr)) {
+        idx->blocks[k++] = idx->blocks[i];
+      } else {
+        FREEMEMORY(NULL, idx->blocks[i].chr);
+      }
+    }
+    idx->n = k;
+    ir = initInputReader(args->values[1], idx, nfo.readers);
+  }
 
   headerfi = initFileIterator(NULL, headerfile);
   headerln = readcsvlines(NULL, headerfi, '\t', 1, &headercsv);
@@ -3055,7 +4254,7 @@ int main(int argc, char** argv) {
   }
 
   // subgroups: user-defined groups
-  int subgroupNames_int[nfo.groups];char *subgroupNames = NULL;
+  int subgroupNames_int[nfo.groups];char *subgroupNames = NULL;size_t subgroupNamesLen = 0;
   int *subgroupID[nfo.groups];
   int subgroupSize[nfo.groups];
   for (i = 0; i < nfo.groups; i++)
@@ -3086,77 +4285,39 @@ int main(int argc, char** argv) {
     }
   }
   
-  concatIntsToString(&subgroupNames, subgroupNames_int, nfo.groups, '|');
+  concatIntsToString(&subgroupNames, &subgroupNamesLen, subgroupNames_int, nfo.groups, '|');
   // fprintf(stderr, "Single groups %s:\n", subgroupNames);
 
   // all combinations of subgroups
   // char *combinationNames = NULL;
   if(verbose){fprintf(stderr, "start combination.\n");}
   // int groupNumber = nfo.groups*(nfo.groups-1)/2 + nfo.groups; // #one vs one + #one vs others
-  int **grpA_subgroups=NULL;
-  int **grpB_subgroups=NULL;
-  int groupNumber = calGroupNumber(nfo.groups, &grpA_subgroups, &grpB_subgroups, nfo.clustering);
-
-  int ***groupID;
-  int **groupSize;
-  groupID = ALLOCMEMORY(NULL, NULL, int**, 2);
-  groupSize = ALLOCMEMORY(NULL, NULL, int*, 2);
-  for (i = 0; i < 2; i++)
+  combination_t comb;
+  int groupNumber = 0;
+  if (nfo.search == 1)
   {
-    groupID[i] = NULL;
-    groupID[i] = ALLOCMEMORY(NULL, groupID[i], int*, groupNumber);
-    groupSize[i] = NULL;
-    groupSize[i] = ALLOCMEMORY(NULL, groupSize[i], int, groupNumber);
-  }
-  for (i = 0; i < groupNumber; i++)
-  {
-    groupID[0][i] = NULL;
-    groupID[1][i] = NULL;
-    groupSize[0][i] = 0;
-    groupSize[1][i] = 0;
+    // combinations are chosen per segment, see orderedCombinations
+    comb.n = 0;
+    comb.words = (nfo.groups+63)/64;
+    comb.A = NULL;
+    comb.B = NULL;
+  } else {
+    groupNumber = calGroupNumber(nfo.groups, &comb, nfo.clustering);
   }
+  combinationGroups(&comb, subgroupID, subgroupSize, nfo.groups);
+
+  int ***groupID = comb.groupID;
+  int **groupSize = comb.groupSize;
 
   for (i = 0; i < groupNumber; i++)
   {
-    int grpAindex = 0;
-    int grpBindex = 0;
-    
-    // int combinationNames_int[nfo.groups-1];
-    int j2=0;
-    for (j = 0; j < nfo.groups; j++)
-    {
-      if (grpA_subgroups[i][j]==1)
-      {
-        // combinationNames_int[j2++]=j;
-        groupID[0][i] = ALLOCMEMORY(NULL, groupID[0][i], int, groupSize[0][i]+subgroupSize[j]);
-        for (k = 0; k < subgroupSize[j]; k++)
-        {
-          groupID[0][i][grpAindex] = subgroupID[j][k];
-          grpAindex++;
-        }
-        groupSize[0][i] += subgroupSize[j];
-      }
-
-      if (grpB_subgroups[i][j]==1)
-      {
-        // combinationNames_int[j2++]=j;
-        groupID[1][i] = ALLOCMEMORY(NULL, groupID[1][i], int, groupSize[1][i]+subgroupSize[j]);
-        for (k = 0; k < subgroupSize[j]; k++)
-        {
-          groupID[1][i][grpBindex] = subgroupID[j][k];
-          grpBindex++;
-        }
-        groupSize[1][i] += subgroupSize[j];
-      }
-
-    }
-
-    char *tmp=NULL;
-    // concatIntsToString(&tmp, combinationNames_int, nfo.groups-1, ',');
-    // concatStrings(&combinationNames, tmp, '|');
-    // fprintf(stderr, "CombinedGroup: %s\n", combinationNames);
+    j = nfo.groups;
     if ((nfo.clustering == 0)&&(verbose))
     {
+      char *tmp=NULL;
+      comparisonString(&comb, i, nfo.groups, &tmp);
+      fprintf(stderr, "# Combination %d: %s\n", i, tmp);
+      FREEMEMORY(NULL, tmp);
       fprintf(stderr, "CombinedGroup: %d; Size: %d. The following ids belong to the first combined group:\n", i, groupSize[0][i]);
       for (k = 0; k < groupSize[0][i]; k++)
       {
@@ -3176,45 +4337,29 @@ int main(int argc, char** argv) {
   if(verbose){fprintf(stderr, "end combination. # of combination:%d\n", groupNumber);}
   // assert(0);
 
-  destructStringset(NULL, csv[0]);
-  FREEMEMORY(NULL, csv);
   destructStringset(NULL, headercsv[0]);
   FREEMEMORY(NULL, headercsv);
   
-  /* init schedules and idle counter */
-  idle = nfo.threads;
-  schedule = ALLOCMEMORY(NULL, NULL, volatile char, nfo.threads);
-  for(i=0; i < nfo.threads; i++) {
-    schedule[i]=0;
-  }
-  
-  threads = ALLOCMEMORY(space, NULL, pthread_t, nfo.threads);
+  /* worker copies of nfo, filled by startWorkers */
   th_nfo = ALLOCMEMORY(space, NULL, metseg_t, nfo.threads);
-  
-  for(i=0; i < nfo.threads; i++) {
-    memmove(&th_nfo[i], &nfo, sizeof(metseg_t));
-  }
+  th_args = ALLOCMEMORY(space, NULL, void*, nfo.threads);
 
  
   
 //###################### SINGLE CpG mode #########################
   if(nfo.mode == 3) {
       
-      nfo.outputList = ALLOCMEMORY(NULL, NULL, list_out, 1);
-      nfo.outputList->segment_out = ALLOCMEMORY(NULL, NULL, segment_out, 1);
-      nfo.outputList->n=1000000;
-      nfo.outputList->i=0;
-      nfo.outputList->numberTests=0;
-      nfo.outputList->segment_out = ALLOCMEMORY(NULL, NULL, segment_out, nfo.outputList->n);
+      nfo.outputList = initOutputList();
+      if(nfo.threads > 1) {
+        pool = startWorkers(th_nfo, th_args, &nfo, segworker_CpG, groupID, groupSize, groupNumber, subgroupID, subgroupSize);
+      }
     
       
       
-        ln = readcsvlines(NULL, fi, '\t', 1, &csv);
+        ncols = readInputRow(fi, mc, ir, NULL, &rowchr, &rowpos, &values, &nan);
         j = 0;
-        while(ln) {
+        while(ncols) {
 //check missing numbers            
-            double *values = ALLOCMEMORY(NULL, NULL, double, csv[0]->noofstrings);
-            int nan = checkSetNAN(csv, values);
             if(nan>0) {
           //      fprintf(stderr,"call fillNAN");
                 nan = fillNAN(values, subgroupID, subgroupSize, nfo.groups, &nfo);
@@ -3225,24 +4370,13 @@ int main(int argc, char** argv) {
         numnonnan++;
         }
             if(nan>0) {
-                destructStringset(NULL, csv[0]);
-                csv[0] = NULL;
-                FREEMEMORY(NULL, csv);
-                csv = NULL;
-                ln = readcsvlines(NULL, fi, '\t', 1, &csv);
+                FREEMEMORY(NULL, rowchr);
                 FREEMEMORY(NULL, values); 
+                ncols = readInputRow(fi, mc, ir, NULL, &rowchr, &rowpos, &values, &nan);
                 continue;
             } else {
               if (nfo.outputImputed==1){
-                char *subtmp =NULL;
-                outputImputedValues(&subtmp, values, csv[0]->noofstrings, '\t');
-                fprintf(stdout,"//Imputed:");
-                fprintf(stdout, my_strdup(csv[0]->strings[0].str));
-                fprintf(stdout,"\t");
-                fprintf(stdout, csv[0]->strings[1].str);
-                fprintf(stdout,"\t");
-                fprintf(stdout, subtmp);
-                fprintf(stdout,"\n");
+                outputImputedRow(rowchr, rowpos, values, ncols);
               }
             }
 
@@ -3260,48 +4394,18 @@ int main(int argc, char** argv) {
             }
             cpg->groupA=groupA;
             cpg->groupB=groupB;
-            cpg->chr = ALLOCMEMORY(NULL, NULL, char, csv[0]->strings[0].len+1);
-            strcpy(cpg->chr, csv[0]->strings[0].str);
+            cpg->chr = rowchr;
+            rowchr = NULL;
             cpg->noA=noA;
             cpg->noB=noB;
-            cpg->start=atoi(csv[0]->strings[1].str);
-            cpg->stop=atoi(csv[0]->strings[1].str);
+            cpg->start=rowpos;
+            cpg->stop=rowpos;
             
             if(nfo.threads > 1) { 
-                //wait for a free thread
-                while(idle == 0);
-                //look for the free slot
-                // for(i=0; i < nfo.threads; i++) {
-                //   if(schedule[i] == 0) break;
-                // }
-                int nofreeslot = 1;
-                while (nofreeslot)
-                {
-                  for(i=0; i < nfo.threads; i++) {
-                    if(schedule[i] == 0) {
-                      nofreeslot = 0;
-                      break;
-                    }
-                  }
-                }
-                //this must always hold because of idle variable
-                assert(i < nfo.threads);
-     //           fprintf(stderr, "starting thread %d\n", i);
-                //decrement the idle and set the schedule
-                pthread_mutex_lock(&cnt);
-                idle--;
-                schedule[i]=1;
-                pthread_mutex_unlock(&cnt);
-                //assign task
-                th_nfo[i].threadno = i;
-                th_nfo[i].cpg=cpg;
-                th_nfo[i].outputList = nfo.outputList;
                 fprintf(stderr, "CpG testing %s-[%d]\n", cpg->chr, cpg->start);
-                //create the thread (detached!)
-                pthread_create(&threads[i], &tattr, segworker_CpG, &th_nfo[i]);
-                //now we must make sure that each thread keeps his own chunk
-                //of the input data, thus the three arrays are simply set to NULL
-                //the thread is going to take care of the deallocation
+                //the worker takes care of the deallocation
+                batch = addBatch(batch, cpg, 1, nfo.seq++);
+                submitBatch(pool, &batch, 0);
                 cpg = NULL;
 
               } else { 
@@ -3313,18 +4417,16 @@ int main(int argc, char** argv) {
                 
                 
                 cpgTest(cpg->chr, cpg->start,cpg->stop,ratio,p,&nfo, cpg->methA, cpg->methB);
+                nfo.seq++;
                 destructCpg(cpg);
               }
             
             
             
-            destructStringset(NULL, csv[0]);
-            csv[0] = NULL;
-            FREEMEMORY(NULL, csv);
-            csv = NULL;
             FREEMEMORY(NULL, values); 
-           ln =readcsvlines(NULL, fi, '\t', 1, &csv);
+           ncols = readInputRow(fi, mc, ir, NULL, &rowchr, &rowpos, &values, &nan);
     }
+    if(pool) submitBatch(pool, &batch, 1);
         
         
         
@@ -3348,12 +4450,10 @@ int main(int argc, char** argv) {
 //###################### DEFINED REGIONS mode#####################
   if(nfo.mode == 2) {
       fprintf(stderr, "Mode 2 -- pre-defined regions\n");
-      nfo.outputList = ALLOCMEMORY(NULL, NULL, list_out, 1);
-      nfo.outputList->segment_out = ALLOCMEMORY(NULL, NULL, segment_out, 1);
-      nfo.outputList->n=1000000;
-      nfo.outputList->i=0;
-      nfo.outputList->numberTests=0;
-      nfo.outputList->segment_out = ALLOCMEMORY(NULL, NULL, segment_out, nfo.outputList->n);
+      nfo.outputList = initOutputList();
+      if(nfo.threads > 1) {
+        pool = startWorkers(th_nfo, th_args, &nfo, segworker_region, groupID, groupSize, groupNumber, subgroupID, subgroupSize);
+      }
     
       
       
@@ -3372,13 +4472,11 @@ int main(int argc, char** argv) {
       set->chr = ALLOCMEMORY(NULL, NULL, char, bedcsv[0]->strings[0].len+1);
       strcpy(set->chr, bedcsv[0]->strings[0].str);
       
-      ln = readcsvlines(NULL, fi, '\t', 1, &csv);
+      ncols = readInputRow(fi, mc, ir, NULL, &rowchr, &rowpos, &values, &nan);
       int l=-1;
-      while(ln) {
+      while(ncols) {
           l++;
 //add missing values          
-          double *values = ALLOCMEMORY(NULL, NULL, double, csv[0]->noofstrings);
-            int nan = checkSetNAN(csv, values);
             if(nan>0) {
   //              fprintf(stdout,"call fillNAN");
                 nan = fillNAN(values, subgroupID, subgroupSize, nfo.groups, &nfo);
@@ -3387,36 +4485,25 @@ int main(int argc, char** argv) {
         numnonnan++;
         }
             if(nan>0) {
-                destructStringset(NULL, csv[0]);
-                csv[0] = NULL;
-                FREEMEMORY(NULL, csv);
-                csv = NULL;
-                ln = readcsvlines(NULL, fi, '\t', 1, &csv);
+                FREEMEMORY(NULL, rowchr);
                 FREEMEMORY(NULL, values); 
+                ncols = readInputRow(fi, mc, ir, NULL, &rowchr, &rowpos, &values, &nan);
                 continue;
             } else {
               if (nfo.outputImputed==1){
-                char *subtmp =NULL;
-                outputImputedValues(&subtmp, values, csv[0]->noofstrings, '\t');
-                fprintf(stdout,"//Imputed:");
-                fprintf(stdout, my_strdup(csv[0]->strings[0].str));
-                fprintf(stdout,"\t");
-                fprintf(stdout, csv[0]->strings[1].str);
-                fprintf(stdout,"\t");
-                fprintf(stdout, subtmp);
-                fprintf(stdout,"\n");
+                outputImputedRow(rowchr, rowpos, values, ncols);
               }
             }
          
           
-          int pos = atoi(csv[0]->strings[1].str);
+          int pos = rowpos;
           
           
       //   fprintf(stdout,"########## %s %d (currChrom %s ,firststop %d, nextChr %s, nextStart %d)\n",csv[0]->strings[0].str,pos,set->chr,set->firststop, set->nextchr,set->nextstart);
           
 //remove filled segments if
 //Size of set >0 AND (currentChrNotNULL  OR  curr.Positon > FirstStopInSet OR  ChromosomeChangeForCpGInput)
-          if(set->n>0 && (set->chr == NULL || pos > set->firststop || (strcmp(set->chr, csv[0]->strings[0].str) != 0))) {
+          if(set->n>0 && (set->chr == NULL || pos > set->firststop || (strcmp(set->chr, rowchr) != 0))) {
 
    //           if((strcmp(set->chr, csv[0]->strings[0].str) != 0))
    //               fprintf(stdout,"CHROMCHANGE\n");
@@ -3425,55 +4512,20 @@ int main(int argc, char** argv) {
               set->firststop=-1;
               while(seg) {
                   segment_t *tmp = seg->next;
-                  if(set->n>0 && ( set->chr == NULL || (strcmp(set->chr, csv[0]->strings[0].str) != 0) || seg->stop<pos)) {
+                  if(set->n>0 && ( set->chr == NULL || (strcmp(set->chr, rowchr) != 0) || seg->stop<pos)) {
        //                 fprintf(stdout,"@@@@@@@@@@Removing seg %s:%d-%d next%d parent%d\n",seg->chr,seg->start,seg->stop,seg->next == NULL,seg->parent == NULL);
                         removeThisSegmentFromSet(set,seg);
                         if(nfo.threads > 1) { 
-                            //wait for a free thread
-                            while(idle == 0);
-                            //look for the free slot
-                            // for(i=0; i < nfo.threads; i++) {
-                            //   if(schedule[i] == 0) break;
-                            // }
-                            int nofreeslot = 1;
-                            while (nofreeslot)
-                            {
-                              for(i=0; i < nfo.threads; i++) {
-                                if(schedule[i] == 0) {
-                                  nofreeslot = 0;
-                                  break;
-                                }
-                              }
-                            }
-                            //this must always hold because of idle variable
-                            assert(i < nfo.threads);
-//                            fprintf(stderr, "starting thread %d\n", i);
-                            //decrement the idle and set the schedule
-                            pthread_mutex_lock(&cnt);
-                            idle--;
-                            schedule[i]=1;
-                            pthread_mutex_unlock(&cnt);
-                            //assign task
-                            th_nfo[i].seg = seg;
-                            th_nfo[i].groupID = groupID;
-                            th_nfo[i].groupSize = groupSize;
-                            th_nfo[i].groupNumber = groupNumber;
-                            th_nfo[i].subgroupID = subgroupID;
-                            th_nfo[i].subgroupSize = subgroupSize;
-                            th_nfo[i].threadno = i;
-                            th_nfo[i].outputList = nfo.outputList;
-          
                             fprintf(stderr, "region testing %s-[%d,%d]\n", seg->chr, seg->start, seg->stop);
-                            //create the thread (detached!)
-                            pthread_create(&threads[i], &tattr, segworker_region, &th_nfo[i]);
-                            //now we must make sure that each thread keeps his own chunk
-                            //of the input data, thus the three arrays are simply set to NULL
-                            //the thread is going to take care of the deallocation
+                            //the worker takes care of the deallocation
+                            batch = addBatch(batch, seg, seg->n, nfo.seq++);
+                            submitBatch(pool, &batch, 0);
                             seg = NULL;
 
                           } else { 
                             fprintf(stderr, "region testing %s-[%d,%d]\n", seg->chr, seg->start, seg->stop);
                             regionTest(seg, groupID, groupSize, groupNumber, subgroupID, subgroupSize, &nfo);
+                            nfo.seq++;
                               
                           }
                   }
@@ -3489,13 +4541,10 @@ int main(int argc, char** argv) {
               }
           }
           
-            if((!set->chr) && set->nextchr && (strcmp(set->nextchr, csv[0]->strings[0].str) != 0)) {
-                 destructStringset(NULL, csv[0]);
-                 csv[0] = NULL;
-                 FREEMEMORY(NULL, csv);
-                 csv = NULL;
-                 ln = readcsvlines(NULL, fi, '\t', 1, &csv);
+            if((!set->chr) && set->nextchr && (strcmp(set->nextchr, rowchr) != 0)) {
+                 FREEMEMORY(NULL, rowchr);
                  FREEMEMORY(NULL, values); 
+                 ncols = readInputRow(fi, mc, ir, NULL, &rowchr, &rowpos, &values, &nan);
                  continue;
              }
           
@@ -3584,14 +4633,14 @@ int main(int argc, char** argv) {
           
           while(seg)  {
 //              fprintf(stdout,"@@@@@@@@@@@@@@@@@@@@@adding seqs now %s %s\n",seg->chr,csv[0]->strings[0].str);
-              if(!strcmp(seg->chr,csv[0]->strings[0].str)) {
+              if(!strcmp(seg->chr,rowchr)) {
 //                fprintf(stderr,"#Adding CpG %s:%s to region %s:%d-%d\n",csv[0]->strings[0].str,csv[0]->strings[1].str,seg->chr,seg->start,seg->stop);
                 seg->pos = ALLOCMEMORY(NULL, seg->pos, int,    seg->n+1); //index
                 seg->value = ALLOCMEMORY(NULL, seg->value, double*, seg->n+1); //cpgs  
 
-                seg->pos[seg->n] = atoi(csv[0]->strings[1].str);
-                seg->value[seg->n] = ALLOCMEMORY(NULL, NULL, double, csv[0]->noofstrings);
-                for(k=2; k < csv[0]->noofstrings; k++) { 
+                seg->pos[seg->n] = rowpos;
+                seg->value[seg->n] = ALLOCMEMORY(NULL, NULL, double, ncols);
+                for(k=2; k < ncols; k++) { 
 //                  seg->value[seg->n][k-2] = atof(csv[0]->strings[k].str);
                     seg->value[seg->n][k-2] = values[k];
                 }
@@ -3600,12 +4649,9 @@ int main(int argc, char** argv) {
           seg = seg->next;    
           }
        //   if(Notbreaking==1){
-            destructStringset(NULL, csv[0]);
-            csv[0] = NULL;
-            FREEMEMORY(NULL, csv);
-            csv = NULL;
+            FREEMEMORY(NULL, rowchr);
             FREEMEMORY(NULL, values); 
-            ln = readcsvlines(NULL, fi, '\t', 1, &csv);
+            ncols = readInputRow(fi, mc, ir, NULL, &rowchr, &rowpos, &values, &nan);
     //      }      
       
        }
@@ -3616,54 +4662,21 @@ int main(int argc, char** argv) {
                   segment_t *tmp = seg->next;
         //          fprintf(stderr,"@@@@@@@@@@Removing seg %s:%d-%d\n",seg->chr,seg->start,seg->stop);
                   if(nfo.threads > 1) { 
-                            //wait for a free thread
-                            while(idle == 0);
-                            //look for the free slot
-                            // for(i=0; i < nfo.threads; i++) {
-                            //   if(schedule[i] == 0) break;
-                            // }
-                            int nofreeslot = 1;
-                            while (nofreeslot)
-                            {
-                              for(i=0; i < nfo.threads; i++) {
-                                if(schedule[i] == 0) {
-                                  nofreeslot = 0;
-                                  break;
-                                }
-                              }
-                            }
-                            //this must always hold because of idle variable
-                            assert(i < nfo.threads);
-                            fprintf(stderr, "starting thread %u\n", i);
-                            //decrement the idle and set the schedule
-                            pthread_mutex_lock(&cnt);
-                            idle--;
-                            schedule[i]=1;
-                            pthread_mutex_unlock(&cnt);
-                            //assign task
-                            th_nfo[i].seg = seg;
-                            th_nfo[i].grpA = grpA;
-                            th_nfo[i].grpB = grpB;
-                            th_nfo[i].noA = noA;
-                            th_nfo[i].noB = noB;
-                            th_nfo[i].threadno = i;
-                            
                             fprintf(stderr, "region testing %s-[%d,%d]\n", seg->chr, seg->start, seg->stop);
-                            //create the thread (detached!)
-                            pthread_create(&threads[i], &tattr, segworker_region, &th_nfo[i]);
-                            //now we must make sure that each thread keeps his own chunk
-                            //of the input data, thus the three arrays are simply set to NULL
-                            //the thread is going to take care of the deallocation
+                            batch = addBatch(batch, seg, seg->n, nfo.seq++);
+                            submitBatch(pool, &batch, 0);
                             seg = NULL;
 
                           } else { 
     //                        fprintf(stderr, "region testing %s-[%d,%d]\n", seg->chr, seg->start, seg->stop);
                             regionTest(seg, groupID, groupSize, groupNumber, subgroupID, subgroupSize, &nfo);
+                            nfo.seq++;
                               
                           }
                   seg = tmp;
               }
     //  if(seg)
+              if(pool) submitBatch(pool, &batch, 1);
               destructSegmentSet(set);
               
           
@@ -3676,21 +4689,23 @@ int main(int argc, char** argv) {
 //###################### SEGMENTER (main) mode ###########################
   if(nfo.mode == 1) {
    //   fprintf(stderr,"#MODE2\n");
-    nfo.outputList = ALLOCMEMORY(NULL, NULL, list_out, 1);
-    nfo.outputList->n=1000000;
-    nfo.outputList->i=0;
-    nfo.outputList->numberTests=0;
-    nfo.outputList->segment_out = ALLOCMEMORY(NULL, NULL, segment_out, nfo.outputList->n);
+    char *seedchr = NULL; // chromosome the generator was seeded for by -Z
+    nfo.outputList = initOutputList();
+    if(nfo.threads > 1) {
+      pool = startWorkers(th_nfo, th_args, &nfo, segworker, groupID, groupSize, groupNumber, subgroupID, subgroupSize);
+    }
     //fprintf(stderr,"output->n: %d\n",nfo.outputList->n);
       
       
-    ln = readcsvlines(NULL, fi, '\t', 1, &csv); // zzhu$ reading the methyl table into variable 'csv'
+    ncols = readInputRow(fi, mc, ir, &chrnames, &rowchr, &rowpos, &values, &nan); // zzhu$ reading the methyl table row by row
     j = 0;
-    while(ln) { 
+    while(ncols) { 
+        if(nfo.chrseed && rowchr != seedchr) {
+          srand(chrSeed(nfo.randomseed, rowchr));
+          seedchr = rowchr;
+        }
         //fprintf(stderr,"#new LINE\n");
 //check missing numbers            
-        double *values = ALLOCMEMORY(NULL, NULL, double, csv[0]->noofstrings);
-        int nan = checkSetNAN(csv, values);
         if(nan>0) {
         // fprintf(stderr,"#call fillNAN for %d groups\n", nfo.groups);
             nan = fillNAN(values, subgroupID, subgroupSize, nfo.groups, &nfo);
@@ -3702,138 +4717,82 @@ int main(int argc, char** argv) {
      //   fprintf(stdout,"#LINES INPUT\n");
         if(nan>0) {
      //       fprintf(stdout,"#REMOVING LINE\n");
-            destructStringset(NULL, csv[0]);
-            csv[0] = NULL;
-            FREEMEMORY(NULL, csv);
-            csv = NULL;
-            ln = readcsvlines(NULL, fi, '\t', 1, &csv);
-            FREEMEMORY(NULL, values); 
+            ncols = readInputRow(fi, mc, ir, &chrnames, &rowchr, &rowpos, &values, &nan);
             continue;
         }
         else {
     //            fprintf(stdout,"#LINE OKAY \n");
               if (nfo.outputImputed==1){
-                char *subtmp =NULL;
-                outputImputedValues(&subtmp, values, csv[0]->noofstrings, '\t');
-                fprintf(stdout,"//Imputed:");
-                fprintf(stdout, my_strdup(csv[0]->strings[0].str));
-                fprintf(stdout,"\t");
-                fprintf(stdout, csv[0]->strings[1].str);
-                fprintf(stdout,"\t");
-                fprintf(stdout, subtmp);
-                fprintf(stdout,"\n");
+                outputImputedRow(rowchr, rowpos, values, ncols);
               }
         }
-      char *x = my_strdup(csv[0]->strings[0].str); //zzhu$ x: chromosome in current line
-      int y = atoi(csv[0]->strings[1].str); //zzhu$ y: CpG position in current line
+      char *x = rowchr; //zzhu$ x: chromosome in current line
+      int y = rowpos; //zzhu$ y: CpG position in current line
 
-      if(j > 0 && (strcmp(x, chr[j-1]) || y > pos[j-1] + nfo.maxdist ||
+      if(j > 0 && (x != chr || y > pos[j-1] + nfo.maxdist ||
                    (nfo.maxseg > 0 && j >= nfo.maxseg))) {
 
         if(nfo.threads > 1) { 
-          //wait for a free thread
-          while(idle == 0);
-          //look for the free slot
-          int nofreeslot = 1;
-          while (nofreeslot)
-          {
-            for(i=0; i < nfo.threads; i++) {
-              if(schedule[i] == 0) {
-                nofreeslot = 0;
-                break;
-              }
-            }
+          chunk_t *chunk = ALLOCMEMORY(NULL, NULL, chunk_t, 1);
+          //hand over the buffers trimmed to the chunk
+          chunk->chr = chr;
+          chunk->pos = ALLOCMEMORY(NULL, pos, int, j);
+          chunk->block = ALLOCMEMORY(NULL, block, double, (size_t)j*nsamples);
+          chunk->value = ALLOCMEMORY(NULL, val, double*, j);
+          for(i=0; i < j; i++) {
+            chunk->value[i] = chunk->block + (size_t)i*nsamples;
           }
-          
-
-          //this must always hold because of idle variable
-          assert(i < nfo.threads);
-  //        fprintf(stderr, "starting thread %d\n", i);
-          //decrement the idle and set the schedule
-          pthread_mutex_lock(&cnt);
-          idle--;
-          schedule[i]=1;
-          pthread_mutex_unlock(&cnt);
-          //assign task
-  /*copied from segworker*/
-  //         segmentation(t->chr, t->pos, t->value, t->n, t->groupID, t->groupSize, t->groupNumber, t->subgroupID, t->subgroupSize, t);
-  
-  // //cleanup own data
-  // for(i=0; i < t->n; i++) {
-  //   FREEMEMORY(NULL, t->chr[i]);
-  //   FREEMEMORY(NULL, t->value[i]);
-  // }
-  // FREEMEMORY(NULL, t->chr);
-  // FREEMEMORY(NULL, t->pos);
-  // FREEMEMORY(NULL, t->value);
-          th_nfo[i].chr = chr;
-          th_nfo[i].pos = pos;
-          th_nfo[i].value = val;
-          th_nfo[i].n = j;
-          th_nfo[i].groupID = groupID;
-          th_nfo[i].groupSize = groupSize;
-          th_nfo[i].groupNumber = groupNumber;
-          th_nfo[i].subgroupID = subgroupID;
-          th_nfo[i].subgroupSize = subgroupSize;
-          th_nfo[i].threadno = i;
-          th_nfo[i].outputList = nfo.outputList;
-          
-          
-          if(verbose){fprintf(stderr, "Thread: %d segmenting %s-[%d,%d], %u CpGs\n", i, chr[0], pos[0], pos[j-1], j);}
-          //create the thread (detached!)
-          pthread_create(&threads[i], &tattr, segworker, &th_nfo[i]);
-          //now we must make sure that each thread keeps his own chunk
-          //of the input data, thus the three arrays are simply set to NULL
-          //the thread is going to take care of the deallocation
-          // fprintf(stderr, "segmented %s-[%d,%d], %u CpGs\n", chr[0], pos[0], pos[j-1], j);
-
-          chr = NULL;
+          chunk->n = j;
+          if(verbose){fprintf(stderr, "Queueing %s-[%d,%d], %u CpGs\n", chr, chunk->pos[0], chunk->pos[j-1], j);}
+          //small chunks are batched, the worker takes care of the deallocation
+          batch = addBatch(batch, chunk, j, nfo.seq++);
+          submitBatch(pool, &batch, 0);
           pos = NULL;
           val = NULL;
+          block = NULL;
+          chunkrows = 0;
 
         } else { 
-          if(verbose){fprintf(stderr, "Segmenting %s-[%d,%d], %u CpGs\n", chr[0], pos[0], pos[j-1],j);}
-          // segmentation(chr, pos, val, j, grpA, noA, grpB, noB, &nfo);
-          segmentation(chr, pos, val, j, groupID, groupSize, groupNumber, subgroupID, subgroupSize, &nfo);
-          for(i=0; i < j; i++) { 
-            FREEMEMORY(NULL, chr[i]);
-            FREEMEMORY(NULL, val[i]);
-          }   
-          // if(nfo.outputList->i>=2){fprintf(stderr,"start7:%d\n",nfo.outputList->segment_out[2].start);}
+          chunk_t piece = {chr, pos, NULL, val, j};
+          if(verbose){fprintf(stderr, "Segmenting %s-[%d,%d], %u CpGs\n", chr, pos[0], pos[j-1],j);}
+          segmentChunk(&piece, groupID, groupSize, groupNumber, subgroupID, subgroupSize, &nfo);
+          nfo.seq++;
+          //the buffers are reused for the next chunk
         }
 
         j = 0;
       } 
 
-      chr = ALLOCMEMORY(NULL, chr, char*,   j+1); //chr
-      pos = ALLOCMEMORY(NULL, pos, int,    j+1); //index
-      val = ALLOCMEMORY(NULL, val, double*, j+1); //cpgs  
-
-      chr[j] = x;
-      pos[j] = y;
-      val[j] = ALLOCMEMORY(NULL, NULL, double, csv[0]->noofstrings);
-
-      for(k=2; k < csv[0]->noofstrings; k++) { 
-//        val[j][k-2] = atof(csv[0]->strings[k].str);
-        val[j][k-2] = values[k];
+      if(nsamples == 0) {
+        nsamples = ncols-2;
+      } else if(ncols-2 < nsamples) {
+        fprintf(stderr, "Error: %s:%d has %u columns, expected %u. Exit forced.\n", 
+            x, y, ncols, nsamples+2);
+        exit(-1);
+      }
+      if(j == chunkrows) {
+        chunkrows = chunkrows ? 2*chunkrows : 16;
+        pos = ALLOCMEMORY(NULL, pos, int, chunkrows); //index
+        val = ALLOCMEMORY(NULL, val, double*, chunkrows); //cpgs
+        block = ALLOCMEMORY(NULL, block, double, (size_t)chunkrows*nsamples);
+        for(i=0; i < j; i++) {
+          val[i] = block + (size_t)i*nsamples;
+        }
       }
 
+      chr = x;
+      pos[j] = y;
+      val[j] = block + (size_t)j*nsamples;
+      memmove(val[j], &values[2], sizeof(double)*nsamples);
 
       j+=1; // zzhu$ j: the number of CpGs in the segment
-      destructStringset(NULL, csv[0]);
-      csv[0] = NULL;
-      FREEMEMORY(NULL, csv);
-      csv = NULL;
-      FREEMEMORY(NULL, values); 
-      ln =readcsvlines(NULL, fi, '\t', 1, &csv);
+      ncols = readInputRow(fi, mc, ir, &chrnames, &rowchr, &rowpos, &values, &nan);
     } 
   
-    if(verbose){fprintf(stderr, "segmenting %s-[%d,%d], %u CpGs \n", chr[0], pos[0], pos[j-1],j);}
-    segmentation(chr, pos, val, j, groupID, groupSize, groupNumber, subgroupID, subgroupSize, &nfo);
-    for(i=0; i < j; i++) { 
-        FREEMEMORY(NULL, chr[i]);
-        FREEMEMORY(NULL, val[i]);
-    }
+    if(pool) submitBatch(pool, &batch, 1);
+    chunk_t last = {chr, pos, NULL, val, j};
+    if(verbose){fprintf(stderr, "segmenting %s-[%d,%d], %u CpGs \n", chr, pos[0], pos[j-1],j);}
+    segmentChunk(&last, groupID, groupSize, groupNumber, subgroupID, subgroupSize, &nfo);
     // if(nfo.outputList->i>=2){fprintf(stderr,"start8:%d\n",nfo.outputList->segment_out[2].start);}
   }
   
@@ -3846,8 +4805,15 @@ int main(int argc, char** argv) {
   
   
   
-  //wait for all threads to terminate
-  while(idle != nfo.threads);
+  //wait for all workers to finish
+  if(pool) {
+    waitThreadPool(pool);
+    destructThreadPool(pool);
+    pool = NULL;
+    collectWorkers(th_nfo, &nfo);
+  }
+  if(verbose){printFilterStats(nfo.stats);}
+  if(verbose && nfo.mode == 1){printChunkStats(nfo.chunkstats);}
 
   if(nfo.mode == 1 || nfo.mode == 2) {
     if(verbose){fprintf(stderr, "Number of Tests: %d\n", nfo.outputList->numberTests);}
@@ -3856,51 +4822,32 @@ int main(int argc, char** argv) {
     // if(nfo.outputList->i>=2){fprintf(stderr,"start92:%d\n",nfo.outputList->segment_out[2].start);}
     if(verbose){fprintf(stderr, "Multiple testing correction done.\n");}
     fprintf(stdout, "#non-NA CpGs:%d\n", numnonnan);
+    if(nfo.nthresholds > 0) {
+      for(k=0; k < nfo.nthresholds; k++) {
+        multiple_testing_correction(nfo.outputLists[k], nfo.mode, nfo.mtc);
+        fprintf(stdout, "#test@%g:%d\n", nfo.thresholds[k], nfo.outputLists[k]->numberTests);
+      }
+      fprintf(stdout, "chr\tstart\tstop\tq\tmeandiff\tlength\tmwu\tp\tmean\tsig.comparison\tthreshold\n");
+      for(k=0; k < nfo.nthresholds; k++) {
+        list_out *list = nfo.outputLists[k];
+        for(int i=0;i<list->i;i++){
+          if(nfo.shardoutput || list->segment_out[i].meandiff >= nfo.thresholds[k] || list->segment_out[i].meandiff <= -1* nfo.thresholds[k]) {
+            outputSegmentRow(&list->segment_out[i], nfo.clustering, nfo.search, nfo.shardoutput);
+            fprintf(stdout, "\t%g\n", nfo.thresholds[k]);
+          }
+        }
+      }
+    } else {
     fprintf(stdout, "#test:%d\n", nfo.outputList->numberTests);
     // fprintf(stdout, "chr\tstart\tstop\tq\tmeandiff\tlength\tmwu\tp\t%s\tsig.comparison\n",subgroupNames);
-    fprintf(stdout, "chr\tstart\tstop\tq\tmeandiff\tlength\tmwu\tp\tmean\tsig.comparison\n",subgroupNames);
+    fprintf(stdout, "chr\tstart\tstop\tq\tmeandiff\tlength\tmwu\tp\tmean\tsig.comparison\n");
     for(int i=0;i<nfo.outputList->i;i++){
-      // fprintf(stderr,"start10:%d\n",nfo.outputList->segment_out[2].start);
       // fprintf(stderr, "TEST %d: %d,%f.\n",i,nfo.outputList->segment_out[i].start,nfo.outputList->segment_out[i].meandiff);
-
-      if (nfo.clustering==1)
-      {
-        if(nfo.outputList->segment_out[i].meandiff >= nfo.minMethDist || nfo.outputList->segment_out[i].meandiff <= -1* nfo.minMethDist) {
-        // if(1) {
-          // fprintf(stderr, "TEST %d: %d,%d.\n",i,nfo.outputList->segment_out[i].start,nfo.outputList->segment_out[i].stop);
-          fprintf(stdout, "%s\t%d\t%d\t%.5g\t%f\t%d\t%.5g\t%.5g\t%s\t%s\n", 
-                  nfo.outputList->segment_out[i].chr,
-                  nfo.outputList->segment_out[i].start,
-                  nfo.outputList->segment_out[i].stop,
-                  nfo.outputList->segment_out[i].q,
-                  nfo.outputList->segment_out[i].meandiff,
-                  nfo.outputList->segment_out[i].length,                
-                  nfo.outputList->segment_out[i].mwu,
-                  nfo.outputList->segment_out[i].p,
-                  nfo.outputList->segment_out[i].methA,
-                  // nfo.outputList->segment_out[i].methB,
-                  nfo.outputList->segment_out[i].methB);
-        }
-      } else {
-        if(nfo.outputList->segment_out[i].meandiff >= nfo.minMethDist || nfo.outputList->segment_out[i].meandiff <= -1* nfo.minMethDist) {
-        // if(1) {
-          // fprintf(stderr, "TEST %d: %d,%d.\n",i,nfo.outputList->segment_out[i].start,nfo.outputList->segment_out[i].stop);
-          fprintf(stdout, "%s\t%d\t%d\t%.5g\t%f\t%d\t%.5g\t%.5g\t%s\t%f\n", 
-                  nfo.outputList->segment_out[i].chr,
-                  nfo.outputList->segment_out[i].start,
-                  nfo.outputList->segment_out[i].stop,
-                  nfo.outputList->segment_out[i].q,
-                  nfo.outputList->segment_out[i].meandiff,
-                  nfo.outputList->segment_out[i].length,                
-                  nfo.outputList->segment_out[i].mwu,
-                  nfo.outputList->segment_out[i].p,
-                  nfo.outputList->segment_out[i].methA,
-                  // nfo.outputList->segment_out[i].methB,
-                  nfo.outputList->segment_out[i].sigcp);
-        }
+      if(nfo.shardoutput || nfo.outputList->segment_out[i].meandiff >= nfo.minMethDist || nfo.outputList->segment_out[i].meandiff <= -1* nfo.minMethDist) {
+        outputSegmentRow(&nfo.outputList->segment_out[i], nfo.clustering, nfo.search, nfo.shardoutput);
+        fprintf(stdout, "\n");
       }
-      
-      
+    }
     }
   }
     
@@ -3929,27 +4876,36 @@ int main(int argc, char** argv) {
   fflush(stdout); 
   
   
-  FREEMEMORY(NULL, chr);
+  destructChrNames(&chrnames);
   FREEMEMORY(NULL, pos);
   FREEMEMORY(NULL, val);
+  FREEMEMORY(NULL, block);
   FREEMEMORY(NULL, grpA);
   FREEMEMORY(NULL, grpB);
   
-  closeFileIterator(NULL, fi);
-  FREEMEMORY(NULL, fi);
+  destructInputReader(ir);
+  destructInputIndex(idx);
+  if(fi) {
+    closeFileIterator(NULL, fi);
+    FREEMEMORY(NULL, fi);
+  }
+  closeMatCache(mc);
 
   if(csv && csv[0]) destructStringset(NULL, csv[0]);
   if(csv) FREEMEMORY(NULL, csv);
-  for(int i=0;i<nfo.outputList->i;i++){
-    FREEMEMORY(NULL, nfo.outputList->segment_out[i].chr);
+  destructOutputList(nfo.outputList);
+  for(k=0; k < nfo.nthresholds; k++) {
+    destructOutputList(nfo.outputLists[k]);
   }
-  FREEMEMORY(NULL, nfo.outputList->segment_out);
-  FREEMEMORY(NULL, nfo.outputList);
+  FREEMEMORY(NULL, nfo.outputLists);
+  FREEMEMORY(NULL, nfo.thresholds);
 
-  pthread_attr_destroy(&tattr);  
-  FREEMEMORY(NULL, threads);
   FREEMEMORY(NULL, th_nfo);
-  free((void*)schedule);
+  FREEMEMORY(NULL, th_args);
+  destructFormatBuffer(nfo.fmt);
+  destructScratch(nfo.scratch);
+  FREEMEMORY(NULL, nfo.stats);
+  FREEMEMORY(NULL, nfo.chunkstats);
 
   destructMannWhitneyCDFMatrix(nfo.MWU, MAXM, MAXN);
   manopt_destructoptionset(&optset);
@@ -11,6 +11,7 @@
  *
  */
 
+#include <stdint.h>
 
 typedef struct segm{
 
@@ -45,6 +46,7 @@ typedef struct{
   double sigcp;
   char *methA;
   char *methB;
+  int seq; // input order of the chunk, region or CpG, for merging
 } segment_out;
 
 typedef struct{
@@ -67,6 +69,120 @@ typedef struct{
   segment_t *tail;
 } segmentset_t;
 
+/* group combinations as bitsets over the subgroups, words uint64 per
+ * combination; groupID and groupSize hold the sample columns of both sides */
+typedef struct{
+  int n;
+  int words;
+  uint64_t *A;
+  uint64_t *B;
+  int ***groupID;
+  int **groupSize;
+} combination_t;
+
+#define COMBBIT(bits, c, j, w) \
+  (((bits)[(size_t)(c)*(w)+((j)>>6)] >> ((j)&63)) & 1)
+#define SETCOMBBIT(bits, c, j, w) \
+  ((bits)[(size_t)(c)*(w)+((j)>>6)] |= ((uint64_t)1 << ((j)&63)))
+
+/* a run of CpGs without a gap larger than -M, segmented as one piece;
+ * the values of all CpGs are one block, value[i] points to row i */
+typedef struct{
+  char *chr; // interned, owned by the chrnames_t of main
+  int *pos;
+  double *block;
+  double **value;
+  int n;
+} chunk_t;
+
+/* the chromosome names of the input, each stored once */
+typedef struct{
+  char **names;
+  int n;
+  char **select; // -L: the chromosomes to read, NULL: all of them
+  int nselect;
+  char *last; // the name checked last and whether it is selected
+  int lastselected;
+} chrnames_t;
+
+/* work unit of the thread pool: chunks (mode 1), regions (mode 2) or
+ * CpGs (mode 3) are collected until they hold BATCHCPGS CpGs */
+#define BATCHCPGS 1024
+/* batches queued per thread; the free workers take the largest of them */
+#define POOLQUEUE 4
+
+typedef struct{
+  void **items;
+  int n;
+  int cpgs;
+  int seq; // input order of the first item, item k has seq+k
+} batch_t;
+
+/* reusable buffers of one thread for the formatted group means and
+ * comparisons; copies of a metseg_t share them through the pointer */
+typedef struct{
+  char *str[2];
+  size_t len[2];
+} fmtbuf_t;
+
+/* a value of the two-dimensional ks-test with its position, group
+ * (0: x, 1: y) and rank among the distinct values */
+typedef struct{
+  double v;
+  double pos;
+  int set;
+  int rank;
+} kspoint_t;
+
+/* a kstest result of the interval [s,t] for combination gn; only entries
+ * of the current generation (chunk) of the table are valid */
+typedef struct{
+  int s;
+  int t;
+  int gn;
+  int gen;
+  double ks[3];
+} ksmemo_t;
+
+/* reusable scratch space of one thread for kstest: the values and
+ * positions of both groups, the points and trees of counterSweep and the
+ * results of the intervals tested in the current chunk; copies of a
+ * metseg_t share it */
+typedef struct{
+  double *la[2];
+  double *lb[2];
+  size_t size;
+  kspoint_t *pts;
+  int *ints;
+  size_t points;
+  ksmemo_t *memo;
+  size_t memosize;
+  size_t memoused;
+  int gen;
+} kscratch_t;
+
+/* how many candidate intervals each check drops before kstest, and how
+ * many tests were run or taken from the results of the chunk */
+typedef struct{
+  long candidates;
+  long sigcpgs; // combinations, not intervals
+  long mincpgs;
+  long trend;
+  long valley;
+  long tested;
+  long reused;
+} filterstats_t;
+
+/* sizes and segmentation times of the chunks of one thread */
+typedef struct{
+  long chunks;
+  long cpgs;
+  int maxcpgs;
+  double seconds;
+  double maxseconds;
+  int slowcpgs; // CpGs of the slowest chunk
+} chunkstats_t;
+
 typedef struct{
   int start;
   int stop;
@@ -106,7 +222,11 @@ typedef struct{
   int groupNumber;// newcodes
 
   int clustering;// newcodes
+  int search; // combinations for -l 0, 0: exhaustive, 1: ordered by group means
   int outputImputed;// newcodes
+  int nthresholds; // number of -T thresholds, 0: use -d/-w/-q
+  double *thresholds; // each is applied as -d, -w and -q
+  list_out **outputLists; // one output list per threshold
 
   //only used for threaded segmentation
   char **chr;
@@ -123,6 +243,14 @@ typedef struct{
   segment_t *List;
   int nList;
   list_out *outputList;
+  int seq; // input order of the current chunk, region or CpG
+  fmtbuf_t *fmt;
+  kscratch_t *scratch;
+  filterstats_t *stats;
+  chunkstats_t *chunkstats;
+  int readers; // threads parsing the text input, mode 1 only
+  int chrseed; // reseed the random generator at every chromosome, mode 1 only
+  int shardoutput; // print every segment with exact p and meandiff, for merging shards
   
   int threadno;
   int randomseed;
@@ -131,6 +259,24 @@ typedef struct{
 // zzhu$ metseg_t: parameters for the whole process and input data.
 
 void initSegment(segment_t *seg);
+int calGroupNumber(int n, combination_t *comb, int clustering);
+void combinationGroups(combination_t *comb, int **subgroupID, int *subgroupSize, int n);
+void destructCombinations(combination_t *comb);
+void orderedCombinations(segment_t *seg, int **subgroupID, int *subgroupSize, metseg_t *nfo, combination_t *comb);
+void comparisonString(combination_t *comb, int c, int n, char **str);
+void growOutputList(list_out *list);
+void sortOutputList(list_out *list);
+list_out* mergeOutputLists(list_out **lists, int k);
+fmtbuf_t* initFormatBuffer();
+void destructFormatBuffer(fmtbuf_t *fmt);
+kscratch_t* initScratch();
+void destructScratch(kscratch_t *sc);
+void growScratch(kscratch_t *sc, size_t size, size_t points);
+void newChunkScratch(kscratch_t *sc);
+filterstats_t* initFilterStats();
+chunkstats_t* initChunkStats();
+void printFilterStats(filterstats_t *f);
+void printChunkStats(chunkstats_t *cs);
 
 
 typedef struct{
@@ -0,0 +1,182 @@
+/*
+ *
+ *  threadpool.c
+ *  persistent worker threads fed from a bounded task queue
+ *
+ *  @author zzhu
+ *
+ */
+
+#include <stdlib.h>
+#include <stdio.h>
+#include <pthread.h>
+#include "memory.h"
+#include "threadpool.h"
+
+/*----------------------------- threadPoolWorker -----------------------------
+ *
+ * @brief take tasks from the queue, the largest first, until the pool is
+ * stopped and drained
+ * @author zzhu
+ *
+ */
+
+static void*
+threadPoolWorker(void *args) {
+  threadpoolworker_t *w = (threadpoolworker_t*) args;
+  threadpool_t *pool = w->pool;
+  void *task;
+  long weight;
+  int i, k, best;
+
+  while(1) {
+    pthread_mutex_lock(&pool->lock);
+    while(pool->count == 0 && !pool->stop) {
+      pthread_cond_wait(&pool->notempty, &pool->lock);
+    }
+    if(pool->count == 0) {
+      pthread_mutex_unlock(&pool->lock);
+      break;
+    }
+    //swap the first of the largest tasks to the head
+    best = pool->head;
+    for(i=1; i < pool->count; i++) {
+      k = (pool->head+i) % pool->size;
+      if(pool->weight[k] > pool->weight[best]) best = k;
+    }
+    task = pool->queue[best];
+    weight = pool->weight[best];
+    pool->queue[best] = pool->queue[pool->head];
+    pool->weight[best] = pool->weight[pool->head];
+    pool->queue[pool->head] = task;
+    pool->weight[pool->head] = weight;
+    pool->head = (pool->head+1) % pool->size;
+    pool->count--;
+    pthread_cond_signal(&pool->notfull);
+    pthread_mutex_unlock(&pool->lock);
+
+    pool->fn(task, pool->args[w->id]);
+
+    pthread_mutex_lock(&pool->lock);
+    pool->pending--;
+    if(pool->pending == 0) {
+      pthread_cond_broadcast(&pool->done);
+    }
+    pthread_mutex_unlock(&pool->lock);
+  }
+
+  return NULL;
+}
+
+/*------------------------------ initThreadPool ------------------------------
+ *
+ * @brief start nthreads workers; worker i calls fn(task, args[i]).
+ * At most queuesize tasks wait in the queue.
+ * @author zzhu
+ *
+ */
+
+threadpool_t*
+initThreadPool(int nthreads, int queuesize, threadpool_fn fn, void **args) {
+  threadpool_t *pool = ALLOCMEMORY(NULL, NULL, threadpool_t, 1);
+  int i;
+
+  pool->nthreads = nthreads;
+  pool->fn = fn;
+  pool->args = args;
+  pool->size = (queuesize > 0) ? queuesize : 1;
+  pool->queue = ALLOCMEMORY(NULL, NULL, void*, pool->size);
+  pool->weight = ALLOCMEMORY(NULL, NULL, long, pool->size);
+  pool->head = 0;
+  pool->count = 0;
+  pool->pending = 0;
+  pool->stop = 0;
+  pthread_mutex_init(&pool->lock, NULL);
+  pthread_cond_init(&pool->notempty, NULL);
+  pthread_cond_init(&pool->notfull, NULL);
+  pthread_cond_init(&pool->done, NULL);
+
+  pool->threads = ALLOCMEMORY(NULL, NULL, pthread_t, nthreads);
+  pool->workers = ALLOCMEMORY(NULL, NULL, threadpoolworker_t, nthreads);
+  for(i=0; i < nthreads; i++) {
+    pool->workers[i].pool = pool;
+    pool->workers[i].id = i;
+    if(pthread_create(&pool->threads[i], NULL, threadPoolWorker, &pool->workers[i]) != 0) {
+      fprintf(stderr, "could not start worker thread %d. Exit forced.\n", i);
+      exit(-1);
+    }
+  }
+
+  return pool;
+}
+
+/*----------------------------- submitThreadPool -----------------------------
+ *
+ * @brief queue a task of the given weight, e.g. its size; blocks while the
+ * queue is full
+ * @author zzhu
+ *
+ */
+
+void
+submitThreadPool(threadpool_t *pool, void *task, long weight) {
+  pthread_mutex_lock(&pool->lock);
+  while(pool->count == pool->size) {
+    pthread_cond_wait(&pool->notfull, &pool->lock);
+  }
+  pool->queue[(pool->head+pool->count) % pool->size] = task;
+  pool->weight[(pool->head+pool->count) % pool->size] = weight;
+  pool->count++;
+  pool->pending++;
+  pthread_cond_signal(&pool->notempty);
+  pthread_mutex_unlock(&pool->lock);
+}
+
+/*------------------------------ waitThreadPool ------------------------------
+ *
+ * @brief wait until every submitted task has finished
+ * @author zzhu
+ *
+ */
+
+void
+waitThreadPool(threadpool_t *pool) {
+  pthread_mutex_lock(&pool->lock);
+  while(pool->pending > 0) {
+    pthread_cond_wait(&pool->done, &pool->lock);
+  }
+  pthread_mutex_unlock(&pool->lock);
+}
+
+/*---------------------------- destructThreadPool ----------------------------
+ *
+ * @brief finish the queued tasks, join the workers and release the pool
+ * @author zzhu
+ *
+ */
+
+void
+destructThreadPool(threadpool_t *pool) {
+  int i;
+
+  if(!pool) return;
+
+  pthread_mutex_lock(&pool->lock);
+  pool->stop = 1;
+  pthread_cond_broadcast(&pool->notempty);
+  pthread_mutex_unlock(&pool->lock);
+
+  for(i=0; i < pool->nthreads; i++) {
+    pthread_join(pool->threads[i], NULL);
+  }
+
+  pthread_mutex_destroy(&pool->lock);
+  pthread_cond_destroy(&pool->notempty);
+  pthread_cond_destroy(&pool->notfull);
+  pthread_cond_destroy(&pool->done);
+  FREEMEMORY(NULL, pool->threads);
+  FREEMEMORY(NULL, pool->workers);
+  FREEMEMORY(NULL, pool->queue);
+  FREEMEMORY(NULL, pool->weight);
+  FREEMEMORY(NULL, pool);
+}
@@ -0,0 +1,56 @@
+#ifndef THREADPOOL_H
+#define THREADPOOL_H
+/*
+ *
+ *  threadpool.h
+ *  persistent worker threads fed from a bounded task queue
+ *
+ *  The reader submits tasks and blocks only while the queue is full, so
+ *  it keeps parsing ahead while the workers are busy. A free worker takes
+ *  the queued task of the largest weight, the oldest of equal weights, so
+ *  long tasks start early and do not hold up the end of the run. Each
+ *  worker passes its own argument (e.g. a private metseg_t copy) to the
+ *  task function.
+ *
+ *  @author zzhu
+ *
+ */
+
+#include <pthread.h>
+
+typedef void (*threadpool_fn)(void *task, void *arg);
+
+struct threadpool_s;
+
+typedef struct{
+  struct threadpool_s *pool;
+  int id;
+} threadpoolworker_t;
+
+typedef struct threadpool_s{
+  int nthreads;
+  pthread_t *threads;
+  threadpoolworker_t *workers;
+  threadpool_fn fn;
+  void **args;
+
+  void **queue;
+  long *weight; // of the queued tasks
+  int size;
+  int head;
+  int count;
+  int pending; // queued or running tasks
+  int stop;
+
+  pthread_mutex_t lock;
+  pthread_cond_t notempty;
+  pthread_cond_t notfull;
+  pthread_cond_t done;
+} threadpool_t;
+
+threadpool_t* initThreadPool(int nthreads, int queuesize, threadpool_fn fn, void **args);
+void submitThreadPool(threadpool_t *pool, void *task, long weight);
+void waitThreadPool(threadpool_t *pool);
+void destructThreadPool(threadpool_t *pool);
+
+#endif
@@ -0,0 +1,383 @@
+/*
+ *
+ *  zinput.c
+ *  transparent gzip/bgzip decompression of input files
+ *
+ *  Methylation matrices are usually kept bgzip-compressed. Reading them
+ *  through a stream avoids decompressing them to scratch space first; all
+ *  text readers (fileio, bedavg) take the FILE* as if it were the plain
+ *  file.
+ *
+ *  @author zzhu
+ *
+ */
+
+#define _GNU_SOURCE
+
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <stdint.h>
+#include <limits.h>
+#include <pthread.h>
+#include <sys/types.h>
+#include <zlib.h>
+#include "zinput.h"
+
+#define BGZF_EMPTY 0
+#define BGZF_QUEUED 1
+#define BGZF_INFLATED 2
+
+typedef struct {
+  unsigned char in[BGZF_MAXBLOCK];
+  unsigned char out[BGZF_MAXBLOCK];
+  size_t inlen;
+  size_t data; // start of the deflate data in in
+  size_t outlen;
+  int state;
+} bgzfblock_t;
+
+typedef struct {
+  char *filename;
+  FILE *fp;
+  int nthreads;
+  pthread_t *threads;
+  int nslots;
+  bgzfblock_t *slots;
+  uint64_t nread; // blocks read from fp
+  uint64_t next; // next block claimed by a worker
+  uint64_t cur; // block read by the caller
+  size_t ptr; // next byte of cur
+  int eof;
+  int stop;
+  pthread_mutex_t lock;
+  pthread_cond_t queued;
+  pthread_cond_t inflated;
+} bgzfstream_t;
+
+/*---------------------------------- zi_die ----------------------------------
+ *
+ * @brief report a corrupt or unreadable compressed input and exit
+ * @author zzhu
+ *
+ */
+
+static void
+zi_die(char *msg, const char *filename) {
+  fprintf(stderr, "compressed input %s: %s. Exit forced.\n", filename, msg);
+  exit(-1);
+}
+
+/*----------------------------- isCompressedInput ----------------------------
+ *
+ * @brief check the gzip magic bytes; bgzip files are gzip files as well
+ * @author zzhu
+ *
+ */
+
+int
+isCompressedInput(const char *filename) {
+  unsigned char magic[2];
+  FILE *fp = fopen(filename, "rb");
+  int ret = 0;
+
+  if(!fp) return 0;
+  if(fread(magic, 1, 2, fp) == 2 && magic[0] == 0x1f && magic[1] == 0x8b) {
+    ret = 1;
+  }
+  fclose(fp);
+  return ret;
+}
+
+/*------------------------------- bgzfBlockSize ------------------------------
+ *
+ * @brief the size of a bgzip block from its gzip header (12 bytes) and
+ * extra field (xlen bytes), or 0 if the BC subfield is missing
+ * @author zzhu
+ *
+ */
+
+static size_t
+bgzfBlockSize(unsigned char *h, size_t xlen) {
+  unsigned char *x = h+12;
+  size_t i, slen;
+
+  if(h[0] != 0x1f || h[1] != 0x8b || h[2] != 8 || !(h[3] & 4)) return 0;
+  for(i=0; i+4 <= xlen; i += 4+slen) {
+    slen = x[i+2] | (x[i+3] << 8);
+    if(x[i] == 'B' && x[i+1] == 'C' && slen == 2 && i+6 <= xlen) {
+      return (x[i+4] | (x[i+5] << 8)) + 1;
+    }
+  }
+  return 0;
+}
+
+/*-------------------------------- isBgzfFile --------------------------------
+ *
+ * @brief whether the first gzip member carries the bgzip BC subfield
+ * @author zzhu
+ *
+ */
+
+static int
+isBgzfFile(FILE *fp) {
+  unsigned char h[BGZF_MAXBLOCK];
+  size_t xlen;
+  int ret = 0;
+
+  if(fread(h, 1, 12, fp) == 12 && (h[3] & 4)) {
+    xlen = h[10] | (h[11] << 8);
+    ret = (fread(h+12, 1, xlen, fp) == xlen && bgzfBlockSize(h, xlen) > 0);
+  }
+  rewind(fp);
+  return ret;
+}
+
+/*------------------------------- readBgzfBlock ------------------------------
+ *
+ * @brief read the next compressed block; returns 0 at the end of the file
+ * @author zzhu
+ *
+ */
+
+static int
+readBgzfBlock(bgzfstream_t *z, bgzfblock_t *b) {
+  size_t len, xlen, size;
+
+  len = fread(b->in, 1, 12, z->fp);
+  if(len == 0) return 0;
+  if(len < 12) zi_die("truncated block header", z->filename);
+  xlen = b->in[10] | (b->in[11] << 8);
+  if(fread(b->in+12, 1, xlen, z->fp) != xlen) zi_die("truncated block header", z->filename);
+  size = bgzfBlockSize(b->in, xlen);
+  if(size < 12+xlen+8 || size > BGZF_MAXBLOCK) zi_die("not a bgzip block", z->filename);
+  if(fread(b->in+12+xlen, 1, size-12-xlen, z->fp) != size-12-xlen) {
+    zi_die("truncated block", z->filename);
+  }
+  b->inlen = size;
+  b->data = 12+xlen;
+  return 1;
+}
+
+/*------------------------------- inflateBgzfBlock ---------------------------
+ *
+ * @brief inflate one block and check its length and crc32
+ * @author zzhu
+ *
+ */
+
+static void
+inflateBgzfBlock(bgzfstream_t *z, z_stream *zs, bgzfblock_t *b) {
+  unsigned char *t = b->in + b->inlen - 8;
+  uint32_t crc = t[0] | (t[1] << 8) | (t[2] << 16) | ((uint32_t)t[3] << 24);
+  uint32_t isize = t[4] | (t[5] << 8) | (t[6] << 16) | ((uint32_t)t[7] << 24);
+
+  inflateReset(zs);
+  zs->next_in = b->in + b->data;
+  zs->avail_in = b->inlen - b->data - 8;
+  zs->next_out = b->out;
+  zs->avail_out = BGZF_MAXBLOCK;
+  if(inflate(zs, Z_FINISH) != Z_STREAM_END) zi_die("corrupt block", z->filename);
+  b->outlen = zs->total_out;
+  if(b->outlen != isize || crc32(crc32(0L, Z_NULL, 0), b->out, b->outlen) != crc) {
+    zi_die("block fails its length or crc check", z->filename);
+  }
+}
+
+/*--------------------------------- bgzfWorker -------------------------------
+ *
+ * @brief inflate queued blocks in the order they were read
+ * @author zzhu
+ *
+ */
+
+static void*
+bgzfWorker(void *args) {
+  bgzfstream_t *z = (bgzfstream_t*) args;
+  bgzfblock_t *b;
+  z_stream zs;
+
+  memset(&zs, 0, sizeof(z_stream));
+  if(inflateInit2(&zs, -15) != Z_OK) zi_die("cannot initialize zlib", z->filename);
+
+  while(1) {
+    pthread_mutex_lock(&z->lock);
+    while(!z->stop && z->next == z->nread) {
+      pthread_cond_wait(&z->queued, &z->lock);
+    }
+    if(z->stop) {
+      pthread_mutex_unlock(&z->lock);
+      break;
+    }
+    b = &z->slots[z->next++ % z->nslots];
+    pthread_mutex_unlock(&z->lock);
+
+    inflateBgzfBlock(z, &zs, b);
+
+    pthread_mutex_lock(&z->lock);
+    b->state = BGZF_INFLATED;
+    pthread_cond_broadcast(&z->inflated);
+    pthread_mutex_unlock(&z->lock);
+  }
+
+  inflateEnd(&zs);
+  return NULL;
+}
+
+/*--------------------------------- bgzfRead ---------------------------------
+ *
+ * @brief stream read: keep all slots queued, then copy from the blocks
+ * in order as they are inflated
+ * @author zzhu
+ *
+ */
+
+static ssize_t
+bgzfRead(void *cookie, char *buf, size_t n) {
+  bgzfstream_t *z = (bgzfstream_t*) cookie;
+  bgzfblock_t *b;
+  size_t got = 0, len;
+
+  while(got < n) {
+    while(!z->eof && z->nread < z->cur + z->nslots) {
+      b = &z->slots[z->nread % z->nslots];
+      if(!readBgzfBlock(z, b)) {
+        z->eof = 1;
+        break;
+      }
+      pthread_mutex_lock(&z->lock);
+      b->state = BGZF_QUEUED;
+      z->nread++;
+      pthread_cond_signal(&z->queued);
+      pthread_mutex_unlock(&z->lock);
+    }
+    if(z->cur == z->nread) break;
+
+    b = &z->slots[z->cur % z->nslots];
+    if(z->ptr == 0) {
+      pthread_mutex_lock(&z->lock);
+      while(b->state != BGZF_INFLATED) {
+        pthread_cond_wait(&z->inflated, &z->lock);
+      }
+      pthread_mutex_unlock(&z->lock);
+    }
+
+    len = b->outlen - z->ptr;
+    if(len > n-got) len = n-got;
+    memcpy(buf+got, b->out+z->ptr, len);
+    got += len;
+    z->ptr += len;
+
+    if(z->ptr == b->outlen) {
+      pthread_mutex_lock(&z->lock);
+      b->state = BGZF_EMPTY;
+      z->cur++;
+      z->ptr = 0;
+      pthread_mutex_unlock(&z->lock);
+    }
+  }
+
+  return got;
+}
+
+/*--------------------------------- bgzfClose --------------------------------
+ *
+ * @brief stop the workers and free the stream
+ * @author zzhu
+ *
+ */
+
+static int
+bgzfClose(void *cookie) {
+  bgzfstream_t *z = (bgzfstream_t*) cookie;
+  int i;
+
+  pthread_mutex_lock(&z->lock);
+  z->stop = 1;
+  pthread_cond_broadcast(&z->queued);
+  pthread_mutex_unlock(&z->lock);
+  for(i=0; i < z->nthreads; i++) {
+    pthread_join(z->threads[i], NULL);
+  }
+
+  fclose(z->fp);
+  pthread_mutex_destroy(&z->lock);
+  pthread_cond_destroy(&z->queued);
+  pthread_cond_destroy(&z->inflated);
+  free(z->threads);
+  free(z->slots);
+  free(z->filename);
+  free(z);
+  return 0;
+}
+
+/*---------------------------------- gzRead ----------------------------------
+ *
+ * @brief stream read of a gzip file through zlib
+ * @author zzhu
+ *
+ */
+
+static ssize_t
+gzRead(void *cookie, char *buf, size_t n) {
+  int len;
+
+  if(n > INT_MAX) n = INT_MAX;
+  len = gzread((gzFile) cookie, buf, (unsigned) n);
+  return (len < 0) ? -1 : len;
+}
+
+static int
+gzClose(void *cookie) {
+  return (gzclose((gzFile) cookie) == Z_OK) ? 0 : EOF;
+}
+
+/*------------------------------ openInputStream -----------------------------
+ *
+ * @brief open a plain, gzip or bgzip file for reading; bgzip blocks are
+ * inflated by nthreads workers if nthreads > 1. Returns NULL if the file
+ * cannot be opened
+ * @author zzhu
+ *
+ */
+
+FILE*
+openInputStream(const char *filename, int nthreads) {
+  cookie_io_functions_t bgzfio = {bgzfRead, NULL, NULL, bgzfClose};
+  cookie_io_functions_t gzio = {gzRead, NULL, NULL, gzClose};
+  unsigned char magic[2];
+  bgzfstream_t *z;
+  gzFile gz;
+  FILE *fp;
+  int i;
+
+  if(!(fp = fopen(filename, "r"))) return NULL;
+  if(fread(magic, 1, 2, fp) != 2 || magic[0] != 0x1f || magic[1] != 0x8b) {
+    rewind(fp);
+    return fp;
+  }
+  rewind(fp);
+
+  if(nthreads > 1 && isBgzfFile(fp)) {
+    z = calloc(1, sizeof(bgzfstream_t));
+    z->filename = strdup(filename);
+    z->fp = fp;
+    z->nthreads = nthreads;
+    z->nslots = 4*nthreads;
+    z->slots = calloc(z->nslots, sizeof(bgzfblock_t));
+    z->threads = malloc(sizeof(pthread_t)*nthreads);
+    if(!z->slots || !z->threads) zi_die("out of memory", filename);
+    pthread_mutex_init(&z->lock, NULL);
+    pthread_cond_init(&z->queued, NULL);
+    pthread_cond_init(&z->inflated, NULL);
+    for(i=0; i < nthreads; i++) {
+      pthread_create(&z->threads[i], NULL, bgzfWorker, z);
+    }
+    return fopencookie(z, "r", bgzfio);
+  }
+
+  fclose(fp);
+  if(!(gz = gzopen(filename, "rb"))) return NULL;
+  gzbuffer(gz, 1 << 17);
+  return fopencookie(gz, "r", gzio);
+}
@@ -0,0 +1,25 @@
+#ifndef ZINPUT_H
+#define ZINPUT_H
+/*
+ *
+ *  zinput.h
+ *  transparent gzip/bgzip decompression of input files
+ *
+ *  openInputStream returns a read-only stream for a plain, gzip or bgzip
+ *  file, told apart by the magic bytes. gzip is inflated by zlib on the
+ *  reading thread. bgzip is a series of independent gzip blocks of at most
+ *  64 kB: the reading thread reads the compressed blocks in order and
+ *  nthreads workers inflate them ahead of it. The stream cannot seek.
+ *
+ *  @author zzhu
+ *
+ */
+
+#include <stdio.h>
+
+#define BGZF_MAXBLOCK 65536
+
+int isCompressedInput(const char *filename);
+FILE* openInputStream(const char *filename, int nthreads);
+
+#endif